@@ -0,0 +1,109 @@
+"""Compare the single-pass handleDirs with the per-file rglob version it replaced.
+
+Usage: python benchmarks/bench_handle_dirs.py [seasons] [episodes_per_season]
+
+Builds a show with one directory per season, each holding a release folder
+per episode with a sparse media file, a sample and a Subs folder of srt
+files, then times flattening it with each implementation.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from settings import MEDIA_FILE_EXTENSIONS, MINIMUM_FILE_SIZE  # noqa: E402
+from tv_runner import TvRunner  # noqa: E402
+
+SUBTITLES = ("2_Eng.srt", "3_English.srt", "4_Spa.srt")
+
+
+def _setup(show_dir, seasons, episodes):
+    for season in range(1, seasons + 1):
+        season_dir = show_dir / f"Some.Show.S{season:02d}.1080p.WEB-DL"
+        for episode in range(1, episodes + 1):
+            name = f"Some.Show.S{season:02d}E{episode:02d}.1080p.WEB-DL"
+            release_dir = season_dir / name
+            (release_dir / "Subs").mkdir(parents=True)
+            (release_dir / "Sample").mkdir()
+
+            with open(release_dir / f"{name}.mkv", "wb") as f:
+                f.truncate(MINIMUM_FILE_SIZE + 1)
+            (release_dir / "Sample" / f"{name}.sample.mkv").write_bytes(b"0")
+            (release_dir / f"{name}.nfo").write_bytes(b"0")
+            for subtitle in SUBTITLES:
+                (release_dir / "Subs" / subtitle).write_bytes(b"0")
+
+    # Everything is old enough to be considered settled
+    mtime = time.time() - 3600
+    for root, dirs, files in os.walk(show_dir):
+        for file in files:
+            os.utime(os.path.join(root, file), (mtime, mtime))
+
+
+def legacy_handle_dirs(path):
+    paths = []
+    dir_set = set()
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            paths.append(Path(root) / file)
+
+    for fullpath in paths:
+        dirs = str(fullpath).split(str(path))[1].split(os.path.sep)
+        top, episode, file = path, dirs[1], dirs[-1]
+        file_ext = os.path.splitext(file)[-1].lower()
+
+        dir_path = Path(top) / episode
+        if dir_path.is_dir():
+            dir_set.add(dir_path)
+
+            count = 0
+            for srt_path in dir_path.rglob("*Eng*.srt"):
+                os.rename(srt_path, Path(top) / f"{episode}-{count}.srt")
+                count += 1
+
+            if (
+                file_ext in MEDIA_FILE_EXTENSIONS
+                and os.path.getsize(fullpath) > MINIMUM_FILE_SIZE
+            ):
+                os.rename(fullpath, os.path.join(top, file))
+
+    for directory in dir_set:
+        shutil.rmtree(directory)
+
+
+def _run(name, func, seasons, episodes):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        show_dir = Path(temp_dir) / "Some.Show"
+        _setup(show_dir, seasons, episodes)
+        num_files = sum(len(files) for _, _, files in os.walk(show_dir))
+
+        start = time.perf_counter()
+        func(show_dir)
+        elapsed = time.perf_counter() - start
+
+        remaining = sorted(x.name for x in show_dir.iterdir())
+    print(f"{name:>12}: {num_files} files in {elapsed:.3f}s")
+    return remaining
+
+
+def main(seasons=50, episodes=24):
+    tv_runner = TvRunner()
+    legacy = _run("legacy", legacy_handle_dirs, seasons, episodes)
+    single_pass = _run("single pass", tv_runner.handleDirs, seasons, episodes)
+
+    # The subtitle numbering depends on directory order, so only compare
+    # what ended up in the show directory
+    assert len(legacy) == len(single_pass)
+    assert [x for x in legacy if x.endswith(".mkv")] == [
+        x for x in single_pass if x.endswith(".mkv")
+    ]
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
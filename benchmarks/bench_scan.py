@@ -0,0 +1,101 @@
+"""Compare the os.scandir walker with the find subprocess it replaced.
+
+Usage: python benchmarks/bench_scan.py [num_files]
+
+Builds a tree of empty files spread over show and season directories, then
+times listing every file in one call (like _getFilesInDirectory) and listing
+each season directory with a size filter (like buildLocalFileSet, which runs
+once per show).
+"""
+
+import sys
+import shlex
+import tempfile
+import time
+
+from pathlib import Path
+from subprocess import Popen, PIPE  # nosec
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from scanner import scan_files  # noqa: E402
+
+FILES_PER_DIRECTORY = 100
+DIRECTORIES_PER_SHOW = 10
+
+
+def _setup(directory, num_files):
+    for i in range(num_files):
+        dir_num = i // FILES_PER_DIRECTORY
+        subdir = (
+            directory
+            / f"show{dir_num // DIRECTORIES_PER_SHOW}"
+            / f"season{dir_num % DIRECTORIES_PER_SHOW}"
+        )
+        if i % FILES_PER_DIRECTORY == 0:
+            subdir.mkdir(parents=True)
+        (subdir / f"episode{i}.mkv").touch()
+
+
+def bench_find(directory):
+    start = time.perf_counter()
+    command = f"find '{directory}' -maxdepth 10 -not -type d"
+    p = Popen(shlex.split(command), stdout=PIPE, stderr=PIPE)  # nosec
+    res = p.communicate()[0]
+    count = len(set(x for x in res.split(b"\n") if x))
+    return count, time.perf_counter() - start
+
+
+def bench_scandir(directory):
+    start = time.perf_counter()
+    count = len(set(entry.path for entry in scan_files(directory, max_depth=10)))
+    return count, time.perf_counter() - start
+
+
+def bench_find_per_directory(directories):
+    start = time.perf_counter()
+    count = 0
+    for directory in directories:
+        command = f"find '{directory}' -maxdepth 1 -size +0c -not -type d"
+        p = Popen(shlex.split(command), stdout=PIPE, stderr=PIPE)  # nosec
+        res = p.communicate()[0]
+        count += len(set(x for x in res.split(b"\n") if x))
+    return count, time.perf_counter() - start
+
+
+def bench_scandir_per_directory(directories):
+    start = time.perf_counter()
+    count = 0
+    for directory in directories:
+        count += len(
+            set(entry.name for entry in scan_files(directory, max_depth=1, min_size=0))
+        )
+    return count, time.perf_counter() - start
+
+
+def main(num_files=100000):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        directory = Path(temp_dir)
+        _setup(directory, num_files)
+
+        print("Whole tree:")
+        for name, bench in (("find", bench_find), ("scandir", bench_scandir)):
+            count, elapsed = bench(directory)
+            print(f"{name:>8}: {count} files in {elapsed:.3f}s")
+
+        # Give every file a size so the size filter has something to pass
+        for path in directory.glob("*/*/*"):
+            path.write_bytes(b"0")
+
+        directories = sorted(directory.glob("*/*"))
+        print(f"Each of {len(directories)} directories:")
+        for name, bench in (
+            ("find", bench_find_per_directory),
+            ("scandir", bench_scandir_per_directory),
+        ):
+            count, elapsed = bench(directories)
+            print(f"{name:>8}: {count} files in {elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,60 @@
+"""Compare the native srt -> vtt converter with the srt-vtt binary.
+
+Usage: python benchmarks/bench_subtitles.py [num_files]
+"""
+
+import sys
+import shutil
+import tempfile
+import time
+
+from pathlib import Path
+from subprocess import run, DEVNULL  # nosec
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from subtitles import convert_srt_to_vtt  # noqa: E402
+
+DATA_DIR_PATH = Path(__file__).resolve().parent.parent / "tests" / "data"
+
+
+def _setup(directory, num_files):
+    sources = sorted(DATA_DIR_PATH.glob("*.srt"))
+    for i in range(num_files):
+        shutil.copy(sources[i % len(sources)], directory / f"{i}.srt")
+
+
+def bench_native(directory):
+    start = time.perf_counter()
+    for srt_path in sorted(directory.glob("*.srt")):
+        convert_srt_to_vtt(srt_path)
+    return time.perf_counter() - start
+
+
+def bench_subprocess(directory):
+    start = time.perf_counter()
+    for srt_path in sorted(directory.glob("*.srt")):
+        run(["srt-vtt", str(srt_path)], stdout=DEVNULL, stderr=DEVNULL)  # nosec
+    return time.perf_counter() - start
+
+
+def main(num_files=500):
+    benches = [("native", bench_native)]
+    if shutil.which("srt-vtt"):
+        benches.append(("srt-vtt", bench_subprocess))
+    else:
+        print("srt-vtt not found on PATH, skipping subprocess benchmark")
+
+    for name, bench in benches:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            directory = Path(temp_dir)
+            _setup(directory, num_files)
+            elapsed = bench(directory)
+        print(
+            f"{name:>8}: {num_files} files in {elapsed:.3f}s "
+            f"({elapsed / num_files * 1000:.2f}ms/file)"
+        )
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
@@ -0,0 +1,151 @@
+import time
+import logging
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qs, urlencode
+
+from settings import (
+    CATALOG_UPDATED_AFTER_PARAM,
+    CATALOG_FULL_SYNC_INTERVAL,
+)
+from state import connect
+from utils import get_all_pages
+
+log = logging.getLogger(__name__)
+
+# Changes are asked for from this many seconds before the last sync started
+# so clock differences with the server can't hide an update
+SYNC_OVERLAP = 300
+
+
+def with_query(url, **params):
+    parts = urlsplit(url)
+    query = parse_qs(parts.query, keep_blank_values=True)
+    query.update({key: [value] for key, value in params.items()})
+    return urlunsplit(parts._replace(query=urlencode(query, doseq=True)))
+
+
+class RemoteCatalog:
+    """Local copy of a MediaViewer listing that is kept current with deltas.
+
+    The first sync fetches the whole listing at url. Later syncs only ask
+    for entries updated since the previous one and apply them on top of the
+    stored copy. A server that ignores the filter just sends everything,
+    which is applied the same way. Deleted entries can't be seen in a delta,
+    so the whole listing is fetched again every full_sync_interval hours or
+    whenever a full sync is asked for.
+
+    parse turns one listing result into (local path, media path pk,
+    finished) tuples.
+    """
+
+    DB_NAME = "catalog"
+
+    def __init__(self, name, url, parse, full_sync_interval=None):
+        self.name = name
+        self.url = url
+        self.parse = parse
+        self.full_sync_interval = (
+            CATALOG_FULL_SYNC_INTERVAL
+            if full_sync_interval is None
+            else full_sync_interval
+        )
+
+    @contextmanager
+    def _connect(self):
+        with connect(self.DB_NAME) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "catalog TEXT NOT NULL, "
+                "pk INTEGER NOT NULL, "
+                "path TEXT NOT NULL, "
+                "finished INTEGER NOT NULL, "
+                "PRIMARY KEY (catalog, pk))"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS syncs ("
+                "catalog TEXT PRIMARY KEY, "
+                "updated_after TEXT NOT NULL, "
+                "full_synced_at REAL NOT NULL)"
+            )
+            yield conn
+
+    def _last_sync(self):
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT updated_after, full_synced_at FROM syncs WHERE catalog=?",
+                (self.name,),
+            ).fetchone()
+
+    def needs_full_sync(self):
+        last_sync = self._last_sync()
+        if last_sync is None:
+            return True
+        return time.time() - last_sync[1] > self.full_sync_interval * 3600
+
+    def _rows(self, url):
+        for data in get_all_pages(url):
+            for result in data["results"] or ():
+                for path, pk, finished in self.parse(result):
+                    yield pk, str(path), int(bool(finished))
+
+    def sync(self, full=False):
+        """Bring the stored copy up to date and return it."""
+        last_sync = self._last_sync()
+        full = full or self.needs_full_sync()
+
+        started = datetime.now(timezone.utc) - timedelta(seconds=SYNC_OVERLAP)
+        if full:
+            log.info(f"Fetching the whole {self.name} catalog")
+            url = self.url
+        else:
+            log.info(f"Fetching {self.name} catalog changes since {last_sync[0]}")
+            url = with_query(self.url, **{CATALOG_UPDATED_AFTER_PARAM: last_sync[0]})
+
+        # Fetch everything before touching the stored copy so a failed sync
+        # leaves the previous one intact
+        rows = list(self._rows(url))
+
+        with self._connect() as conn:
+            if full:
+                conn.execute("DELETE FROM entries WHERE catalog=?", (self.name,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries (catalog, pk, path, finished) "
+                "VALUES (?, ?, ?, ?)",
+                [(self.name, *row) for row in rows],
+            )
+            conn.execute(
+                "INSERT INTO syncs (catalog, updated_after, full_synced_at) "
+                "VALUES (?, ?, ?) "
+                "ON CONFLICT(catalog) DO UPDATE SET "
+                "updated_after=excluded.updated_after, "
+                "full_synced_at=CASE WHEN ? THEN excluded.full_synced_at "
+                "ELSE syncs.full_synced_at END",
+                (self.name, started.isoformat(), time.time(), int(full)),
+            )
+        log.info(f"Applied {len(rows)} {self.name} catalog entries")
+
+        return self.paths()
+
+    def paths(self):
+        """Return the stored copy as {path: {"pks": set, "finished": bool}}."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT path, pk, finished FROM entries WHERE catalog=? ORDER BY pk",
+                (self.name,),
+            ).fetchall()
+
+        paths = dict()
+        for path, pk, finished in rows:
+            val = paths.setdefault(
+                Path(path), {"pks": set(), "finished": bool(finished)}
+            )
+            val["pks"].add(pk)
+        return paths
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM entries WHERE catalog=?", (self.name,))
+            conn.execute("DELETE FROM syncs WHERE catalog=?", (self.name,))
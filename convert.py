@@ -1,23 +1,49 @@
+import os
+import time
 import shutil
-import shlex
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from re import search
 from settings import (
     MEDIAVIEWER_SUFFIX,
     ENCODER,
+    MAX_PARALLEL_ENCODES,
+    SINGLE_PASS_ENCODE,
+    ENCODE_PROGRESS_INTERVAL,
+    ENCODE_STDERR_TAIL_BYTES,
+    SCRATCH_STRATEGY,
+    SCRATCH_DIR,
+    SCRATCH_FREE_SPACE_FACTOR,
+    SCRATCH_STALE_HOURS,
+    CHUNKED_ENCODE_MIN_DURATION,
+    CHUNKED_ENCODE_SEGMENT_SECONDS,
+    CHUNKED_ENCODE_WORKERS,
 )
 from utils import (
     stripUnicode,
+    normalize_paths,
     EncoderException,
     is_valid_media_file,
 )
-from subprocess import Popen, PIPE
+from probe import probe, get_probe_cache
+from jobs import estimate_cost
+from subtitles import convert_srt_to_vtt
+from profiles import select_profile, SourceProperties
+from progress import parse_progress, progress_logger, OutputTail
+from scanner import scan_files, StabilityGate
+from subprocess import Popen, PIPE, DEVNULL
 
 import logging
 
 log = logging.getLogger(__name__)
 
 
+SCRATCH_PREFIX = ".mc-scratch-"
+
+
 class AlreadyEncoded(Exception):
     """Raised when attempting to encoded a file previously encoded."""
 
@@ -26,20 +52,17 @@ class SkipProcessing(Exception):
     """Raised to stop processing a file."""
 
 
-def checkVideoEncoding(source):
-    ffmpeg = Popen((ENCODER, "-hide_banner", "-i", source), stderr=PIPE)  # nosec
-    output = ffmpeg.communicate()[1].decode("utf-8")
+_directory_locks = defaultdict(threading.Lock)
+_directory_locks_lock = threading.Lock()
+
+
+def _directoryLock(directory):
+    with _directory_locks_lock:
+        return _directory_locks[Path(directory)]
 
-    # Can't check returncode here since we always get back 1
-    if "At least one output file must be specified" != output.split("\n")[-2]:
-        log.error(output)
-        raise EncoderException(output)
 
-    vmatch = search(r"Video.*h264", output)
-    amatch = search(r"Audio.*aac", output)
-    smatch = search(r"(\d+).(\d+)\(eng.*Subtitle", output)
-    surround = search(r"Audio.*5\.1", output)
-    return (vmatch and 1 or 0, amatch and 1 or 0, smatch, surround)
+def checkVideoEncoding(source):
+    return probe(source, cache=get_probe_cache())
 
 
 def _extractSubtitles(source, dest, stream_identifier):
@@ -85,140 +108,361 @@ def _extractSubtitleFromVideo(
 
 
 def _convertSrtToVtt(srt_path):
-    vtt_path = srt_path.with_suffix(".vtt")
+    return convert_srt_to_vtt(srt_path)
 
-    srt_vtt_command = ["srt-vtt", str(srt_path)]
-    log.info("Extracting using following command:")
-    log.info(" ".join(srt_vtt_command))
-    process = Popen(srt_vtt_command, stdin=PIPE, stdout=PIPE, stderr=PIPE)  # nosec
-    out, err = process.communicate()
-    if process.returncode != 0:
-        log.error(err)
-        try:
-            vtt_path.unlink()
-        except (OSError, FileNotFoundError) as e:
-            log.warning(e)
-        raise EncoderException(err)
-    return vtt_path
 
+def encode(source, dest, dryRun=False, threads=None):
+    probe_result = checkVideoEncoding(source)
+
+    if not SINGLE_PASS_ENCODE:
+        _handleSubtitles(source, dest, probe_result)
+        _reencodeVideo(source, dest, probe_result, dryRun=dryRun, threads=threads)
+        return
+
+    count = _handleSubtitles(source, dest, probe_result, extractEmbedded=False)
+    subtitle_outputs = _subtitleOutputs(source, dest, probe_result, count)
+    _reencodeVideo(
+        source,
+        dest,
+        probe_result,
+        dryRun=dryRun,
+        threads=threads,
+        subtitle_outputs=[(x[0], x[1]) for x in subtitle_outputs],
+    )
 
-def encode(source, dest, dryRun=False):
-    vres, ares, sres, surround = checkVideoEncoding(source)
+    if not dryRun:
+        for _, srt_path, dest_path in subtitle_outputs:
+            vtt_path = _convertSrtToVtt(srt_path)
+            _moveSubtitleFile(vtt_path, dest_path)
 
-    _handleSubtitles(source, dest, sres)
-    _reencodeVideo(source, dest, vres, ares, surround, dryRun=dryRun)
 
+def _subtitleOutputs(source, dest, probe_result, count):
+    """Plan the subtitle sidecars written alongside the video in one pass.
 
-def _handleSubtitles(source, dest, sres):
+    Returns (stream_identifier, srt_path, dest_path) tuples. The srt files are
+    written next to dest so they cannot be mistaken for sidecar subtitles in
+    the source directory.
+    """
     dirname = Path(source).parent
-    english_subtitle_paths = dirname.glob("*[eE][nN][gG]*.srt")
+    outputs = []
+    for stream in probe_result.english_subtitle_streams if probe_result else []:
+        outputs.append(
+            (
+                stream.identifier,
+                dest.parent / f"{dest.name}-{count}.srt",
+                dirname / f"{dest.name}.{MEDIAVIEWER_SUFFIX}-{count}.vtt",
+            )
+        )
+        count += 1
+    return outputs
 
-    file_srt_paths = dirname.glob("*.srt")
 
+def _handleSubtitles(source, dest, probe_result, extractEmbedded=True):
+    dirname = Path(source).parent
     count = 0
+    # Sidecar subtitles are shared by every file in the directory so only one
+    # encode at a time may claim them.
+    with _directoryLock(dirname):
+        english_subtitle_paths = dirname.glob("*[eE][nN][gG]*.srt")
 
-    for srt_path in english_subtitle_paths:
-        log.info(f"{srt_path.name} found in directory. Attempting to convert.")
-        dest_path = dirname / f"{dest.name}.{MEDIAVIEWER_SUFFIX}-{count}.vtt"
-        vtt_path = _convertSrtToVtt(srt_path)
-        _moveSubtitleFile(vtt_path, dest_path)
+        file_srt_paths = dirname.glob("*.srt")
 
-        count += 1
-
-    for file_srt_path in file_srt_paths:
-        log.info(f"{file_srt_path} found in directory. Looking for {source.stem}")
-        if source.stem in str(file_srt_path):
-            log.info(f"{file_srt_path} found in directory. Attempting to convert.")
+        for srt_path in english_subtitle_paths:
+            log.info(f"{srt_path.name} found in directory. Attempting to convert.")
             dest_path = dirname / f"{dest.name}.{MEDIAVIEWER_SUFFIX}-{count}.vtt"
-            vtt_path = _convertSrtToVtt(file_srt_path)
+            vtt_path = _convertSrtToVtt(srt_path)
             _moveSubtitleFile(vtt_path, dest_path)
+
             count += 1
 
-    if sres:
+        for file_srt_path in file_srt_paths:
+            log.info(f"{file_srt_path} found in directory. Looking for {source.stem}")
+            if source.stem in str(file_srt_path):
+                log.info(f"{file_srt_path} found in directory. Attempting to convert.")
+                dest_path = dirname / f"{dest.name}.{MEDIAVIEWER_SUFFIX}-{count}.vtt"
+                vtt_path = _convertSrtToVtt(file_srt_path)
+                _moveSubtitleFile(vtt_path, dest_path)
+                count += 1
+
+    if not extractEmbedded:
+        return count
+
+    subtitle_streams = probe_result.english_subtitle_streams if probe_result else []
+    for stream in subtitle_streams:
         log.info("Found subtitles stream. Attempting to extract")
-        sres = sres.groups()
-        stream_identifier = f"{sres[0]}:{sres[1]}"
         dest_path = dirname / f"{dest.name}.{MEDIAVIEWER_SUFFIX}-{count}.vtt"
         _extractSubtitles(
             source,
             dest_path,
-            stream_identifier,
+            stream.identifier,
         )
+        count += 1
+    return count
+
+
+def _reencodeVideo(
+    source,
+    dest,
+    probe_result,
+    dryRun=False,
+    threads=None,
+    subtitle_outputs=(),
+    progress_callback=None,
+):
+    video = probe_result.video_stream
+    audio = probe_result.audio_stream
+
+    copy_video = probe_result.can_copy_video
+    copy_audio = probe_result.can_copy_audio
+
+    audio_args = []
+    if copy_audio:
+        audio_args = ["-c:a", "copy"]
+    elif audio:
+        audio_args = ["-c:a", "libfdk_aac"]
 
+        if audio.is_surround:
+            audio_args.extend(["-ac", "2"])
+
+    video_args = []
+    if not copy_video:
+        profile = select_profile(SourceProperties.from_probe(probe_result, source))
+        video_args = profile.video_args()
+        threads = profile.threads or threads
+
+    if _useChunkedEncode(probe_result):
+        return _encodeChunked(
+            source,
+            dest,
+            probe_result,
+            audio_args,
+            video_args=video_args,
+            dryRun=dryRun,
+            threads=threads,
+            subtitle_outputs=subtitle_outputs,
+        )
 
-def _reencodeVideo(source, dest, vres, ares, surround, dryRun=False):
     command = [
         ENCODER,
         "-hide_banner",
         "-y",
+        "-nostats",
+        "-progress",
+        "pipe:1",
+        "-stats_period",
+        str(ENCODE_PROGRESS_INTERVAL),
         "-i",
         str(source),
     ]
 
-    if vres and (ares and not surround):
+    if video:
+        command.extend(["-map", video.identifier])
+    if audio:
+        command.extend(["-map", audio.identifier])
+
+    if copy_video and (copy_audio or not audio):
         command.extend(
             [
                 "-c",
                 "copy",
             ]
         )
-    elif vres:
-        command.extend(
-            [
-                "-c:v",
-                "copy",
-                "-c:a",
-                "libfdk_aac",
-            ]
-        )
-
-        if surround:
-            command.extend(["-ac", "2"])
-    elif ares:
-        command.extend(
-            [
-                "-c:v",
-                "libx264",
-            ]
-        )
-
-        if surround:
-            command.extend(["-c:a", "libfdk_aac", "-ac", "2"])
-        else:
-            command.extend(
-                [
-                    "-c:a",
-                    "copy",
-                ]
-            )
     else:
         command.extend(
             [
                 "-c:v",
-                "libx264",
-                "-c:a",
-                "libfdk_aac",
+                copy_video and "copy" or "libx264",
             ]
         )
+        command.extend(video_args)
+        command.extend(audio_args)
 
-        if surround:
-            command.extend(["-ac", "2"])
+    if threads:
+        command.extend(["-threads", str(threads)])
 
     command.extend(["-pix_fmt", "yuv420p", "-movflags", "faststart"])
     command.append(str(dest))
+
+    # Extra outputs let ffmpeg write the subtitles during the same read of the
+    # source instead of demuxing it a second time.
+    for stream_identifier, srt_path in subtitle_outputs:
+        command.extend(["-map", stream_identifier, "-c:s", "srt", str(srt_path)])
     command = tuple(command)
 
     log.info(command)
     if not dryRun:
-        process = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)  # nosec
-        process.communicate()
+        if progress_callback is None:
+            progress_callback = progress_logger(
+                Path(source).name, probe_result.duration
+            )
 
-        if process.returncode != 0:
-            if dest.exists():
-                dest.unlink()
+        returncode, stderr_tail = _runEncoder(command, progress_callback)
+
+        if returncode != 0:
+            log.error(stderr_tail)
+            for path in [dest] + [Path(x[1]) for x in subtitle_outputs]:
+                if path.exists():
+                    path.unlink()
             raise EncoderException("Encoding failed")
 
 
+def _runEncoder(command, progress_callback=None):
+    """Run an ffmpeg command started with -progress pipe:1.
+
+    Progress is parsed from stdout as it arrives while stderr is drained on
+    a separate thread, keeping only its tail for error reporting.
+    """
+    process = Popen(command, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)  # nosec
+
+    stderr_tail = OutputTail(ENCODE_STDERR_TAIL_BYTES)
+    stderr_thread = threading.Thread(
+        target=stderr_tail.drain, args=(process.stderr,), daemon=True
+    )
+    stderr_thread.start()
+
+    for progress in parse_progress(process.stdout):
+        if progress_callback:
+            progress_callback(progress)
+
+    stderr_thread.join()
+    process.wait()
+    return process.returncode, stderr_tail.text()
+
+
+def _useChunkedEncode(probe_result):
+    return bool(
+        CHUNKED_ENCODE_MIN_DURATION > 0
+        and probe_result.video_stream
+        and not probe_result.can_copy_video
+        and (probe_result.duration or 0) >= CHUNKED_ENCODE_MIN_DURATION
+    )
+
+
+def _runEncoderOrFail(command):
+    log.info(command)
+    returncode, stderr_tail = _runEncoder(command)
+
+    if returncode != 0:
+        log.error(stderr_tail)
+        raise EncoderException("Encoding failed")
+
+
+def _encodeChunked(
+    source,
+    dest,
+    probe_result,
+    audio_args,
+    video_args=(),
+    dryRun=False,
+    threads=None,
+    subtitle_outputs=(),
+):
+    """Transcode the video in keyframe-aligned segments on several workers.
+
+    The video stream is split at keyframes with a stream copy, each segment
+    is encoded by its own ffmpeg process and the results are joined with the
+    concat demuxer. Audio and subtitles are written by a single extra pass
+    over the source that runs alongside the segment encodes.
+    """
+    work_dir = Path(dest).parent / f"{Path(dest).stem}-chunks"
+    base_command = [ENCODER, "-hide_banner", "-y"]
+
+    split_command = base_command + [
+        "-i",
+        str(source),
+        "-map",
+        probe_result.video_stream.identifier,
+        "-c",
+        "copy",
+        "-f",
+        "segment",
+        "-segment_time",
+        str(CHUNKED_ENCODE_SEGMENT_SECONDS),
+        "-reset_timestamps",
+        "1",
+        str(work_dir / "chunk_%05d.mkv"),
+    ]
+
+    log.info(f"Encoding {source} in chunks")
+    if dryRun:
+        log.info(tuple(split_command))
+        return
+
+    workers = max(1, CHUNKED_ENCODE_WORKERS)
+    chunk_threads = max(1, (threads or os.cpu_count() or 1) // workers)
+
+    work_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        _runEncoderOrFail(tuple(split_command))
+
+        commands = []
+        encoded_chunks = []
+        for chunk in sorted(work_dir.glob("chunk_*.mkv")):
+            encoded_chunk = chunk.with_name(f"encoded_{chunk.name}")
+            encoded_chunks.append(encoded_chunk)
+            commands.append(
+                tuple(
+                    base_command
+                    + ["-i", str(chunk), "-map", "0:v", "-c:v", "libx264"]
+                    + list(video_args)
+                    + ["-threads", str(chunk_threads), "-pix_fmt", "yuv420p"]
+                    + [str(encoded_chunk)]
+                )
+            )
+
+        audio_path = None
+        side_command = base_command + ["-i", str(source)]
+        if audio_args:
+            audio_path = work_dir / "audio.m4a"
+            side_command.extend(
+                ["-map", probe_result.audio_stream.identifier, "-vn"]
+                + audio_args
+                + [str(audio_path)]
+            )
+        for stream_identifier, srt_path in subtitle_outputs:
+            side_command.extend(
+                ["-map", stream_identifier, "-c:s", "srt", str(srt_path)]
+            )
+        if audio_path or subtitle_outputs:
+            commands.insert(0, tuple(side_command))
+
+        failed = False
+        jobs = runEncodeJobs(_runEncoderOrFail, commands, max_parallel=workers + 1)
+        with closing(jobs):
+            for command, _, exc in jobs:
+                if exc is not None:
+                    log.error(f"Chunk command failed: {command}")
+                    failed = True
+        if failed:
+            raise EncoderException("Encoding failed")
+
+        concat_list = work_dir / "chunks.txt"
+        with open(concat_list, "w") as f:
+            for encoded_chunk in encoded_chunks:
+                escaped = str(encoded_chunk).replace("'", "'\\''")
+                f.write(f"file '{escaped}'\n")
+
+        concat_command = base_command + [
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            str(concat_list),
+        ]
+        if audio_path:
+            concat_command.extend(["-i", str(audio_path), "-map", "0:v", "-map", "1:a"])
+        concat_command.extend(["-c", "copy", "-movflags", "faststart", str(dest)])
+        _runEncoderOrFail(tuple(concat_command))
+    except EncoderException:
+        for path in [Path(dest)] + [Path(x[1]) for x in subtitle_outputs]:
+            if path.exists():
+                path.unlink()
+        raise
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
 def _moveSubtitleFile(source, dest, dryRun=False):
     srt_path = source.with_suffix(".srt")
     source_vtt_path = source.with_suffix(".vtt")
@@ -260,7 +504,104 @@ def overwriteExistingFile(source, directory, dryRun=False, appendSuffix=True):
     return dest
 
 
-def makeFileStreamable(filename, dryRun=False, appendSuffix=True, removeOriginal=True):
+def _chooseScratchDirectory(orig):
+    """Pick where to write the encode before it is moved next to orig.
+
+    Writing beside the original keeps the final move a rename on the same
+    filesystem. Candidates are tried in the order given by SCRATCH_STRATEGY
+    and the first with room for roughly another copy of orig is used.
+    Returns None for the system temp directory.
+    """
+    if SCRATCH_STRATEGY == "sibling":
+        candidates = [orig.parent, SCRATCH_DIR and Path(SCRATCH_DIR)]
+    elif SCRATCH_STRATEGY == "dir":
+        candidates = [SCRATCH_DIR and Path(SCRATCH_DIR), orig.parent]
+    elif SCRATCH_STRATEGY == "tmp":
+        return None
+    else:
+        raise ValueError(f"Got invalid scratch strategy {SCRATCH_STRATEGY}")
+
+    required = orig.stat().st_size * SCRATCH_FREE_SPACE_FACTOR
+    for candidate in candidates:
+        if not candidate:
+            continue
+
+        try:
+            free = shutil.disk_usage(candidate).free
+        except OSError as e:
+            log.warning(f"Unable to check free space in {candidate}: {e}")
+            continue
+
+        if free >= required:
+            return candidate
+        log.warning(f"Not enough free space in {candidate} to encode {orig.name}")
+
+    raise EncoderException(f"Not enough free space to encode {orig}")
+
+
+def _lastWritten(path):
+    latest = os.stat(path).st_mtime
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                mtime = os.stat(
+                    os.path.join(root, name), follow_symlinks=False
+                ).st_mtime
+            except OSError:
+                continue
+            latest = max(latest, mtime)
+    return latest
+
+
+def removeStaleScratch(directory, max_age=None, dryRun=False):
+    """Delete scratch directories in directory left behind by killed encodes.
+
+    An encode keeps writing to its scratch directory, so one that nothing
+    has touched for max_age hours belongs to an encode that is gone.
+    Returns the directories removed.
+    """
+    if max_age is None:
+        max_age = SCRATCH_STALE_HOURS
+
+    try:
+        with os.scandir(directory) as entries:
+            candidates = [
+                Path(entry.path)
+                for entry in entries
+                if entry.name.startswith(SCRATCH_PREFIX)
+                and entry.is_dir(follow_symlinks=False)
+            ]
+    except OSError:
+        return []
+
+    removed = []
+    now = time.time()
+    for scratch_dir in candidates:
+        try:
+            if now - _lastWritten(scratch_dir) < max_age * 3600:
+                continue
+        except OSError:
+            continue
+
+        if dryRun:
+            log.debug(f"Would remove stale scratch directory {scratch_dir}")
+        else:
+            log.info(f"Removing stale scratch directory {scratch_dir}")
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+        removed.append(scratch_dir)
+    return removed
+
+
+def removeStaleSharedScratch(dryRun=False):
+    """Clean the scratch locations that aren't beside any original."""
+    for directory in (SCRATCH_DIR, tempfile.gettempdir()):
+        if directory:
+            removeStaleScratch(directory, dryRun=dryRun)
+
+
+def makeFileStreamable(
+    filename, dryRun=False, appendSuffix=True, removeOriginal=True, threads=None
+):
     if MEDIAVIEWER_SUFFIX in str(filename):
         raise AlreadyEncoded("File appears to already have been encoded.")
 
@@ -269,18 +610,29 @@ def makeFileStreamable(filename, dryRun=False, appendSuffix=True, removeOriginal
     if not is_valid_media_file(filename) or not orig.exists():
         raise SkipProcessing(f"{filename} is not a valid media file.")
 
-    new = Path("/tmp") / orig.with_suffix(".mp4").name
-
-    log.info(f"Begin re-encoding of {orig}...")
-    encode(orig, new, dryRun=dryRun)
-    log.info("Finished encoding")
+    if any(part.startswith(SCRATCH_PREFIX) for part in orig.parts):
+        raise SkipProcessing(f"{filename} is a partial encode.")
 
-    dest = overwriteExistingFile(
-        new,
-        orig.parent,
-        dryRun=dryRun,
-        appendSuffix=appendSuffix,
+    # Each job gets its own hidden scratch directory so concurrent encodes of
+    # files with the same name never collide.
+    scratch_dir = Path(
+        tempfile.mkdtemp(prefix=SCRATCH_PREFIX, dir=_chooseScratchDirectory(orig))
     )
+    new = scratch_dir / orig.with_suffix(".mp4").name
+
+    try:
+        log.info(f"Begin re-encoding of {orig}...")
+        encode(orig, new, dryRun=dryRun, threads=threads)
+        log.info("Finished encoding")
+
+        dest = overwriteExistingFile(
+            new,
+            orig.parent,
+            dryRun=dryRun,
+            appendSuffix=appendSuffix,
+        )
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
 
     if not dryRun:
         if removeOriginal and orig.exists():
@@ -290,12 +642,55 @@ def makeFileStreamable(filename, dryRun=False, appendSuffix=True, removeOriginal
     return dest
 
 
-def _getFilesInDirectory(fullPath):
-    command = f"find '{fullPath}' -maxdepth 10 -not -type d"
-    p = Popen(shlex.split(command), stdout=PIPE, stderr=PIPE)  # nosec
-    res = p.communicate()[0]
-    tokens = res.split(b"\n")
-    return set([x for x in tokens if x])
+def encodeThreadBudget(max_parallel=None):
+    if max_parallel is None:
+        max_parallel = MAX_PARALLEL_ENCODES
+    return max(1, (os.cpu_count() or 1) // max(1, max_parallel))
+
+
+def runEncodeJobs(func, items, max_parallel=None):
+    """Run func over items using at most max_parallel workers.
+
+    Yields (item, result, exception) tuples in the order the items were
+    given, regardless of the order the jobs finish in. Jobs that have not
+    started yet are cancelled if the caller stops iterating early.
+    """
+    if max_parallel is None:
+        max_parallel = MAX_PARALLEL_ENCODES
+
+    items = list(items)
+
+    if max_parallel <= 1 or len(items) <= 1:
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    executor = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="encode")
+    try:
+        futures = [(item, executor.submit(func, item)) for item in items]
+        for item, future in futures:
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _getFilesInDirectory(fullPath, stability=None):
+    if stability is None:
+        stability = StabilityGate()
+
+    try:
+        return set(
+            entry.path
+            for entry in scan_files(fullPath, max_depth=10, stability=stability)
+        )
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
 
 
 def reencodeFilesInDirectory(fullPath, dryRun=False):
@@ -303,16 +698,42 @@ def reencodeFilesInDirectory(fullPath, dryRun=False):
     cleanedFullPath = stripUnicode(fullPath)
     tokens = _getFilesInDirectory(cleanedFullPath)
 
-    for token in tokens:
-        if is_valid_media_file(token):
-            try:
-                cleanPath = stripUnicode(token)
-                makeFileStreamable(
-                    cleanPath, appendSuffix=True, removeOriginal=True, dryRun=dryRun
-                )
-            except EncoderException as e:
-                log.error(e)
+    cleanPaths = normalize_paths(
+        token for token in tokens if is_valid_media_file(token)
+    )
+
+    # Scratch directories sit beside the original, which is only removed once
+    # its encode succeeds, so a killed encode's leftovers are found here
+    for directory in sorted({Path(x).parent for x in cleanPaths}):
+        if not any(part.startswith(SCRATCH_PREFIX) for part in directory.parts):
+            removeStaleScratch(directory, dryRun=dryRun)
+
+    # Cheapest first, like the tv encode queue's default policy, so one long
+    # transcode doesn't hold up everything else in the directory
+    estimates = {x: estimate_cost(x) for x in cleanPaths}
+    cleanPaths = sorted(
+        cleanPaths,
+        key=lambda x: (estimates[x] is None, estimates[x] or 0, str(x)),
+    )
+
+    threads = encodeThreadBudget()
+    jobs = runEncodeJobs(
+        lambda cleanPath: makeFileStreamable(
+            cleanPath,
+            appendSuffix=True,
+            removeOriginal=True,
+            dryRun=dryRun,
+            threads=threads,
+        ),
+        cleanPaths,
+    )
+    with closing(jobs):
+        for cleanPath, _, exc in jobs:
+            if isinstance(exc, EncoderException):
+                log.error(exc)
                 errors.append(cleanPath)
-            except (AlreadyEncoded, SkipProcessing) as e:
-                log.warning(e)
+            elif isinstance(exc, (AlreadyEncoded, SkipProcessing)):
+                log.warning(exc)
+            elif exc is not None:
+                raise exc
     return errors
@@ -0,0 +1,208 @@
+import json
+import time
+import threading
+import logging
+
+import requests
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from settings import (
+    HTTP_CACHE_ENABLED,
+    HTTP_CACHE_MAX_ENTRIES,
+    HTTP_CACHE_TTL,
+)
+from state import connect
+
+log = logging.getLogger(__name__)
+
+# Response headers kept alongside a cached body
+CACHED_HEADERS = ("Content-Type", "ETag", "Last-Modified")
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    url: str
+    body: bytes
+    etag: str | None = None
+    last_modified: str | None = None
+    headers: dict = field(default_factory=dict)
+    stored_at: float = 0.0
+
+    def validators(self):
+        """Headers asking the server to reply 304 if the body is unchanged."""
+        headers = dict()
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def to_response(self, not_modified=None):
+        """Build a 200 response carrying the cached body.
+
+        Headers from the 304 the server sent, if given, take precedence over
+        the stored ones.
+        """
+        response = requests.Response()
+        response.status_code = 200
+        response.url = self.url
+        response.headers = CaseInsensitiveDict(self.headers)
+        if not_modified is not None:
+            response.headers.update(not_modified.headers)
+            response.request = not_modified.request
+            response.elapsed = not_modified.elapsed
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = self.body
+        return response
+
+
+class HttpCache:
+    """On-disk cache of GET responses that is revalidated on every use.
+
+    Only responses carrying an ETag or Last-Modified header are stored.
+    Cached bodies are never served blind. Each request for a cached URL
+    sends the stored validators, and the body is only reused when the
+    server answers 304 Not Modified, so callers never see stale data.
+    Entries not revalidated for ttl hours are dropped. The least recently
+    used entries are evicted once the table grows past max_entries.
+    """
+
+    DB_NAME = "http_cache"
+
+    def __init__(self, max_entries=None, ttl=None):
+        self.max_entries = (
+            HTTP_CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        )
+        self.ttl = HTTP_CACHE_TTL if ttl is None else ttl
+
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self):
+        with connect(self.DB_NAME) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "url TEXT PRIMARY KEY, "
+                "etag TEXT, "
+                "last_modified TEXT, "
+                "headers TEXT NOT NULL, "
+                "body BLOB NOT NULL, "
+                "stored_at REAL NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            yield conn
+
+    def get(self, url):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT etag, last_modified, headers, body, stored_at "
+                "FROM responses WHERE url=?",
+                (url,),
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            if time.time() - row[4] > self.ttl * 3600:
+                conn.execute("DELETE FROM responses WHERE url=?", (url,))
+                return None
+
+            conn.execute(
+                "UPDATE responses SET last_used=? WHERE url=?", (time.time(), url)
+            )
+
+        return CachedResponse(
+            url=url,
+            etag=row[0],
+            last_modified=row[1],
+            headers=json.loads(row[2]),
+            body=row[3],
+            stored_at=row[4],
+        )
+
+    def not_modified(self, entry, response):
+        """Turn a 304 for entry into a full response and note the hit."""
+        with self._lock:
+            self.hits += 1
+
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE responses SET stored_at=? WHERE url=?",
+                (time.time(), entry.url),
+            )
+        log.debug(f"{entry.url} not modified, using cached response")
+        return entry.to_response(not_modified=response)
+
+    def store(self, url, response):
+        """Remember a full response for url and note the miss."""
+        with self._lock:
+            self.misses += 1
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code != 200 or not (etag or last_modified):
+            self.invalidate(url)
+            return
+
+        headers = {
+            key: response.headers[key]
+            for key in CACHED_HEADERS
+            if key in response.headers
+        }
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(url, etag, last_modified, headers, body, stored_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    etag,
+                    last_modified,
+                    json.dumps(headers),
+                    response.content,
+                    now,
+                    now,
+                ),
+            )
+            self._evict(conn)
+
+    def invalidate(self, url):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses WHERE url=?", (url,))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _evict(self, conn):
+        conn.execute(
+            "DELETE FROM responses WHERE rowid NOT IN "
+            "(SELECT rowid FROM responses ORDER BY last_used DESC, rowid DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+
+_http_cache = None
+
+
+def get_http_cache():
+    global _http_cache
+
+    if not HTTP_CACHE_ENABLED:
+        return None
+
+    if _http_cache is None:
+        _http_cache = HttpCache()
+    return _http_cache
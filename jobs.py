@@ -0,0 +1,282 @@
+import os
+import time
+import socket
+import sqlite3
+import logging
+import threading
+
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from settings import ENCODE_QUEUE_POLICY, ENCODE_JOB_LEASE_SECONDS
+from probe import probe, get_probe_cache
+from state import connect
+from utils import EncoderException
+
+log = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+FAILED = "failed"
+
+# Remuxing a file that is already streamable costs a small fraction of a
+# full transcode of the same length
+REMUX_COST_FACTOR = 0.02
+REFERENCE_HEIGHT = 1080
+
+POLICIES = {
+    "shortest_first": "estimate IS NULL, estimate, size, id",
+    "newest_first": "mtime DESC, id",
+    "fifo": "id",
+}
+
+
+def estimate_cost(source):
+    """Rough relative cost of encoding source, or None if it can't be probed.
+
+    Transcodes are weighted by running time and frame size. Files whose video
+    can be copied only need a remux and are cheap regardless of length.
+    """
+    try:
+        probe_result = probe(source, cache=get_probe_cache())
+    except EncoderException as e:
+        log.warning(f"Unable to estimate encode cost for {source}: {e}")
+        return None
+
+    if probe_result.duration is None:
+        return None
+
+    if probe_result.can_copy_video:
+        return probe_result.duration * REMUX_COST_FACTOR
+
+    video = probe_result.video_stream
+    height = (video and video.height) or REFERENCE_HEIGHT
+    return probe_result.duration * height / REFERENCE_HEIGHT
+
+
+@dataclass(frozen=True)
+class EncodeJob:
+    id: int
+    path: Path
+    media_path_id: int | None = None
+    show: str | None = None
+    estimate: float | None = None
+    size: int | None = None
+    mtime: float | None = None
+    status: str = PENDING
+    error: str | None = None
+    owner: str | None = None
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            id=row["id"],
+            path=Path(row["path"]),
+            media_path_id=row["media_path_id"],
+            show=row["show"],
+            estimate=row["estimate"],
+            size=row["size"],
+            mtime=row["mtime"],
+            status=row["status"],
+            error=row["error"],
+            owner=row["owner"],
+        )
+
+
+class JobQueue:
+    """Durable queue of files waiting to be made streamable.
+
+    Jobs survive restarts in a sqlite database under STATE_DIR. Completed
+    jobs are removed and failed ones are kept until the file is enqueued
+    again. Claimed jobs are leased to owner, and a background thread renews
+    the lease until they are completed or failed. Running jobs whose lease
+    has run out were left by a process that died and are picked up by the
+    next drain, whichever process it runs in.
+    """
+
+    DB_NAME = "encode_queue"
+
+    def __init__(self, policy=None, owner=None, lease=None):
+        policy = policy or ENCODE_QUEUE_POLICY
+        if policy not in POLICIES:
+            raise ValueError(f"Invalid encode queue policy: {policy}")
+        self.policy = policy
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease = ENCODE_JOB_LEASE_SECONDS if lease is None else lease
+
+        self._held = set()
+        self._held_lock = threading.Lock()
+        self._renewer = None
+
+    @contextmanager
+    def _connect(self):
+        with connect(self.DB_NAME) as conn:
+            conn.row_factory = sqlite3.Row
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "path TEXT NOT NULL UNIQUE, "
+                "media_path_id INTEGER, "
+                "show TEXT, "
+                "estimate REAL, "
+                "size INTEGER, "
+                "mtime REAL, "
+                "status TEXT NOT NULL, "
+                "error TEXT, "
+                "owner TEXT, "
+                "heartbeat REAL, "
+                "enqueued_at REAL NOT NULL)"
+            )
+            yield conn
+
+    def enqueue(self, path, media_path_id=None, show=None, estimate=None):
+        path = Path(path)
+        try:
+            stat = os.stat(path)
+            size, mtime = stat.st_size, stat.st_mtime
+        except OSError:
+            size, mtime = None, None
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs "
+                "(path, media_path_id, show, estimate, size, mtime, "
+                "status, enqueued_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET "
+                "media_path_id=excluded.media_path_id, "
+                "show=excluded.show, "
+                "estimate=excluded.estimate, "
+                "size=excluded.size, "
+                "mtime=excluded.mtime, "
+                "status=excluded.status, "
+                "error=NULL "
+                "WHERE jobs.status != ?",
+                (
+                    str(path),
+                    media_path_id,
+                    None if show is None else str(show),
+                    estimate,
+                    size,
+                    mtime,
+                    PENDING,
+                    time.time(),
+                    RUNNING,
+                ),
+            )
+        log.debug(f"Queued {path}")
+
+    def claim(self):
+        """Mark the highest priority pending job as running and return it."""
+        with self._connect() as conn:
+            row = conn.execute(
+                f"UPDATE jobs SET status=?, owner=?, heartbeat=? WHERE id = ("
+                f"SELECT id FROM jobs WHERE status=? "
+                f"ORDER BY {POLICIES[self.policy]} LIMIT 1) "
+                f"RETURNING *",  # nosec
+                (RUNNING, self.owner, time.time(), PENDING),
+            ).fetchone()
+        if row is None:
+            return None
+
+        job = EncodeJob.from_row(row)
+        self._hold(job)
+        return job
+
+    def drain(self):
+        """Yield jobs in priority order until none are pending."""
+        self.recover()
+        while True:
+            job = self.claim()
+            if job is None:
+                return
+            yield job
+
+    def complete(self, job):
+        self._release(job)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM jobs WHERE id=?", (job.id,))
+
+    def fail(self, job, error=None):
+        self._release(job)
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status=?, error=?, owner=NULL WHERE id=?",
+                (FAILED, None if error is None else str(error), job.id),
+            )
+
+    def _hold(self, job):
+        with self._held_lock:
+            self._held.add(job.id)
+            if self._renewer is None:
+                self._renewer = threading.Thread(
+                    target=self._renew_leases, name="lease", daemon=True
+                )
+                self._renewer.start()
+
+    def _release(self, job):
+        with self._held_lock:
+            self._held.discard(job.id)
+
+    def _renew_leases(self):
+        while True:
+            time.sleep(self.lease / 3)
+            with self._held_lock:
+                held = list(self._held)
+                if not held:
+                    self._renewer = None
+                    return
+            self.renew(held)
+
+    def renew(self, job_ids):
+        """Extend the lease on job_ids if they are still owned by this queue."""
+        try:
+            with self._connect() as conn:
+                conn.executemany(
+                    "UPDATE jobs SET heartbeat=? "
+                    "WHERE id=? AND status=? AND owner=?",
+                    [(time.time(), x, RUNNING, self.owner) for x in job_ids],
+                )
+        except sqlite3.Error as e:
+            # The lease has some slack, try again next time
+            log.warning(f"Unable to renew encode job leases: {e}")
+
+    def abandon(self):
+        """Return the jobs this queue still holds to the pending queue."""
+        with self._held_lock:
+            held = list(self._held)
+            self._held.clear()
+
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE jobs SET status=?, owner=NULL "
+                "WHERE id=? AND status=? AND owner=?",
+                [(PENDING, x, RUNNING, self.owner) for x in held],
+            )
+
+    def recover(self):
+        """Return jobs left running by a process that died to the queue."""
+        with self._connect() as conn:
+            count = conn.execute(
+                "UPDATE jobs SET status=?, owner=NULL "
+                "WHERE status=? AND (heartbeat IS NULL OR heartbeat < ?)",
+                (PENDING, RUNNING, time.time() - self.lease),
+            ).rowcount
+        if count:
+            log.warning(f"Requeued {count} interrupted encode jobs")
+
+    def jobs(self, status=PENDING):
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM jobs WHERE status=? "
+                f"ORDER BY {POLICIES[self.policy]}",  # nosec
+                (status,),
+            ).fetchall()
+        return [EncodeJob.from_row(row) for row in rows]
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status=?", (PENDING,)
+            ).fetchone()[0]
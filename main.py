@@ -8,6 +8,7 @@ from settings import (
     CELERY_VHOST,
 )
 from utils import send_email
+from http_cache import get_http_cache
 from celery import Celery
 
 log = logging.getLogger(__name__)
@@ -17,6 +18,10 @@ app = Celery("tasks", broker=f"{os.environ['BROKER']}/{CELERY_VHOST}")
 
 @app.task(name="main.main", serializer="json")
 def main():
+    # The cache lives as long as the worker, only report this run's share
+    cache = get_http_cache()
+    cache_stats = (cache.hits, cache.misses) if cache is not None else None
+
     all_errors = []
     tvRunner = TvRunner()
     tv_errors = tvRunner.run()
@@ -37,6 +42,10 @@ def main():
             message = "\n".join(all_errors)
             send_email(subject, message)
 
+    if cache is not None:
+        hits, misses = cache.hits - cache_stats[0], cache.misses - cache_stats[1]
+        log.info(f"HTTP cache: {hits} hits, {misses} misses")
+
     log.info("All done")
 
 
@@ -5,9 +5,12 @@ from settings import (
     SUBTITLE_FILES,
     DOMAIN,
     BASE_PATH,
+    CATALOG_SYNC_ENABLED,
 )
-from convert import reencodeFilesInDirectory
-from utils import get_data, put_data
+from catalog import RemoteCatalog
+from convert import reencodeFilesInDirectory, removeStaleSharedScratch
+from scanner import scan_files, StabilityGate
+from utils import get_data, get_all_pages, put_data, flush_infer_scrapers
 from tv_runner import MediaPathMixin
 
 import logging
@@ -45,30 +48,34 @@ class Movie(MediaPathMixin):
     def MEDIAVIEWER_MEDIAPATH_URL(cls):
         return DOMAIN + "/mediaviewer/api/moviemediapath/"
 
+    @staticmethod
+    def _media_paths(result):
+        media_path = result["media_path"]
+
+        if BASE_PATH not in media_path:
+            local_path = Path(BASE_PATH) / media_path["path"]
+        else:
+            local_path = Path(media_path["path"])
+        yield local_path, media_path["pk"], result["finished"]
+
     @classmethod
-    def get_all_movies(cls):
-        paths = dict()
+    def get_all_movies(cls, full_sync=False):
+        if CATALOG_SYNC_ENABLED:
+            catalog = RemoteCatalog(
+                "movie", cls.MEDIAVIEWER_MOVIE_URL, cls._media_paths
+            )
+            return catalog.sync(full=full_sync)
 
-        data = {"next": cls.MEDIAVIEWER_MOVIE_URL}
-        while data["next"]:
-            request = get_data(data["next"])
-            request.raise_for_status()
-            data = request.json()
+        paths = dict()
 
+        for data in get_all_pages(cls.MEDIAVIEWER_MOVIE_URL):
             if data["results"]:
                 for result in data["results"]:
-                    media_path = result["media_path"]
-
-                    if BASE_PATH not in media_path:
-                        local_path = Path(BASE_PATH) / media_path["path"]
-                    else:
-                        local_path = Path(media_path["path"])
-
-                    val = paths.setdefault(
-                        local_path, {"pks": set(), "finished": result["finished"]}
-                    )
-                    val["pks"].add(media_path["pk"])
-                    paths[local_path] = val
+                    for local_path, pk, finished in cls._media_paths(result):
+                        val = paths.setdefault(
+                            local_path, {"pks": set(), "finished": finished}
+                        )
+                        val["pks"].add(pk)
         return paths
 
 
@@ -76,6 +83,8 @@ class MovieRunner:
     def __init__(self):
         self.movies = set()
         self.errors = []
+        # Movie directories holding files that are still being written
+        self.deferred = set()
 
     def postMovies(self, dry_run=False):
         base_path = Path(BASE_PATH)
@@ -93,27 +102,48 @@ class MovieRunner:
             for token in tokens:
                 localpath = moviepath / token
                 if localpath not in remote_paths:
-                    log.info(f"Found {localpath}")
-                    log.info(f"Starting re-encoding of {localpath}...")
-                    try:
-                        self.promoteSubtitles(localpath, dry_run=dry_run)
-                        if dry_run:
-                            log.debug(f"Would re-encode files in {localpath}")
-                        else:
-                            errors = reencodeFilesInDirectory(localpath)
-
-                        if errors:
-                            self.errors.extend(errors)
-                            continue
-                    except Exception as e:
-                        log.error(f"Error processing {localpath}")
-                        log.error(str(e))
-                        raise
-                    log.info(f"Posting {localpath}")
-                    if dry_run:
-                        log.debug(f"Would post path for {localpath}")
-                    else:
-                        Movie.post_media_path(localpath)
+                    self.postMovie(localpath, dry_run=dry_run)
+
+    def postMovie(self, localpath, dry_run=False):
+        errors = []
+        log.info(f"Found {localpath}")
+
+        self.deferred.discard(localpath)
+        if not self.isSettled(localpath):
+            log.info(f"Waiting for {localpath} to finish downloading")
+            self.deferred.add(localpath)
+            return
+
+        log.info(f"Starting re-encoding of {localpath}...")
+        try:
+            self.promoteSubtitles(localpath, dry_run=dry_run)
+            if dry_run:
+                log.debug(f"Would re-encode files in {localpath}")
+            else:
+                errors = reencodeFilesInDirectory(localpath)
+
+            if errors:
+                self.errors.extend(errors)
+                return
+        except Exception as e:
+            log.error(f"Error processing {localpath}")
+            log.error(str(e))
+            raise
+        log.info(f"Posting {localpath}")
+        if dry_run:
+            log.debug(f"Would post path for {localpath}")
+        else:
+            Movie.post_media_path(localpath)
+
+    @staticmethod
+    def isSettled(localpath):
+        stability = StabilityGate()
+        try:
+            for _ in scan_files(localpath, max_depth=10, stability=stability):
+                pass
+        except (FileNotFoundError, NotADirectoryError):
+            pass
+        return not stability.deferred
 
     @staticmethod
     def promoteSubtitles(localpath, dry_run=False):
@@ -141,6 +171,10 @@ class MovieRunner:
         return set(os.listdir(moviepath))
 
     def run(self, dry_run=False):
-        self.postMovies(dry_run=dry_run)
+        try:
+            removeStaleSharedScratch(dryRun=dry_run)
+            self.postMovies(dry_run=dry_run)
+        finally:
+            flush_infer_scrapers()
         log.info("Done running movies")
         return self.errors
@@ -0,0 +1,390 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from subprocess import Popen, PIPE  # nosec
+
+from settings import (
+    FFPROBE,
+    PROBE_CACHE_ENABLED,
+    PROBE_CACHE_MAX_ENTRIES,
+)
+from state import connect
+from utils import EncoderException
+
+log = logging.getLogger(__name__)
+
+STREAMABLE_VIDEO_CODECS = ("h264",)
+STREAMABLE_PIX_FMTS = ("yuv420p", "yuvj420p")
+UNSTREAMABLE_VIDEO_PROFILES = (
+    "High 10",
+    "High 10 Intra",
+    "High 4:2:2",
+    "High 4:2:2 Intra",
+    "High 4:4:4 Predictive",
+    "High 4:4:4 Intra",
+)
+STREAMABLE_AUDIO_CODECS = ("aac",)
+MAX_STREAMABLE_AUDIO_CHANNELS = 2
+TEXT_SUBTITLE_CODECS = ("subrip", "srt", "ass", "ssa", "mov_text", "webvtt", "text")
+ENGLISH_LANGUAGES = ("eng", "en")
+# Audio tracks that accompany the main mix rather than replace it
+ALTERNATE_AUDIO_DISPOSITIONS = ("comment", "hearing_impaired", "visual_impaired")
+ALTERNATE_AUDIO_TITLE_WORDS = ("commentary", "description", "descriptive")
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class Stream:
+    index: int
+    codec_type: str
+    codec_name: str | None = None
+    profile: str | None = None
+    pix_fmt: str | None = None
+    channels: int | None = None
+    language: str | None = None
+    width: int | None = None
+    height: int | None = None
+    bit_rate: int | None = None
+    title: str | None = None
+    disposition: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_ffprobe(cls, data):
+        tags = data.get("tags") or {}
+        return cls(
+            index=int(data["index"]),
+            codec_type=data.get("codec_type", ""),
+            codec_name=data.get("codec_name"),
+            profile=data.get("profile"),
+            pix_fmt=data.get("pix_fmt"),
+            channels=_to_int(data.get("channels")),
+            language=(tags.get("language") or "").lower() or None,
+            width=_to_int(data.get("width")),
+            height=_to_int(data.get("height")),
+            bit_rate=_to_int(data.get("bit_rate")),
+            title=tags.get("title") or None,
+            disposition={
+                key: bool(val) for key, val in (data.get("disposition") or {}).items()
+            },
+        )
+
+    @property
+    def identifier(self):
+        return f"0:{self.index}"
+
+    @property
+    def is_default(self):
+        return self.disposition.get("default", False)
+
+    @property
+    def is_english(self):
+        return self.language in ENGLISH_LANGUAGES
+
+    @property
+    def is_attached_pic(self):
+        return self.disposition.get("attached_pic", False)
+
+    @property
+    def is_alternate_audio(self):
+        """Commentary, audio description and other secondary tracks."""
+        if any(self.disposition.get(x, False) for x in ALTERNATE_AUDIO_DISPOSITIONS):
+            return True
+        title = (self.title or "").lower()
+        return any(word in title for word in ALTERNATE_AUDIO_TITLE_WORDS)
+
+    @property
+    def is_text_subtitle(self):
+        return self.codec_type == "subtitle" and self.codec_name in TEXT_SUBTITLE_CODECS
+
+    @property
+    def is_surround(self):
+        return (self.channels or 0) > MAX_STREAMABLE_AUDIO_CHANNELS
+
+    @property
+    def can_copy_video(self):
+        return (
+            self.codec_type == "video"
+            and self.codec_name in STREAMABLE_VIDEO_CODECS
+            and self.pix_fmt in STREAMABLE_PIX_FMTS
+            and self.profile not in UNSTREAMABLE_VIDEO_PROFILES
+        )
+
+    @property
+    def can_copy_audio(self):
+        return (
+            self.codec_type == "audio"
+            and self.codec_name in STREAMABLE_AUDIO_CODECS
+            and not self.is_surround
+        )
+
+
+@dataclass(frozen=True)
+class ProbeResult:
+    streams: tuple = ()
+    format_name: str | None = None
+    duration: float | None = None
+    bit_rate: int | None = None
+    size: int | None = None
+    tags: dict = field(default_factory=dict)
+
+    @classmethod
+    def from_ffprobe(cls, data):
+        fmt = data.get("format") or {}
+        return cls(
+            streams=tuple(Stream.from_ffprobe(x) for x in data.get("streams") or []),
+            format_name=fmt.get("format_name"),
+            duration=_to_float(fmt.get("duration")),
+            bit_rate=_to_int(fmt.get("bit_rate")),
+            size=_to_int(fmt.get("size")),
+            tags={
+                key.lower(): str(val) for key, val in (fmt.get("tags") or {}).items()
+            },
+        )
+
+    @property
+    def video_streams(self):
+        return [
+            x for x in self.streams if x.codec_type == "video" and not x.is_attached_pic
+        ]
+
+    @property
+    def audio_streams(self):
+        return [x for x in self.streams if x.codec_type == "audio"]
+
+    @property
+    def subtitle_streams(self):
+        return [x for x in self.streams if x.codec_type == "subtitle"]
+
+    @staticmethod
+    def _default_or_first(streams):
+        for stream in streams:
+            if stream.is_default:
+                return stream
+        return streams[0] if streams else None
+
+    @property
+    def video_stream(self):
+        return self._default_or_first(self.video_streams)
+
+    @property
+    def audio_stream(self):
+        """Audio stream to keep in the output.
+
+        The default track wins unless it needs transcoding and another main
+        mix in the same language can be copied as-is. Commentary and
+        described tracks are never swapped in, the default is transcoded
+        instead. Without a default the first main mix is used.
+        """
+        main_streams = [x for x in self.audio_streams if not x.is_alternate_audio]
+        defaults = [x for x in self.audio_streams if x.is_default]
+        candidates = defaults or main_streams or self.audio_streams
+        primary = candidates[0] if candidates else None
+        if primary is None or primary.can_copy_audio:
+            return primary
+
+        for stream in main_streams:
+            if stream.can_copy_audio and stream.language == primary.language:
+                return stream
+        return primary
+
+    @property
+    def english_subtitle_streams(self):
+        return [x for x in self.subtitle_streams if x.is_english and x.is_text_subtitle]
+
+    @property
+    def can_copy_video(self):
+        stream = self.video_stream
+        return bool(stream and stream.can_copy_video)
+
+    @property
+    def can_copy_audio(self):
+        stream = self.audio_stream
+        return bool(stream and stream.can_copy_audio)
+
+
+class ProbeCache:
+    """On-disk cache of ffprobe output keyed by file identity.
+
+    Entries are looked up by (device, inode) and only trusted while the
+    file's size and mtime_ns still match, so any rewrite of a file
+    invalidates its entry. The least recently used entries are evicted once
+    the table grows past max_entries.
+    """
+
+    DB_NAME = "probe_cache"
+
+    def __init__(self, max_entries=PROBE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+
+    @contextmanager
+    def _connect(self):
+        with connect(self.DB_NAME) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS probes ("
+                "device INTEGER NOT NULL, "
+                "inode INTEGER NOT NULL, "
+                "size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, "
+                "path TEXT NOT NULL, "
+                "data TEXT NOT NULL, "
+                "last_used REAL NOT NULL, "
+                "PRIMARY KEY (device, inode))"
+            )
+            yield conn
+
+    @staticmethod
+    def key(source):
+        stat = os.stat(source)
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get(self, source):
+        device, inode, size, mtime_ns = self.key(source)
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT size, mtime_ns, data FROM probes WHERE device=? AND inode=?",
+                (device, inode),
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            if (row[0], row[1]) != (size, mtime_ns):
+                conn.execute(
+                    "DELETE FROM probes WHERE device=? AND inode=?", (device, inode)
+                )
+                return None
+
+            conn.execute(
+                "UPDATE probes SET last_used=? WHERE device=? AND inode=?",
+                (time.time(), device, inode),
+            )
+        return json.loads(row[2])
+
+    def set(self, source, data):
+        device, inode, size, mtime_ns = self.key(source)
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO probes "
+                "(device, inode, size, mtime_ns, path, data, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    device,
+                    inode,
+                    size,
+                    mtime_ns,
+                    str(source),
+                    json.dumps(data),
+                    time.time(),
+                ),
+            )
+            self._evict(conn)
+
+    def invalidate(self, source):
+        try:
+            device, inode, _, _ = self.key(source)
+        except FileNotFoundError:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM probes WHERE path=?", (str(source),))
+            return
+
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM probes WHERE device=? AND inode=?", (device, inode)
+            )
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM probes")
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM probes").fetchone()[0]
+
+    def _evict(self, conn):
+        conn.execute(
+            "DELETE FROM probes WHERE rowid NOT IN "
+            "(SELECT rowid FROM probes ORDER BY last_used DESC, rowid DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+
+
+_probe_cache = None
+
+
+def get_probe_cache():
+    global _probe_cache
+
+    if not PROBE_CACHE_ENABLED:
+        return None
+
+    if _probe_cache is None:
+        _probe_cache = ProbeCache()
+    return _probe_cache
+
+
+def _run_ffprobe(source):
+    command = (
+        FFPROBE,
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-print_format",
+        "json",
+        "-show_streams",
+        "-show_format",
+        str(source),
+    )
+    process = Popen(command, stdout=PIPE, stderr=PIPE)  # nosec
+    out, err = process.communicate()
+
+    if process.returncode != 0:
+        log.error(err)
+        raise EncoderException(err)
+
+    try:
+        data = json.loads(out)
+    except ValueError as e:
+        log.error(e)
+        raise EncoderException(f"Unable to parse ffprobe output for {source}")
+    return data
+
+
+def probe(source, cache=None):
+    if cache is not None:
+        try:
+            data = cache.get(source)
+        except (OSError, sqlite3.Error) as e:
+            log.warning(f"Unable to read probe cache for {source}: {e}")
+            data = None
+
+        if data is not None:
+            log.debug(f"Using cached probe for {source}")
+            return ProbeResult.from_ffprobe(data)
+
+    data = _run_ffprobe(source)
+
+    if cache is not None:
+        try:
+            cache.set(source, data)
+        except (OSError, sqlite3.Error) as e:
+            log.warning(f"Unable to update probe cache for {source}: {e}")
+
+    return ProbeResult.from_ffprobe(data)
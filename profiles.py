@@ -0,0 +1,129 @@
+import logging
+
+from dataclasses import dataclass, field
+from pathlib import Path
+
+from settings import ENCODING_PROFILES, ANIMATION_KEYWORDS
+
+log = logging.getLogger(__name__)
+
+MATCH_CRITERIA = (
+    "min_height",
+    "max_height",
+    "min_bitrate",
+    "max_bitrate",
+    "min_duration",
+    "max_duration",
+    "animation",
+)
+
+
+@dataclass(frozen=True)
+class SourceProperties:
+    height: int | None = None
+    bitrate: int | None = None
+    duration: float | None = None
+    animation: bool = False
+
+    @classmethod
+    def from_probe(cls, probe_result, source=None):
+        video = probe_result.video_stream
+        return cls(
+            height=video.height if video else None,
+            bitrate=(video and video.bit_rate) or probe_result.bit_rate,
+            duration=probe_result.duration,
+            animation=is_animation(probe_result, source),
+        )
+
+
+def is_animation(probe_result, source=None):
+    """Guess whether a source is animated from its genre tag or its path."""
+    keywords = [x.lower() for x in ANIMATION_KEYWORDS if x]
+
+    genre = probe_result.tags.get("genre", "").lower()
+    if any(keyword in genre for keyword in keywords):
+        return True
+
+    if source is not None:
+        parts = [x.lower() for x in Path(source).parts]
+        return any(keyword in part for part in parts for keyword in keywords)
+    return False
+
+
+@dataclass(frozen=True)
+class EncodingProfile:
+    name: str
+    match: dict = field(default_factory=dict)
+    preset: str | None = None
+    crf: int | None = None
+    tune: str | None = None
+    threads: int | None = None
+    max_height: int | None = None
+    extra_args: tuple = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        unknown = set(data.get("match", {})) - set(MATCH_CRITERIA)
+        if unknown:
+            raise ValueError(
+                f"Got invalid match criteria {sorted(unknown)} for profile "
+                f"{data.get('name')}"
+            )
+
+        return cls(
+            name=data["name"],
+            match=dict(data.get("match", {})),
+            preset=data.get("preset"),
+            crf=data.get("crf"),
+            tune=data.get("tune"),
+            threads=data.get("threads"),
+            max_height=data.get("max_height"),
+            extra_args=tuple(str(x) for x in data.get("extra_args", ())),
+        )
+
+    def matches(self, properties):
+        for criterion, expected in self.match.items():
+            if criterion == "animation":
+                if bool(expected) != properties.animation:
+                    return False
+                continue
+
+            bound, attr = criterion.split("_", 1)
+            value = getattr(properties, attr)
+            if value is None:
+                return False
+            if bound == "min" and value < expected:
+                return False
+            if bound == "max" and value > expected:
+                return False
+        return True
+
+    def video_args(self):
+        args = []
+        if self.preset:
+            args.extend(["-preset", self.preset])
+        if self.crf is not None:
+            args.extend(["-crf", str(self.crf)])
+        if self.tune:
+            args.extend(["-tune", self.tune])
+        if self.max_height:
+            args.extend(["-vf", f"scale=-2:'min({self.max_height},ih)'"])
+        args.extend(self.extra_args)
+        return args
+
+
+DEFAULT_PROFILE = EncodingProfile(name="default")
+
+
+def load_profiles(profiles=None):
+    if profiles is None:
+        profiles = ENCODING_PROFILES
+    return [EncodingProfile.from_dict(x) for x in profiles]
+
+
+def select_profile(properties, profiles=None):
+    for profile in load_profiles(profiles):
+        if profile.matches(properties):
+            log.info(f"Using encoding profile {profile.name}")
+            return profile
+    return DEFAULT_PROFILE
@@ -0,0 +1,142 @@
+import re
+import logging
+import threading
+
+from collections import deque
+from dataclasses import dataclass
+
+log = logging.getLogger(__name__)
+
+TIMESTAMP_REGEX = re.compile(r"^(\d+):(\d{2}):(\d{2}(?:\.\d+)?)$")
+
+
+def _to_number(value, cast=float):
+    if value is None:
+        return None
+
+    value = value.strip().rstrip("x")
+    for unit in ("kbits/s", "kB"):
+        value = value.removesuffix(unit)
+
+    try:
+        return cast(value)
+    except ValueError:
+        return None
+
+
+def _to_seconds(value):
+    if not value:
+        return None
+
+    match = TIMESTAMP_REGEX.match(value.strip())
+    if not match:
+        return None
+
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+@dataclass(frozen=True)
+class EncodeProgress:
+    frame: int | None = None
+    fps: float | None = None
+    bitrate_kbps: float | None = None
+    total_size: int | None = None
+    out_time: float | None = None
+    speed: float | None = None
+    done: bool = False
+
+    @classmethod
+    def from_values(cls, values):
+        out_time = _to_seconds(values.get("out_time"))
+        if out_time is None:
+            # Despite the name, out_time_ms is reported in microseconds
+            out_time_us = _to_number(
+                values.get("out_time_us", values.get("out_time_ms")), cast=int
+            )
+            out_time = out_time_us / 1_000_000 if out_time_us is not None else None
+
+        return cls(
+            frame=_to_number(values.get("frame"), cast=int),
+            fps=_to_number(values.get("fps")),
+            bitrate_kbps=_to_number(values.get("bitrate")),
+            total_size=_to_number(values.get("total_size"), cast=int),
+            out_time=out_time,
+            speed=_to_number(values.get("speed")),
+            done=values.get("progress") == "end",
+        )
+
+    def percent(self, duration):
+        if not duration or self.out_time is None:
+            return None
+        return min(100.0, self.out_time / duration * 100)
+
+
+def parse_progress(lines):
+    """Yield an EncodeProgress for every block written by ffmpeg -progress.
+
+    ffmpeg writes one key=value pair per line and closes each block with a
+    progress=continue or progress=end line.
+    """
+    values = dict()
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+
+        key, sep, value = line.strip().partition("=")
+        if not sep:
+            continue
+
+        values[key] = value
+        if key == "progress":
+            yield EncodeProgress.from_values(values)
+            values = dict()
+
+
+class OutputTail:
+    """Keep only the last max_bytes of a stream for error reporting."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._chunks = deque()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def feed(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+
+        with self._lock:
+            self._chunks.append(chunk)
+            self._size += len(chunk)
+
+            while self._size > self.max_bytes:
+                excess = self._size - self.max_bytes
+                if len(self._chunks[0]) <= excess:
+                    self._size -= len(self._chunks.popleft())
+                else:
+                    self._chunks[0] = self._chunks[0][excess:]
+                    self._size -= excess
+
+    def drain(self, stream):
+        for chunk in stream:
+            self.feed(chunk)
+
+    def text(self):
+        with self._lock:
+            return b"".join(self._chunks).decode("utf-8", errors="replace")
+
+
+def progress_logger(name, duration=None):
+    """Build a progress callback that logs encode throughput for name."""
+
+    def _log_progress(progress):
+        percent = progress.percent(duration)
+        log.info(
+            f"{name}: "
+            + (f"{percent:.1f}% " if percent is not None else "")
+            + f"out_time={progress.out_time}s fps={progress.fps} "
+            f"speed={progress.speed}x bitrate={progress.bitrate_kbps}kbits/s"
+        )
+
+    return _log_progress
@@ -0,0 +1,325 @@
+import os
+import json
+import time
+import logging
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+from settings import (
+    FULL_SCAN_INTERVAL,
+    FILE_STABILITY_SECONDS,
+    FILE_STABILITY_CHECK_OPEN_FILES,
+)
+from state import connect
+
+log = logging.getLogger(__name__)
+
+PROC_PATH = "/proc"
+# How long a snapshot of the files open for writing is reused
+OPEN_FILES_TTL = 5
+
+_open_files_cache = (None, frozenset())
+
+
+def _read_open_for_writing():
+    open_files = set()
+    try:
+        pids = [x for x in os.listdir(PROC_PATH) if x.isdigit()]
+    except OSError:
+        return frozenset()
+
+    for pid in pids:
+        fd_dir = os.path.join(PROC_PATH, pid, "fd")
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            # Gone already or not ours to look at
+            continue
+
+        for fd in fds:
+            fd_path = os.path.join(fd_dir, fd)
+            try:
+                if not os.readlink(fd_path).startswith("/"):
+                    # Pipes, sockets and the like
+                    continue
+
+                with open(os.path.join(PROC_PATH, pid, "fdinfo", fd)) as f:
+                    for line in f:
+                        if line.startswith("flags:"):
+                            flags = int(line.split()[1], 8)
+                            break
+                    else:
+                        continue
+
+                if flags & os.O_ACCMODE == os.O_RDONLY:
+                    continue
+
+                stat = os.stat(fd_path)
+            except (OSError, ValueError):
+                continue
+            open_files.add((stat.st_dev, stat.st_ino))
+    return frozenset(open_files)
+
+
+def open_for_writing():
+    """Return the (device, inode) of every file open for writing.
+
+    Only processes visible in /proc are seen, so a downloader running in
+    another container or on another host won't show up here. The result is
+    reused for OPEN_FILES_TTL seconds since walking /proc touches every
+    open descriptor on the machine.
+    """
+    global _open_files_cache
+
+    taken_at, open_files = _open_files_cache
+    now = time.monotonic()
+    if taken_at is None or now - taken_at > OPEN_FILES_TTL:
+        open_files = _read_open_for_writing()
+        _open_files_cache = (now, open_files)
+    return open_files
+
+
+class StabilityGate:
+    """Decide whether a file is finished being written.
+
+    A file is stable once its mtime is at least window seconds old and,
+    if check_open_files is set, no process has it open for writing. Files
+    that fail the check are remembered in deferred.
+    """
+
+    def __init__(self, window=None, check_open_files=None):
+        self.window = FILE_STABILITY_SECONDS if window is None else window
+        self.check_open_files = (
+            FILE_STABILITY_CHECK_OPEN_FILES
+            if check_open_files is None
+            else check_open_files
+        )
+        self.deferred = set()
+
+    def is_stable(self, path, stat=None):
+        if stat is None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return False
+
+        if time.time() - stat.st_mtime < self.window:
+            log.info(f"{path} was modified recently, waiting for it to settle")
+            self.deferred.add(os.fspath(path))
+            return False
+
+        if self.check_open_files and (stat.st_dev, stat.st_ino) in open_for_writing():
+            log.info(f"{path} is still open for writing, waiting for it to finish")
+            self.deferred.add(os.fspath(path))
+            return False
+        return True
+
+
+def scan_files(
+    path,
+    max_depth=None,
+    min_size=None,
+    extensions=None,
+    exclude_extensions=None,
+    stability=None,
+):
+    """Yield an os.DirEntry for every non-directory under path.
+
+    Directories are walked with os.scandir as the entries are consumed, so
+    nothing is buffered beyond the directories still waiting to be visited.
+    max_depth counts like find's -maxdepth, where 1 is only the entries
+    directly inside path. Only files larger than min_size bytes are yielded
+    and extensions are compared case-insensitively. When a StabilityGate is
+    given, files still being written are left out. Symlinks are reported
+    but never followed.
+
+    Raises FileNotFoundError or NotADirectoryError if path itself can't be
+    scanned. Unreadable subdirectories are logged and skipped.
+    """
+    if extensions is not None:
+        extensions = tuple(x.lower() for x in extensions)
+    if exclude_extensions is not None:
+        exclude_extensions = tuple(x.lower() for x in exclude_extensions)
+
+    pending = [(os.fspath(path), 1)]
+    while pending:
+        directory, depth = pending.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            if depth == 1:
+                raise
+            log.warning(f"Unable to scan {directory}: {e}")
+            continue
+
+        with entries:
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+
+                if is_dir:
+                    if max_depth is None or depth < max_depth:
+                        pending.append((entry.path, depth + 1))
+                    continue
+
+                ext = os.path.splitext(entry.name)[1].lower()
+                if extensions is not None and ext not in extensions:
+                    continue
+                if exclude_extensions is not None and ext in exclude_extensions:
+                    continue
+
+                if min_size is not None or stability is not None:
+                    try:
+                        # DirEntry caches this, so callers can reuse it for free
+                        stat = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if min_size is not None and stat.st_size <= min_size:
+                        continue
+                    if stability is not None and not stability.is_stable(
+                        entry.path, stat=stat
+                    ):
+                        continue
+
+                yield entry
+
+
+@dataclass(frozen=True)
+class DirectorySnapshot:
+    mtime_ns: int
+    entry_count: int
+    has_subdirs: bool
+
+    @classmethod
+    def take(cls, path):
+        """Cheaply describe path with one stat and one directory read.
+
+        Returns None if path can't be read.
+        """
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            with os.scandir(path) as entries:
+                entry_count = 0
+                has_subdirs = False
+                for entry in entries:
+                    entry_count += 1
+                    if entry.is_dir(follow_symlinks=False):
+                        has_subdirs = True
+        except OSError:
+            return None
+        return cls(mtime_ns=mtime_ns, entry_count=entry_count, has_subdirs=has_subdirs)
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    snapshot: DirectorySnapshot
+    files: frozenset = field(default_factory=frozenset)
+    synced: bool = False
+    scanned_at: float = 0.0
+
+
+class DirectoryManifest:
+    """Remember what each show directory looked like when it was last scanned.
+
+    A directory whose mtime and entry count still match its entry, and which
+    had no subdirectories left to flatten, can't have gained or lost files,
+    so its stored file set can be used instead of walking it again. Entries
+    older than FULL_SCAN_INTERVAL hours are ignored so every directory still
+    gets a full scan now and then.
+    """
+
+    DB_NAME = "scan_manifest"
+
+    def __init__(self, full_scan_interval=None):
+        if full_scan_interval is None:
+            full_scan_interval = FULL_SCAN_INTERVAL
+        self.full_scan_interval = full_scan_interval
+
+    @contextmanager
+    def _connect(self):
+        with connect(self.DB_NAME) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS directories ("
+                "path TEXT PRIMARY KEY, "
+                "mtime_ns INTEGER NOT NULL, "
+                "entry_count INTEGER NOT NULL, "
+                "has_subdirs INTEGER NOT NULL, "
+                "files TEXT NOT NULL, "
+                "synced INTEGER NOT NULL, "
+                "scanned_at REAL NOT NULL)"
+            )
+            yield conn
+
+    def get(self, path):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT mtime_ns, entry_count, has_subdirs, files, synced, scanned_at "
+                "FROM directories WHERE path=?",
+                (str(path),),
+            ).fetchone()
+
+        if row is None:
+            return None
+
+        return ManifestEntry(
+            snapshot=DirectorySnapshot(
+                mtime_ns=row[0], entry_count=row[1], has_subdirs=bool(row[2])
+            ),
+            files=frozenset(json.loads(row[3])),
+            synced=bool(row[4]),
+            scanned_at=row[5],
+        )
+
+    def unchanged(self, path):
+        """Return the stored entry for path if it is still current, else None."""
+        if self.full_scan_interval <= 0:
+            return None
+
+        entry = self.get(path)
+        if entry is None or entry.snapshot.has_subdirs:
+            return None
+
+        if time.time() - entry.scanned_at > self.full_scan_interval * 3600:
+            return None
+
+        if DirectorySnapshot.take(path) != entry.snapshot:
+            return None
+        return entry
+
+    def update(self, path, files, snapshot=None, synced=False, scanned_at=None):
+        """Record the file set computed for path.
+
+        snapshot should be taken before files was computed so that anything
+        changing the directory in between forces another scan.
+        """
+        if snapshot is None:
+            snapshot = DirectorySnapshot.take(path)
+        if snapshot is None:
+            return
+
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO directories "
+                "(path, mtime_ns, entry_count, has_subdirs, files, synced, scanned_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(path),
+                    snapshot.mtime_ns,
+                    snapshot.entry_count,
+                    int(snapshot.has_subdirs),
+                    json.dumps(sorted(files)),
+                    int(synced),
+                    time.time() if scanned_at is None else scanned_at,
+                ),
+            )
+
+    def invalidate(self, path):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM directories WHERE path=?", (str(path),))
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM directories")
@@ -1,4 +1,5 @@
 import os
+import json
 import logging
 
 logging.getLogger().setLevel(level=logging.DEBUG)
@@ -33,6 +34,66 @@ DOMAIN = os.getenv(
 MEDIAVIEWER_SUFFIX = os.getenv("MC_MEDIAVIEWER_SUFFIX", "mv-encoded.mp4")
 
 ENCODER = "ffmpeg"  # or 'avconv'
+FFPROBE = "ffprobe"
+
+# Number of files to encode at once. Each encode gets an equal share of the CPUs.
+MAX_PARALLEL_ENCODES = int(os.getenv("MC_MAX_PARALLEL_ENCODES", 1))
+
+# Number of shows scanned and compared against the server at once. This work
+# mostly waits on the disk and network so it can be much higher than
+# MC_MAX_PARALLEL_ENCODES. 1 handles shows one after another.
+MAX_PARALLEL_SHOWS = int(os.getenv("MC_MAX_PARALLEL_SHOWS", 1))
+
+# Extract embedded subtitles in the same ffmpeg run as the video encode.
+# Set to false to fall back to a separate extraction pass.
+SINGLE_PASS_ENCODE = os.getenv("MC_SINGLE_PASS_ENCODE", "true").lower() == "true"
+
+# Where encodes are written before being moved next to the original:
+#   sibling - hidden directory beside the original, falling back to MC_SCRATCH_DIR
+#   dir     - MC_SCRATCH_DIR, falling back to beside the original
+#   tmp     - the system temp directory
+# Locations without room for about MC_SCRATCH_FREE_SPACE_FACTOR times the
+# original's size are skipped.
+SCRATCH_STRATEGY = os.getenv("MC_SCRATCH_STRATEGY", "sibling")
+SCRATCH_DIR = os.getenv("MC_SCRATCH_DIR", "")
+SCRATCH_FREE_SPACE_FACTOR = float(os.getenv("MC_SCRATCH_FREE_SPACE_FACTOR", 1.1))
+# Scratch directories nothing has been written to for this many hours were left
+# behind by a killed encode and are deleted when their location is next scanned
+SCRATCH_STALE_HOURS = float(os.getenv("MC_SCRATCH_STALE_HOURS", 6))
+
+# Sources at least this many seconds long that need a full video transcode are
+# split at keyframes and encoded on MC_CHUNKED_ENCODE_WORKERS processes. This
+# only helps on hosts with more cores than a single libx264 process keeps busy.
+# 0 disables chunked encoding.
+CHUNKED_ENCODE_MIN_DURATION = int(os.getenv("MC_CHUNKED_ENCODE_MIN_DURATION", 0))
+CHUNKED_ENCODE_SEGMENT_SECONDS = int(
+    os.getenv("MC_CHUNKED_ENCODE_SEGMENT_SECONDS", 300)
+)
+CHUNKED_ENCODE_WORKERS = int(os.getenv("MC_CHUNKED_ENCODE_WORKERS", 4))
+
+# Encoder settings used when the video has to be transcoded. The first profile
+# whose "match" criteria fit the source wins. Criteria are min_/max_height,
+# min_/max_bitrate (bits/s), min_/max_duration (seconds) and animation (bool).
+# Profiles may set preset, crf, tune, threads, max_height (downscale) and
+# extra_args. For example:
+#   MC_ENCODING_PROFILES='[
+#     {"name": "animation", "match": {"animation": true}, "tune": "animation", "crf": 20},
+#     {"name": "uhd", "match": {"min_height": 1440}, "preset": "fast", "max_height": 1080},
+#     {"name": "default", "match": {}, "preset": "medium", "crf": 21}
+#   ]'
+ENCODING_PROFILES = json.loads(
+    os.getenv("MC_ENCODING_PROFILES", '[{"name": "default", "match": {}}]')
+)
+ANIMATION_KEYWORDS = (
+    os.getenv("MC_ANIMATION_KEYWORDS").split(",")
+    if os.getenv("MC_ANIMATION_KEYWORDS")
+    else ["anime", "animation", "animated", "cartoon"]
+)
+
+# Seconds between encode progress reports and how much of ffmpeg's stderr to
+# keep for error reporting
+ENCODE_PROGRESS_INTERVAL = int(os.getenv("MC_ENCODE_PROGRESS_INTERVAL", 30))
+ENCODE_STDERR_TAIL_BYTES = int(os.getenv("MC_ENCODE_STDERR_TAIL_BYTES", 64 * 1024))
 
 MEDIA_FILE_EXTENSIONS = (
     ".mp4",
@@ -59,8 +120,103 @@ EMAIL_RECIPIENTS = (
 
 VERIFY_REQUESTS = True
 
+# HTTP connections are kept alive and pooled per host. Idempotent requests
+# (GET, PUT, ...) that fail to connect or get one of HTTP_RETRY_STATUSES back
+# are retried up to HTTP_RETRIES times with jittered exponential backoff.
+HTTP_POOL_SIZE = int(os.getenv("MC_HTTP_POOL_SIZE", 10))
+HTTP_RETRIES = int(os.getenv("MC_HTTP_RETRIES", 3))
+HTTP_BACKOFF_FACTOR = float(os.getenv("MC_HTTP_BACKOFF_FACTOR", 0.5))
+HTTP_BACKOFF_JITTER = float(os.getenv("MC_HTTP_BACKOFF_JITTER", 0.5))
+HTTP_RETRY_STATUSES = (429, 502, 503, 504)
+
+# Most requests a single lookup, like fetching every media path of a show,
+# sends at once
+MAX_PARALLEL_REQUESTS = int(os.getenv("MC_MAX_PARALLEL_REQUESTS", 4))
+
+# Seconds to wait for a connection and for a response. HTTP_TIMEOUTS
+# overrides the response timeout for URLs containing the given text, the
+# longest match wins. For example:
+#   MC_HTTP_TIMEOUTS='{"/mediaviewer/api/inferscrapers/": 120}'
+HTTP_CONNECT_TIMEOUT = float(os.getenv("MC_HTTP_CONNECT_TIMEOUT", 5))
+HTTP_READ_TIMEOUT = float(os.getenv("MC_HTTP_READ_TIMEOUT", 30))
+HTTP_TIMEOUTS = json.loads(
+    os.getenv("MC_HTTP_TIMEOUTS", '{"/mediaviewer/api/inferscrapers/": 60}')
+)
+
+# Requests to each host are limited by a token bucket refilled at up to
+# HTTP_RATE_LIMIT requests per second that can hold HTTP_RATE_BURST tokens.
+# The rate is halved on 429/503 responses and errors, cut back while
+# responses take longer than HTTP_TARGET_LATENCY seconds and recovers when
+# they are fast again. Retry-After headers pause the host entirely.
+# 0 disables the limiter.
+HTTP_RATE_LIMIT = float(os.getenv("MC_HTTP_RATE_LIMIT", 20))
+HTTP_RATE_BURST = int(os.getenv("MC_HTTP_RATE_BURST", 10))
+HTTP_MIN_RATE = float(os.getenv("MC_HTTP_MIN_RATE", 0.5))
+HTTP_TARGET_LATENCY = float(os.getenv("MC_HTTP_TARGET_LATENCY", 1.0))
+
+# Keep a local copy of the tv and movie listings and only ask MediaViewer for
+# entries changed since the last sync, passing the time of that sync in the
+# MC_CATALOG_UPDATED_AFTER_PARAM query parameter. The whole listing is still
+# fetched every MC_CATALOG_FULL_SYNC_INTERVAL hours and on full scans, which
+# is also when entries deleted on the server disappear locally.
+CATALOG_SYNC_ENABLED = os.getenv("MC_CATALOG_SYNC_ENABLED", "false").lower() == "true"
+CATALOG_UPDATED_AFTER_PARAM = os.getenv(
+    "MC_CATALOG_UPDATED_AFTER_PARAM", "updated_after"
+)
+CATALOG_FULL_SYNC_INTERVAL = float(os.getenv("MC_CATALOG_FULL_SYNC_INTERVAL", 24))
+
+# MediaViewer is asked to scrape metadata for new media after things are
+# posted. When coalescing, that happens once at the end of each tv or movie
+# run (or watch mode batch) instead of after every POST.
+COALESCE_INFER_SCRAPERS = (
+    os.getenv("MC_COALESCE_INFER_SCRAPERS", "true").lower() == "true"
+)
+
 MINIMUM_FILE_SIZE = int(os.getenv("MC_MINIMUM_FILE_SIZE", 10000000))
 
+# Location of local sqlite databases used to remember work between runs (probe
+# and http caches, encode queue, scan manifest and catalog). It defaults to a
+# hidden directory in MC_BASE_PATH so it lives on the same volume as the
+# library and survives the container being recreated. Point it at another
+# mounted volume if the library is read-only.
+STATE_DIR = os.getenv("MC_STATE_DIR", os.path.join(BASE_PATH, ".mediaconverter"))
+
+PROBE_CACHE_ENABLED = os.getenv("MC_PROBE_CACHE_ENABLED", "true").lower() == "true"
+PROBE_CACHE_MAX_ENTRIES = int(os.getenv("MC_PROBE_CACHE_MAX_ENTRIES", 20000))
+
+# GET responses from MediaViewer that carry an ETag or Last-Modified header
+# are kept and revalidated with conditional requests, so unchanged data isn't
+# downloaded again. Entries not revalidated for MC_HTTP_CACHE_TTL hours are
+# dropped.
+HTTP_CACHE_ENABLED = os.getenv("MC_HTTP_CACHE_ENABLED", "true").lower() == "true"
+HTTP_CACHE_MAX_ENTRIES = int(os.getenv("MC_HTTP_CACHE_MAX_ENTRIES", 20000))
+HTTP_CACHE_TTL = float(os.getenv("MC_HTTP_CACHE_TTL", 24 * 7))
+
+# Hours a show directory's scan manifest entry is trusted before it is fully
+# rescanned. 0 rescans every directory on every run
+FULL_SCAN_INTERVAL = float(os.getenv("MC_FULL_SCAN_INTERVAL", 24))
+
+# A file is only picked up once it hasn't been modified for this many seconds
+# and, when FILE_STABILITY_CHECK_OPEN_FILES is on, no process visible in /proc
+# has it open for writing
+FILE_STABILITY_SECONDS = float(os.getenv("MC_FILE_STABILITY_SECONDS", 60))
+FILE_STABILITY_CHECK_OPEN_FILES = (
+    os.getenv("MC_FILE_STABILITY_CHECK_OPEN_FILES", "true").lower() == "true"
+)
+
+# Seconds a watched show or movie directory must be quiet before watch mode
+# processes it
+WATCH_DEBOUNCE_SECONDS = float(os.getenv("MC_WATCH_DEBOUNCE_SECONDS", 30))
+
+# Order pending encodes are run in. One of shortest_first, newest_first or fifo
+ENCODE_QUEUE_POLICY = os.getenv("MC_ENCODE_QUEUE_POLICY", "shortest_first")
+
+# A running encode job is leased to the process that claimed it, which renews
+# the lease while it works. Jobs whose lease hasn't been renewed for this many
+# seconds belong to a process that died and are handed out again, so watch mode
+# and the celery worker can share MC_STATE_DIR without encoding a file twice.
+ENCODE_JOB_LEASE_SECONDS = float(os.getenv("MC_ENCODE_JOB_LEASE_SECONDS", 300))
+
 # DON'T MAKE ANY EDITS BELOW THIS LINE!!!!
 try:
     from local_settings import *  # noqa
@@ -0,0 +1,76 @@
+import re
+import logging
+
+from pathlib import Path
+
+from utils import normalize_filename
+
+log = logging.getLogger(__name__)
+
+WORD = re.compile(r"[a-z0-9]+")
+# S01E02, S01, S01E01E02 or 1x02
+EPISODE_MARKER = re.compile(r"^(s\d{1,2}(e\d{1,3})*|\d{1,2}x\d{1,3})$")
+
+# Stored for show names that more than one directory reduces to
+AMBIGUOUS = object()
+
+
+def title_words(name):
+    """Reduce a show directory or file name to lowercase ASCII words."""
+    return tuple(WORD.findall(normalize_filename(name).lower()))
+
+
+def show_key(filename):
+    """Return the words of filename before its episode marker, or None."""
+    words = title_words(filename)
+    for i, word in enumerate(words):
+        if EPISODE_MARKER.match(word):
+            return words[:i] or None
+    return None
+
+
+class ShowIndex:
+    """Prefix trie of show directories for filing downloaded episodes.
+
+    Names are compared as lowercase ASCII words, so "Grey's.Anatomy" and
+    "greys anatomy" are the same show. A file matches the longest show name
+    it starts with, but only when the very next word is an episode marker,
+    so "The.Office.US.S01E01" is never filed under "The.Office". Names that
+    more than one directory reduces to are ambiguous and never match.
+    """
+
+    def __init__(self, paths=()):
+        self._root = dict()
+        for path in paths:
+            self.add(path)
+
+    def add(self, path):
+        path = Path(path)
+        words = title_words(path.name)
+        if not words:
+            return
+
+        node = self._root
+        for word in words:
+            node = node.setdefault(word, dict())
+
+        # None can't clash with a word, so it marks where a show name ends
+        existing = node.get(None, path)
+        if existing != path:
+            log.debug(f"{path.name} matches more than one show directory")
+        node[None] = path if existing == path else AMBIGUOUS
+
+    def match(self, filename):
+        """Return the show directory filename belongs in, or None."""
+        words = title_words(filename)
+
+        best = None
+        node = self._root
+        for i, word in enumerate(words[:-1]):
+            node = node.get(word)
+            if node is None:
+                break
+            if None in node and EPISODE_MARKER.match(words[i + 1]):
+                best = node[None]
+
+        return None if best is AMBIGUOUS else best
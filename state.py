@@ -0,0 +1,34 @@
+import sqlite3
+import logging
+
+from contextlib import contextmanager
+from pathlib import Path
+
+from settings import STATE_DIR
+
+log = logging.getLogger(__name__)
+
+SQLITE_TIMEOUT = 30
+
+
+def state_path(name):
+    return Path(STATE_DIR) / f"{name}.sqlite3"
+
+
+@contextmanager
+def connect(name):
+    """Open the named state database, committing on success.
+
+    A new connection is made for every use so callers on different
+    threads or processes never share one.
+    """
+    path = state_path(name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    conn = sqlite3.connect(path, timeout=SQLITE_TIMEOUT)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
@@ -0,0 +1,115 @@
+import re
+import codecs
+import logging
+
+from pathlib import Path
+
+from utils import EncoderException
+
+log = logging.getLogger(__name__)
+
+VTT_HEADER = "WEBVTT"
+FALLBACK_ENCODING = "cp1252"
+ENCODING_SAMPLE_SIZE = 64 * 1024
+
+BOMS = (
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+)
+
+TIMESTAMP_REGEX = re.compile(
+    r"^\s*(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})\s*-->\s*"
+    r"(\d+):(\d{1,2}):(\d{1,2})[,.](\d{1,3})"
+)
+FORMATTING_TAG_REGEX = re.compile(r"\{\\[^}]*\}")
+
+
+def detect_encoding(sample, complete=True):
+    """Guess the text encoding of an srt file from its first bytes.
+
+    complete should be False when sample is only the start of the file.
+    """
+    for bom, encoding in BOMS:
+        if sample.startswith(bom):
+            return encoding
+
+    # UTF-16 without a BOM shows up as a NUL next to every ASCII character
+    if len(sample) >= 4:
+        if sample[1::2].count(0) > len(sample) // 4:
+            return "utf-16-le"
+        if sample[0::2].count(0) > len(sample) // 4:
+            return "utf-16-be"
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        # A character cut off by the end of a partial sample is not an error
+        decoder.decode(sample, final=complete)
+    except UnicodeDecodeError:
+        return FALLBACK_ENCODING
+    return "utf-8"
+
+
+def _format_timestamp(hours, minutes, seconds, millis):
+    return (
+        f"{int(hours):02d}:{int(minutes):02d}:{int(seconds):02d}."
+        f"{int(millis.ljust(3, '0')):03d}"
+    )
+
+
+def srt_to_vtt_lines(lines):
+    """Yield WebVTT lines for an iterable of srt lines.
+
+    Cue numbers are kept as cue identifiers, timestamps are rewritten to use
+    a '.' before the milliseconds and ASS style override tags are dropped.
+    """
+    yield f"{VTT_HEADER}\n"
+    yield "\n"
+
+    started = False
+    for line in lines:
+        line = line.rstrip("\r\n").lstrip("\ufeff")
+
+        if not started:
+            if not line.strip():
+                continue
+            started = True
+
+        match = TIMESTAMP_REGEX.match(line)
+        if match:
+            groups = match.groups()
+            yield (
+                f"{_format_timestamp(*groups[:4])} --> "
+                f"{_format_timestamp(*groups[4:])}\n"
+            )
+        else:
+            yield f"{FORMATTING_TAG_REGEX.sub('', line)}\n"
+
+
+def convert_srt_to_vtt(srt_path, vtt_path=None):
+    srt_path = Path(srt_path)
+    vtt_path = Path(vtt_path) if vtt_path else srt_path.with_suffix(".vtt")
+
+    log.info(f"Converting {srt_path} to {vtt_path}")
+    try:
+        with open(srt_path, "rb") as f:
+            sample = f.read(ENCODING_SAMPLE_SIZE)
+        encoding = detect_encoding(sample, complete=len(sample) < ENCODING_SAMPLE_SIZE)
+
+        with (
+            open(
+                srt_path, "r", encoding=encoding, errors="replace", newline=""
+            ) as srt_file,
+            open(vtt_path, "w", encoding="utf-8") as vtt_file,
+        ):
+            vtt_file.writelines(srt_to_vtt_lines(srt_file))
+    except OSError as e:
+        log.error(e)
+        try:
+            vtt_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise EncoderException(str(e))
+    return vtt_path
@@ -5,6 +5,9 @@ from faker import Faker
 
 from pathlib import Path
 
+import utils
+from utils import close_sessions
+
 DATA_DIR_PATH = Path(__file__).parent / "data"
 STREAMABLE_FILE_NAME = "mov_bbb.mp4"
 STREAMABLE_FILE_PATH = DATA_DIR_PATH / STREAMABLE_FILE_NAME
@@ -14,6 +17,29 @@ SRT_FILE_NAME = "2_Eng.srt"
 SRT_FILE_PATH = DATA_DIR_PATH / SRT_FILE_NAME
 
 
+@pytest.fixture(autouse=True)
+def _state_dir(tmp_path, monkeypatch):
+    state_dir = tmp_path / "state"
+    monkeypatch.setattr("state.STATE_DIR", str(state_dir))
+    return state_dir
+
+
+@pytest.fixture(autouse=True)
+def _settled_files(monkeypatch):
+    # Files made by the tests are brand new, don't wait for them to settle
+    monkeypatch.setattr("scanner.FILE_STABILITY_SECONDS", 0)
+    monkeypatch.setattr("scanner._open_files_cache", (None, frozenset()))
+
+
+@pytest.fixture(autouse=True)
+def _unlimited_requests(monkeypatch):
+    # Don't pace or pause test requests, each test gets fresh limiters and
+    # starts with no scraping pending
+    monkeypatch.setattr("utils.HTTP_RATE_LIMIT", 0)
+    close_sessions()
+    utils._infer_scrapers_pending.clear()
+
+
 @pytest.fixture(scope="session")
 def fake():
     return Faker()
@@ -37,16 +37,27 @@ class TestGetFilesInDirectory:
 
     def test_files_exist(self):
         files = [tempfile.mkstemp(dir=self.temp_dir) for i in range(3)]
-        expected = set([x[1].encode("utf-8") for x in files])
+        for fd, _ in files:
+            os.close(fd)
+        expected = set([x[1] for x in files])
         actual = _getFilesInDirectory(self.temp_dir)
         assert expected == actual
 
+    def test_files_being_written_are_skipped(self):
+        fd, file = tempfile.mkstemp(dir=self.temp_dir)
+        try:
+            assert set() == _getFilesInDirectory(self.temp_dir)
+        finally:
+            os.close(fd)
+
     def test_nested_files_exist(self):
         expected = set()
         dirs = [tempfile.mkdtemp(dir=self.temp_dir) for i in range(3)]
         for dir in dirs:
-            files = [tempfile.mkstemp(dir=dir)[1].encode("utf-8") for i in range(3)]
-            expected.update(files)
+            for i in range(3):
+                fd, file = tempfile.mkstemp(dir=dir)
+                os.close(fd)
+                expected.add(file)
 
         actual = _getFilesInDirectory(self.temp_dir)
         assert expected == actual
@@ -2,6 +2,7 @@ import pytest
 import mock
 import tempfile
 import os
+import time
 import shutil
 
 from pathlib import Path
@@ -32,6 +33,7 @@ class TestBuildLocalFileSetFunctional:
         files = [tempfile.mkstemp(dir=self.temp_dir) for i in range(4)]
 
         for i, file in enumerate(files):
+            os.close(file[0])
             with open(file[1], "wb") as f:
                 f.write(os.urandom(i * 100))
 
@@ -41,6 +43,15 @@ class TestBuildLocalFileSetFunctional:
         actual = self.tv_runner.buildLocalFileSet(self.temp_dir)
         assert expected == actual
 
+    def test_path_with_quotes(self):
+        show_dir = Path(self.temp_dir) / "Grey's Anatomy"
+        show_dir.mkdir()
+        (show_dir / "Grey's.Anatomy.S01E01.mkv").write_bytes(b"0" * 300)
+        (show_dir / "Grey's.Anatomy.S01E01.srt").write_bytes(b"0" * 300)
+
+        actual = self.tv_runner.buildLocalFileSet(show_dir)
+        assert set(["Grey's.Anatomy.S01E01.mkv"]) == actual
+
 
 class TestSortUnsortedFiles:
     @pytest.fixture(autouse=True)
@@ -68,7 +79,7 @@ class TestSortUnsortedFiles:
     def test_unsorted_path_does_not_exist(self):
         self.unsorted_path.rmdir()
 
-        assert self.tv_runner._sort_unsorted_files() is None
+        assert self.tv_runner._sort_unsorted_files() == set()
 
     def test_no_localpath_for_filename(self):
         self.mock_get_localpath_by_filename.return_value = None
@@ -76,7 +87,7 @@ class TestSortUnsortedFiles:
 
         unsorted_file_path = self.unsorted_path / "new.show.s02e10"
         unsorted_file_path.mkdir()
-        assert self.tv_runner._sort_unsorted_files() is None
+        assert self.tv_runner._sort_unsorted_files() == set()
         assert unsorted_file_path.exists()
         assert not new_path.exists()
 
@@ -88,7 +99,7 @@ class TestSortUnsortedFiles:
         unsorted_file_path = self.unsorted_path / "new.show.s02e10"
         unsorted_file_path.mkdir()
 
-        assert self.tv_runner._sort_unsorted_files() is None
+        assert self.tv_runner._sort_unsorted_files() == set()
         assert unsorted_file_path.exists()
         assert not new_path.exists()
 
@@ -98,10 +109,46 @@ class TestSortUnsortedFiles:
 
         unsorted_file_path = self.unsorted_path / "new.show.s02e10"
         unsorted_file_path.mkdir()
-        assert self.tv_runner._sort_unsorted_files() is None
+        assert self.tv_runner._sort_unsorted_files() == set()
         assert not unsorted_file_path.exists()
         assert new_path.exists()
 
+    def test_localpath_from_show_index(self, mocker):
+        mocker.patch("tv_runner.LOCAL_TV_SHOWS_PATHS", [str(self.temp_dir_path)])
+        show_dir = self.temp_dir_path / "New.Show"
+        show_dir.mkdir()
+
+        unsorted_file_path = self.unsorted_path / "new.show.s02e10"
+        unsorted_file_path.mkdir()
+
+        assert self.tv_runner._sort_unsorted_files() == set()
+        assert not unsorted_file_path.exists()
+        assert (show_dir / "new.show.s02e10").exists()
+        assert not self.mock_get_localpath_by_filename.called
+
+    def test_remote_lookups_are_memoized(self):
+        self.mock_get_localpath_by_filename.return_value = Path(self.local_path)
+        for name in ("new.show.s02e10", "new.show.s02e11", "other.show.s01e01"):
+            (self.unsorted_path / name).mkdir()
+
+        assert self.tv_runner._sort_unsorted_files() == set()
+        assert (self.local_path / "new.show.s02e10").exists()
+        assert (self.local_path / "new.show.s02e11").exists()
+        assert self.mock_get_localpath_by_filename.call_count == 2
+
+    def test_downloads_still_being_written_are_left_alone(self, mocker):
+        mocker.patch("scanner.FILE_STABILITY_SECONDS", 3600)
+        self.mock_get_localpath_by_filename.return_value = Path(self.local_path)
+        (self.unsorted_path / "new.show.s02e10").mkdir()
+        (self.unsorted_path / "new.show.s02e10" / "new.show.s02e10.mkv").touch()
+        (self.unsorted_path / "new.show.s02e11.mkv.part").touch()
+
+        assert self.tv_runner._sort_unsorted_files() == set([self.unsorted_path])
+        assert (self.unsorted_path / "new.show.s02e10").exists()
+        assert (self.unsorted_path / "new.show.s02e11.mkv.part").exists()
+        assert list(self.local_path.iterdir()) == []
+        assert not self.mock_get_localpath_by_filename.called
+
 
 class TestHandleDirs:
     @pytest.fixture(autouse=True)
@@ -155,3 +202,72 @@ class TestHandleDirs:
         assert self.expected_media_file.exists()
         assert self.expected_sub_file.exists()
         assert not self.non_existent_small_file.exists()
+
+    def test_dry_run(self):
+        self.tv_runner.handleDirs(self.tv_dir, dry_run=True)
+        assert self.episode_file.exists()
+        assert self.sub_file.exists()
+        assert not self.expected_media_file.exists()
+
+    def test_plan(self):
+        (self.sub_dir / "3_English.srt").touch()
+        (self.sub_dir / "4_Spa.srt").touch()
+        (self.tv_dir / "Test.Dir.Path.S04E02.mp4").touch()
+
+        renames, removals = self.tv_runner._planDirs(self.tv_dir)
+
+        assert renames == [
+            (
+                self.sub_file,
+                self.tv_dir / "Test.Dir.Path.S04E01.WEBRip.x264-MV-0.srt",
+            ),
+            (
+                self.sub_dir / "3_English.srt",
+                self.tv_dir / "Test.Dir.Path.S04E01.WEBRip.x264-MV-1.srt",
+            ),
+            (self.episode_file, self.expected_media_file),
+        ]
+        assert removals == [self.episode_dir]
+
+    def test_scratch_dirs_are_ignored(self):
+        scratch_dir = self.tv_dir / ".mc-scratch-abcd"
+        scratch_dir.mkdir()
+        partial_file = scratch_dir / "Test.Dir.Path.S04E02.mp4"
+        with open(partial_file, "w") as f:
+            f.seek(1500)
+            f.write("0")
+
+        self.tv_runner.handleDirs(self.tv_dir)
+        assert self.expected_media_file.exists()
+        assert partial_file.exists()
+        assert not (self.tv_dir / partial_file.name).exists()
+
+    def test_stale_scratch_dirs_are_removed(self):
+        scratch_dir = self.tv_dir / ".mc-scratch-abcd"
+        scratch_dir.mkdir()
+        partial_file = scratch_dir / "Test.Dir.Path.S04E02.mp4"
+        partial_file.touch()
+        stale = time.time() - 7 * 3600
+        for path in (partial_file, scratch_dir):
+            os.utime(path, (stale, stale))
+
+        self.tv_runner.handleDirs(self.tv_dir)
+        assert self.expected_media_file.exists()
+        assert not scratch_dir.exists()
+
+    def test_dangling_symlink_does_not_hold_up_episode(self):
+        (self.episode_dir / "sample.mkv").symlink_to(self.episode_dir / "missing.mkv")
+
+        renames, removals = self.tv_runner._planDirs(self.tv_dir)
+
+        assert (self.episode_file, self.expected_media_file) in renames
+        assert removals == [self.episode_dir]
+        assert self.tv_dir not in self.tv_runner.deferred
+
+    def test_unsettled_episode_dirs_are_left_alone(self, mocker):
+        mocker.patch("scanner.FILE_STABILITY_SECONDS", 3600)
+
+        self.tv_runner.handleDirs(self.tv_dir)
+        assert not self.expected_media_file.exists()
+        assert self.sub_file.exists()
+        assert self.tv_dir in self.tv_runner.deferred
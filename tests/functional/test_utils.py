@@ -6,6 +6,8 @@ import os
 from pathlib import Path
 from utils import (
     stripUnicode,
+    normalize_filenames,
+    normalize_paths,
     is_valid_media_file,
 )
 
@@ -67,6 +69,70 @@ class TestStripUnicode(CreateFileMixin):
         assert expected == actual
 
 
+class TestNormalizeFilenames:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.temp_dir = temp_directory
+        for name in ("CaféÐÆ.mkv", "it's.mkv", "plain.mkv"):
+            (self.temp_dir / name).write_text(name)
+
+    def test_whole_directory(self):
+        current_dir = os.getcwd()
+
+        actual = normalize_filenames(self.temp_dir)
+
+        assert actual == {
+            self.temp_dir / "CaféÐÆ.mkv": self.temp_dir / "CafeDAE.mkv",
+            self.temp_dir / "it's.mkv": self.temp_dir / "its.mkv",
+            self.temp_dir / "plain.mkv": self.temp_dir / "plain.mkv",
+        }
+        assert sorted(x.name for x in self.temp_dir.iterdir()) == [
+            "CafeDAE.mkv",
+            "its.mkv",
+            "plain.mkv",
+        ]
+        assert os.getcwd() == current_dir
+
+    def test_only_named_entries(self):
+        actual = normalize_filenames(self.temp_dir, ["it's.mkv"])
+
+        assert actual == {self.temp_dir / "it's.mkv": self.temp_dir / "its.mkv"}
+        assert (self.temp_dir / "CaféÐÆ.mkv").exists()
+
+    def test_collision_with_existing_file(self):
+        (self.temp_dir / "its.mkv").write_text("existing")
+
+        actual = normalize_filenames(self.temp_dir, ["it's.mkv"])
+
+        assert actual == {self.temp_dir / "it's.mkv": self.temp_dir / "it's.mkv"}
+        assert (self.temp_dir / "its.mkv").read_text() == "existing"
+
+    def test_collision_within_batch(self):
+        (self.temp_dir / "its'.mkv").write_text("second")
+
+        actual = normalize_filenames(self.temp_dir, ["it's.mkv", "its'.mkv"])
+
+        assert actual == {
+            self.temp_dir / "it's.mkv": self.temp_dir / "its.mkv",
+            self.temp_dir / "its'.mkv": self.temp_dir / "its'.mkv",
+        }
+        assert (self.temp_dir / "its.mkv").read_text() == "it's.mkv"
+
+    def test_normalize_paths(self):
+        subdir = self.temp_dir / "Ðir"
+        subdir.mkdir()
+        (subdir / "Ðata.mkv").write_text("")
+
+        actual = normalize_paths(
+            [
+                str(subdir / "Ðata.mkv").encode("utf-8"),
+                self.temp_dir / "it's.mkv",
+            ]
+        )
+
+        assert actual == [subdir / "Data.mkv", self.temp_dir / "its.mkv"]
+
+
 @pytest.mark.parametrize("use_bytes", (True, False))
 class TestIsValidMediaFile(CreateFileMixin):
     @pytest.fixture(autouse=True)
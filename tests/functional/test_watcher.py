@@ -0,0 +1,50 @@
+import os
+import pytest
+
+from watcher import Inotify, Watcher, TV
+
+
+class TestInotify:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.tv_root = temp_directory / "tv"
+        self.show = self.tv_root / "Some.Show"
+        self.show.mkdir(parents=True)
+
+        self.inotify = Inotify()
+        self.watcher = Watcher(self.inotify, [(TV, self.tv_root)], debounce=0)
+        self.watcher.start()
+
+        yield
+        self.inotify.close()
+
+    def _poll(self):
+        for _ in range(10):
+            self.watcher.poll(timeout=0.05)
+
+    def test_file_written(self):
+        (self.show / "Some.Show.S01E01.mkv").write_bytes(b"0")
+        self._poll()
+
+        assert self.watcher.due() == [(TV, self.show)]
+
+    def test_file_in_new_directory(self):
+        episode_dir = self.show / "Some.Show.S01E02"
+        episode_dir.mkdir()
+        self._poll()
+        assert self.watcher.due() == []
+
+        (episode_dir / "Some.Show.S01E02.mkv").write_bytes(b"0")
+        self._poll()
+
+        assert self.watcher.due() == [(TV, self.show)]
+
+    def test_directory_moved_in(self, temp_directory):
+        download = temp_directory / "Some.Show.S01E03"
+        download.mkdir()
+        (download / "Some.Show.S01E03.mkv").write_bytes(b"0")
+
+        os.rename(download, self.show / download.name)
+        self._poll()
+
+        assert self.watcher.due() == [(TV, self.show)]
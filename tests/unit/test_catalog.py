@@ -0,0 +1,119 @@
+import time
+import pytest
+from pathlib import Path
+
+from catalog import RemoteCatalog, with_query
+
+URL = "https://mediaviewer/mediaviewer/api/tv/"
+
+
+def parse(result):
+    for media_path in result["media_paths"]:
+        yield Path(media_path["path"]), media_path["pk"], result["finished"]
+
+
+def tv(pk, path, finished=False):
+    return {"media_paths": [{"pk": pk, "path": path}], "finished": finished}
+
+
+class TestWithQuery:
+    def test_with_query(self):
+        assert (
+            with_query(f"{URL}?page=2", updated_after="2026-10-18T00:00:00+00:00")
+            == f"{URL}?page=2&updated_after=2026-10-18T00%3A00%3A00%2B00%3A00"
+        )
+
+
+class TestRemoteCatalog:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_get_all_pages = mocker.patch("catalog.get_all_pages")
+        self.catalog = RemoteCatalog("tv", URL, parse, full_sync_interval=24)
+
+    def _respond(self, *results):
+        self.mock_get_all_pages.return_value = [{"results": list(results)}]
+
+    def _requested_url(self):
+        return self.mock_get_all_pages.call_args.args[0]
+
+    def test_first_sync_is_full(self):
+        self._respond(tv(1, "/tv/Show.One"), tv(2, "/tv/Show.Two", finished=True))
+
+        actual = self.catalog.sync()
+
+        assert self._requested_url() == URL
+        assert actual == {
+            Path("/tv/Show.One"): {"pks": {1}, "finished": False},
+            Path("/tv/Show.Two"): {"pks": {2}, "finished": True},
+        }
+
+    def test_delta(self):
+        self._respond(tv(1, "/tv/Show.One"), tv(2, "/tv/Show.Two"))
+        self.catalog.sync()
+
+        self._respond(tv(2, "/tv/Show.Two", finished=True), tv(3, "/tv/Show.One"))
+        actual = self.catalog.sync()
+
+        assert self._requested_url().startswith(f"{URL}?updated_after=")
+        assert actual == {
+            Path("/tv/Show.One"): {"pks": {1, 3}, "finished": False},
+            Path("/tv/Show.Two"): {"pks": {2}, "finished": True},
+        }
+
+    def test_full_sync_on_demand_drops_deleted_entries(self):
+        self._respond(tv(1, "/tv/Show.One"), tv(2, "/tv/Show.Two"))
+        self.catalog.sync()
+
+        self._respond(tv(2, "/tv/Show.Two"))
+        actual = self.catalog.sync(full=True)
+
+        assert self._requested_url() == URL
+        assert actual == {Path("/tv/Show.Two"): {"pks": {2}, "finished": False}}
+
+    def test_full_sync_on_schedule(self):
+        self._respond(tv(1, "/tv/Show.One"))
+        self.catalog.sync()
+        assert not self.catalog.needs_full_sync()
+
+        with self.catalog._connect() as conn:
+            conn.execute(
+                "UPDATE syncs SET full_synced_at=?", (time.time() - 25 * 3600,)
+            )
+
+        assert self.catalog.needs_full_sync()
+        self.catalog.sync()
+        assert self._requested_url() == URL
+        assert not self.catalog.needs_full_sync()
+
+    def test_delta_keeps_full_sync_time(self):
+        self._respond(tv(1, "/tv/Show.One"))
+        self.catalog.sync()
+        with self.catalog._connect() as conn:
+            conn.execute("UPDATE syncs SET full_synced_at=?", (time.time() - 3600,))
+
+        self.catalog.sync()
+
+        full_synced_at = self.catalog._last_sync()[1]
+        assert time.time() - full_synced_at >= 3600
+
+    def test_failed_sync_keeps_previous_copy(self):
+        self._respond(tv(1, "/tv/Show.One"))
+        self.catalog.sync()
+        last_sync = self.catalog._last_sync()
+
+        self.mock_get_all_pages.side_effect = ValueError()
+        with pytest.raises(ValueError):
+            self.catalog.sync(full=True)
+
+        assert self.catalog._last_sync() == last_sync
+        assert self.catalog.paths() == {
+            Path("/tv/Show.One"): {"pks": {1}, "finished": False}
+        }
+
+    def test_catalogs_are_separate(self):
+        self._respond(tv(1, "/tv/Show.One"))
+        self.catalog.sync()
+
+        movies = RemoteCatalog("movie", URL, parse)
+        assert movies.needs_full_sync()
+        assert movies.paths() == dict()
@@ -1,10 +1,15 @@
+import os
+import time
 import pytest
 import mock
 import shlex
+import threading
 from pathlib import Path
-from subprocess import PIPE
+from subprocess import PIPE, DEVNULL
 from settings import ENCODER
 from utils import EncoderException
+from probe import ProbeResult, Stream
+from progress import EncodeProgress
 from convert import (
     checkVideoEncoding,
     _extractSubtitles,
@@ -14,40 +19,46 @@ from convert import (
     overwriteExistingFile,
     makeFileStreamable,
     encode,
+    _handleSubtitles,
     _reencodeVideo,
+    encodeThreadBudget,
+    _chooseScratchDirectory,
+    removeStaleScratch,
+    removeStaleSharedScratch,
+    _useChunkedEncode,
+    SkipProcessing,
+    runEncodeJobs,
+    reencodeFilesInDirectory,
+    AlreadyEncoded,
 )
 
 
 class TestCheckVideoEncoding:
     @pytest.fixture(autouse=True)
     def setUp(self, mocker):
-        self.mock_popen = mocker.patch("convert.Popen")
-
-        self.mock_log = mocker.patch("convert.log")
-
-        self.process = mock.MagicMock()
-        self.mock_popen.return_value = self.process
+        self.mock_probe = mocker.patch("convert.probe")
+        self.mock_get_probe_cache = mocker.patch("convert.get_probe_cache")
 
         self.source = "test.mkv"
 
     def test_bad_call(self):
-        self.process.communicate.return_value = ("stdout", INVALID_SAMPLE_OUTPUT)
+        self.mock_probe.side_effect = EncoderException("Bad file")
 
         with pytest.raises(EncoderException):
             checkVideoEncoding(source=self.source)
 
-        self.mock_popen.assert_called_once_with(
-            (ENCODER, "-hide_banner", "-i", self.source), stderr=PIPE
+        self.mock_probe.assert_called_once_with(
+            self.source, cache=self.mock_get_probe_cache.return_value
         )
-        self.mock_log.error.assert_called_once_with(INVALID_SAMPLE_OUTPUT.decode())
 
     def test_good_call(self):
-        self.process.communicate.return_value = ("stdout", VALID_SAMPLE_OUTPUT)
+        expected = self.mock_probe.return_value
+        actual = checkVideoEncoding(self.source)
 
-        vres, ares, sres, surround = checkVideoEncoding(self.source)
-        assert vres == 1
-        assert ares == 0
-        assert sres is not None
+        assert expected == actual
+        self.mock_probe.assert_called_once_with(
+            self.source, cache=self.mock_get_probe_cache.return_value
+        )
 
 
 class TestExtractSubtitles:
@@ -74,6 +85,55 @@ class TestExtractSubtitles:
         self.mock_convertSrtToVtt.assert_called_once_with(expected_srt)
 
 
+class TestHandleSubtitles:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.mock_extractSubtitles = mocker.patch("convert._extractSubtitles")
+        mocker.patch("convert.MEDIAVIEWER_SUFFIX", "suffix.mp4")
+
+        self.source = temp_directory / "file.mkv"
+        self.dest = Path("/scratch/file.mp4")
+        self.probe_result = ProbeResult(
+            streams=(
+                Stream(
+                    index=2, codec_type="subtitle", codec_name="subrip", language="eng"
+                ),
+                Stream(
+                    index=3,
+                    codec_type="subtitle",
+                    codec_name="hdmv_pgs_subtitle",
+                    language="eng",
+                ),
+                Stream(
+                    index=4, codec_type="subtitle", codec_name="ass", language="eng"
+                ),
+            )
+        )
+
+    def test_extract_embedded(self, temp_directory):
+        actual = _handleSubtitles(self.source, self.dest, self.probe_result)
+
+        assert actual == 2
+        self.mock_extractSubtitles.assert_has_calls(
+            [
+                mock.call(
+                    self.source, temp_directory / "file.mp4.suffix.mp4-0.vtt", "0:2"
+                ),
+                mock.call(
+                    self.source, temp_directory / "file.mp4.suffix.mp4-1.vtt", "0:4"
+                ),
+            ]
+        )
+
+    def test_skip_embedded(self):
+        actual = _handleSubtitles(
+            self.source, self.dest, self.probe_result, extractEmbedded=False
+        )
+
+        assert actual == 0
+        assert not self.mock_extractSubtitles.called
+
+
 class TestExtractSubtitleFromVideo:
     @pytest.fixture(autouse=True)
     def setUp(self, mocker):
@@ -146,39 +206,23 @@ class TestExtractSubtitleFromVideo:
 class TestConvertSrtToVtt:
     @pytest.fixture(autouse=True)
     def setUp(self, mocker):
-        self.mock_popen = mocker.patch("convert.Popen")
-
-        self.mock_log = mocker.patch("convert.log")
-
-        self.process = mock.MagicMock()
-        self.process.communicate.return_value = ("vtt_stdout", "vtt_stderr")
-        self.process.returncode = 0
-
-        self.mock_popen.return_value = self.process
+        self.mock_convert_srt_to_vtt = mocker.patch("convert.convert_srt_to_vtt")
 
         self.srt_filename = Path("/path/to/file.srt")
 
     def test_success(self):
-        expected = Path("/path/to/file.vtt")
+        expected = self.mock_convert_srt_to_vtt.return_value
         actual = _convertSrtToVtt(self.srt_filename)
 
-        self.mock_popen.assert_called_once_with(
-            ["srt-vtt", "/path/to/file.srt"], stdin=PIPE, stdout=PIPE, stderr=PIPE
-        )
-        self.process.communicate.assert_called_once_with()
+        self.mock_convert_srt_to_vtt.assert_called_once_with(self.srt_filename)
         assert expected == actual
 
     def test_vtt_extract_failed(self):
-        self.process.returncode = 1
+        self.mock_convert_srt_to_vtt.side_effect = EncoderException("Failed")
 
         with pytest.raises(EncoderException):
             _convertSrtToVtt(self.srt_filename)
 
-        self.mock_popen.assert_called_once_with(
-            ["srt-vtt", "/path/to/file.srt"], stdin=PIPE, stdout=PIPE, stderr=PIPE
-        )
-        self.process.communicate.assert_called_once_with()
-
 
 class TouchFileMixin:
     @staticmethod
@@ -288,6 +332,11 @@ class TestMakeFileStreamable(TouchFileMixin):
 
         self.mock_encode = mocker.patch("convert.encode")
 
+        self.scratch_dir = self.temp_directory / "scratch"
+        self.scratch_dir.mkdir()
+        self.mock_mkdtemp = mocker.patch("convert.tempfile.mkdtemp")
+        self.mock_mkdtemp.return_value = str(self.scratch_dir)
+
         self.mock_overwriteExistingFile = mocker.patch("convert.overwriteExistingFile")
         self.mock_overwriteExistingFile.return_value = "the_final_destination"
 
@@ -304,15 +353,159 @@ class TestMakeFileStreamable(TouchFileMixin):
         assert res == "the_final_destination"
         self.mock_encode.assert_called_once_with(
             self.temp_directory / "this.is.a.file.mkv",
-            Path("/tmp/this.is.a.file.mp4"),
+            self.scratch_dir / "this.is.a.file.mp4",
             dryRun=dryRunSentinel,
+            threads=None,
         )
         self.mock_overwriteExistingFile.assert_called_once_with(
-            Path("/tmp/this.is.a.file.mp4"),
+            self.scratch_dir / "this.is.a.file.mp4",
             self.temp_directory,
             dryRun=dryRunSentinel,
             appendSuffix=appendSuffixSentinel,
         )
+        assert not self.scratch_dir.exists()
+
+    def test_scratch_dir_beside_original(self, mocker):
+        mocker.patch("convert.SCRATCH_STRATEGY", "sibling")
+        orig = self.temp_directory / "this.is.a.file.mkv"
+        self._touch_file(orig)
+
+        makeFileStreamable(orig)
+
+        self.mock_mkdtemp.assert_called_once_with(
+            prefix=".mc-scratch-", dir=self.temp_directory
+        )
+
+    def test_partial_encode_is_skipped(self):
+        scratch_dir = self.temp_directory / ".mc-scratch-abcd"
+        scratch_dir.mkdir()
+        orig = scratch_dir / "this.is.a.file.mp4"
+        self._touch_file(orig)
+
+        with pytest.raises(SkipProcessing):
+            makeFileStreamable(orig)
+
+        assert not self.mock_encode.called
+
+    def test_scratch_dir_removed_on_failure(self):
+        self.mock_encode.side_effect = EncoderException("Encoding failed")
+        orig = self.temp_directory / "this.is.a.file.mkv"
+        self._touch_file(orig)
+
+        with pytest.raises(EncoderException):
+            makeFileStreamable(orig)
+
+        assert not self.scratch_dir.exists()
+        assert orig.exists()
+
+
+class TestChooseScratchDirectory:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        self.scratch_dir = temp_directory / "scratch"
+        self.scratch_dir.mkdir()
+        mocker.patch("convert.SCRATCH_DIR", str(self.scratch_dir))
+        mocker.patch("convert.SCRATCH_FREE_SPACE_FACTOR", 1.0)
+        self.mock_log = mocker.patch("convert.log")
+
+        self.media_dir = temp_directory / "media"
+        self.media_dir.mkdir()
+        self.orig = self.media_dir / "file.mkv"
+        with open(self.orig, "wb") as f:
+            f.write(b"0" * 1000)
+
+        self.free_space = {self.media_dir: 10_000, self.scratch_dir: 10_000}
+        self.mock_disk_usage = mocker.patch("convert.shutil.disk_usage")
+        self.mock_disk_usage.side_effect = lambda path: mock.MagicMock(
+            free=self.free_space[path]
+        )
+
+    @pytest.mark.parametrize(
+        "strategy,expected",
+        (("sibling", "media"), ("dir", "scratch")),
+    )
+    def test_strategy(self, mocker, strategy, expected, temp_directory):
+        mocker.patch("convert.SCRATCH_STRATEGY", strategy)
+
+        assert temp_directory / expected == _chooseScratchDirectory(self.orig)
+
+    def test_tmp(self, mocker):
+        mocker.patch("convert.SCRATCH_STRATEGY", "tmp")
+
+        assert _chooseScratchDirectory(self.orig) is None
+        assert not self.mock_disk_usage.called
+
+    def test_falls_back_when_full(self, mocker):
+        mocker.patch("convert.SCRATCH_STRATEGY", "sibling")
+        self.free_space[self.media_dir] = 999
+
+        assert self.scratch_dir == _chooseScratchDirectory(self.orig)
+
+    def test_no_space(self, mocker):
+        mocker.patch("convert.SCRATCH_STRATEGY", "sibling")
+        self.free_space[self.media_dir] = 999
+        self.free_space[self.scratch_dir] = 999
+
+        with pytest.raises(EncoderException):
+            _chooseScratchDirectory(self.orig)
+
+    def test_no_scratch_dir(self, mocker):
+        mocker.patch("convert.SCRATCH_STRATEGY", "dir")
+        mocker.patch("convert.SCRATCH_DIR", "")
+
+        assert self.media_dir == _chooseScratchDirectory(self.orig)
+
+
+class TestRemoveStaleScratch:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.directory = temp_directory
+        self.scratch_dir = temp_directory / ".mc-scratch-abcd"
+        (self.scratch_dir / "file-chunks").mkdir(parents=True)
+        self.partial_file = self.scratch_dir / "file-chunks" / "chunk_00000.mkv"
+        self.partial_file.touch()
+
+        self.stale = time.time() - 7 * 3600
+        for path in (self.partial_file, self.scratch_dir / "file-chunks"):
+            os.utime(path, (self.stale, self.stale))
+
+    def test_fresh_scratch_is_kept(self):
+        assert removeStaleScratch(self.directory) == []
+        assert self.partial_file.exists()
+
+    def test_stale_scratch_is_removed(self):
+        os.utime(self.scratch_dir, (self.stale, self.stale))
+        (self.directory / "Show.S01E01.mkv").touch()
+
+        assert removeStaleScratch(self.directory) == [self.scratch_dir]
+        assert not self.scratch_dir.exists()
+        assert (self.directory / "Show.S01E01.mkv").exists()
+
+    def test_dry_run(self):
+        os.utime(self.scratch_dir, (self.stale, self.stale))
+
+        assert removeStaleScratch(self.directory, dryRun=True) == [self.scratch_dir]
+        assert self.partial_file.exists()
+
+    def test_still_written_scratch_is_kept(self):
+        os.utime(self.scratch_dir, (self.stale, self.stale))
+        self.partial_file.touch()
+
+        assert removeStaleScratch(self.directory) == []
+
+    def test_missing_directory(self):
+        assert removeStaleScratch(self.directory / "missing") == []
+
+    def test_shared_locations(self, mocker):
+        mocker.patch("convert.SCRATCH_DIR", "/scratch")
+        mocker.patch("convert.tempfile.gettempdir", return_value="/tmp")
+        mock_removeStaleScratch = mocker.patch("convert.removeStaleScratch")
+
+        removeStaleSharedScratch(dryRun=True)
+
+        mock_removeStaleScratch.assert_has_calls(
+            [mock.call("/scratch", dryRun=True), mock.call("/tmp", dryRun=True)]
+        )
 
 
 class TestEncode:
@@ -321,39 +514,118 @@ class TestEncode:
         self.mock_checkVideoEncoding = mocker.patch("convert.checkVideoEncoding")
 
         self.mock_handleSubtitles = mocker.patch("convert._handleSubtitles")
+        self.mock_handleSubtitles.return_value = 1
 
         self.mock_reencodeVideo = mocker.patch("convert._reencodeVideo")
 
-        self.mock_vres = mock.MagicMock()
-        self.mock_ares = mock.MagicMock()
-        self.mock_sres = mock.MagicMock()
-        self.mock_surround = mock.MagicMock()
+        self.mock_convertSrtToVtt = mocker.patch("convert._convertSrtToVtt")
+        self.mock_moveSubtitleFile = mocker.patch("convert._moveSubtitleFile")
 
-        self.mock_checkVideoEncoding.return_value = (
-            self.mock_vres,
-            self.mock_ares,
-            self.mock_sres,
-            self.mock_surround,
+        mocker.patch("convert.MEDIAVIEWER_SUFFIX", "suffix.mp4")
+
+        self.probe_result = ProbeResult(
+            streams=(
+                _video(),
+                _audio(),
+                Stream(
+                    index=2, codec_type="subtitle", codec_name="subrip", language="eng"
+                ),
+                Stream(
+                    index=3, codec_type="subtitle", codec_name="subrip", language="eng"
+                ),
+            )
         )
+        self.mock_checkVideoEncoding.return_value = self.probe_result
 
-    def test_(self):
-        dryRunSentinel = object()
+        self.source = Path("/path/to/file.mkv")
+        self.dest = Path("/scratch/file.mp4")
+
+    def test_single_pass(self, mocker):
+        mocker.patch("convert.SINGLE_PASS_ENCODE", True)
+
+        encode(self.source, self.dest, dryRun=False, threads=2)
+
+        self.mock_checkVideoEncoding.assert_called_once_with(self.source)
+        self.mock_handleSubtitles.assert_called_once_with(
+            self.source, self.dest, self.probe_result, extractEmbedded=False
+        )
+        self.mock_reencodeVideo.assert_called_once_with(
+            self.source,
+            self.dest,
+            self.probe_result,
+            dryRun=False,
+            threads=2,
+            subtitle_outputs=[
+                ("0:2", Path("/scratch/file.mp4-1.srt")),
+                ("0:3", Path("/scratch/file.mp4-2.srt")),
+            ],
+        )
+        self.mock_convertSrtToVtt.assert_has_calls(
+            [
+                mock.call(Path("/scratch/file.mp4-1.srt")),
+                mock.call(Path("/scratch/file.mp4-2.srt")),
+            ]
+        )
+        self.mock_moveSubtitleFile.assert_has_calls(
+            [
+                mock.call(
+                    self.mock_convertSrtToVtt.return_value,
+                    Path("/path/to/file.mp4.suffix.mp4-1.vtt"),
+                ),
+                mock.call(
+                    self.mock_convertSrtToVtt.return_value,
+                    Path("/path/to/file.mp4.suffix.mp4-2.vtt"),
+                ),
+            ]
+        )
 
-        source = "/path/to/file.mkv"
-        dest = "tmpfile.mp4"
+    def test_single_pass_dryRun(self, mocker):
+        mocker.patch("convert.SINGLE_PASS_ENCODE", True)
+
+        encode(self.source, self.dest, dryRun=True)
+
+        assert self.mock_reencodeVideo.called
+        assert not self.mock_convertSrtToVtt.called
+        assert not self.mock_moveSubtitleFile.called
+
+    def test_separate_passes(self, mocker):
+        mocker.patch("convert.SINGLE_PASS_ENCODE", False)
+        dryRunSentinel = object()
 
-        encode(source, dest, dryRun=dryRunSentinel)
+        encode(self.source, self.dest, dryRun=dryRunSentinel)
 
-        self.mock_checkVideoEncoding.assert_called_once_with(source)
-        self.mock_handleSubtitles.assert_called_once_with(source, dest, self.mock_sres)
+        self.mock_checkVideoEncoding.assert_called_once_with(self.source)
+        self.mock_handleSubtitles.assert_called_once_with(
+            self.source, self.dest, self.probe_result
+        )
         self.mock_reencodeVideo.assert_called_once_with(
-            source,
-            dest,
-            self.mock_vres,
-            self.mock_ares,
-            self.mock_surround,
+            self.source,
+            self.dest,
+            self.probe_result,
             dryRun=dryRunSentinel,
+            threads=None,
         )
+        assert not self.mock_convertSrtToVtt.called
+
+
+def _video(index=0, codec_name="h264", pix_fmt="yuv420p", **kwargs):
+    return Stream(
+        index=index,
+        codec_type="video",
+        codec_name=codec_name,
+        pix_fmt=pix_fmt,
+        **kwargs,
+    )
+
+
+def _audio(index=1, codec_name="aac", channels=2, **kwargs):
+    return Stream(
+        index=index,
+        codec_type="audio",
+        codec_name=codec_name,
+        channels=channels,
+        **kwargs,
+    )
 
 
 class TestReencodeVideo:
@@ -363,327 +635,471 @@ class TestReencodeVideo:
         self.mock_Popen.return_value.returncode = 0
 
         mocker.patch("convert.ENCODER", "test_encoder")
+        mocker.patch("convert.ENCODE_PROGRESS_INTERVAL", 10)
 
-    def test_small_vres_ares(self):
-        expected = None
-        actual = _reencodeVideo("test_source", "test_dest", True, True, False)
-
-        assert expected == actual
+    def _assert_command(self, command):
         self.mock_Popen.assert_called_once_with(
-            tuple(
-                shlex.split(
-                    "test_encoder -hide_banner -y -i test_source -c copy -pix_fmt yuv420p -movflags faststart test_dest"
-                )
-            ),
-            stdin=PIPE,
+            tuple(shlex.split(command)),
+            stdin=DEVNULL,
             stdout=PIPE,
             stderr=PIPE,
         )
 
-    def test_small_vres_no_ares(self):
+    def test_copy_video_copy_audio(self):
+        probe_result = ProbeResult(streams=(_video(), _audio()))
+
         expected = None
-        actual = _reencodeVideo("test_source", "test_dest", True, False, False)
+        actual = _reencodeVideo("test_source", "test_dest", probe_result)
 
         assert expected == actual
-        self.mock_Popen.assert_called_once_with(
-            tuple(
-                shlex.split(
-                    "test_encoder -hide_banner -y "
-                    "-i test_source -c:v copy -c:a libfdk_aac -pix_fmt yuv420p -movflags faststart test_dest"
-                )
-            ),
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=PIPE,
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 -map 0:1 "
+            "-c copy -pix_fmt yuv420p -movflags faststart test_dest"
         )
 
-    def test_small_no_vres_no_ares(self):
+    def test_copy_video_transcode_audio(self):
+        probe_result = ProbeResult(streams=(_video(), _audio(codec_name="ac3")))
+
         expected = None
-        actual = _reencodeVideo("test_source", "test_dest", False, False, False)
+        actual = _reencodeVideo("test_source", "test_dest", probe_result)
 
         assert expected == actual
-        self.mock_Popen.assert_called_once_with(
-            tuple(
-                shlex.split(
-                    "test_encoder -hide_banner -y "
-                    "-i test_source -c:v libx264 "
-                    "-c:a libfdk_aac -pix_fmt yuv420p -movflags faststart test_dest"
-                )
-            ),
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=PIPE,
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 -map 0:1 "
+            "-c:v copy -c:a libfdk_aac -pix_fmt yuv420p -movflags faststart test_dest"
         )
 
-    def test_large_vres_ares(self):
+    def test_copy_video_surround_audio(self):
+        probe_result = ProbeResult(streams=(_video(), _audio(channels=6)))
+
         expected = None
-        actual = _reencodeVideo("test_source", "test_dest", True, True, False)
+        actual = _reencodeVideo("test_source", "test_dest", probe_result)
 
         assert expected == actual
-        self.mock_Popen.assert_called_once_with(
-            tuple(
-                shlex.split(
-                    "test_encoder -hide_banner -y "
-                    "-i test_source -c copy -pix_fmt yuv420p -movflags faststart test_dest"
-                )
-            ),
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=PIPE,
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 -map 0:1 "
+            "-c:v copy -c:a libfdk_aac -ac 2 -pix_fmt yuv420p -movflags faststart test_dest"
         )
 
-    def test_large_vres_no_ares(self):
+    def test_transcode_video_copy_audio(self):
+        probe_result = ProbeResult(streams=(_video(codec_name="hevc"), _audio()))
+
         expected = None
-        actual = _reencodeVideo("test_source", "test_dest", True, False, False)
+        actual = _reencodeVideo("test_source", "test_dest", probe_result)
 
         assert expected == actual
-        self.mock_Popen.assert_called_once_with(
-            tuple(
-                shlex.split(
-                    "test_encoder -hide_banner -y "
-                    "-i test_source -c:v copy "
-                    "-c:a libfdk_aac -pix_fmt yuv420p -movflags faststart test_dest"
-                )
-            ),
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=PIPE,
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 -map 0:1 "
+            "-c:v libx264 -c:a copy -pix_fmt yuv420p -movflags faststart test_dest"
+        )
+
+    def test_transcode_10bit_video(self):
+        probe_result = ProbeResult(
+            streams=(_video(pix_fmt="yuv420p10le", profile="High 10"), _audio())
         )
 
-    def test_large_no_vres_no_ares(self):
         expected = None
-        actual = _reencodeVideo("test_source", "test_dest", False, False, False)
+        actual = _reencodeVideo("test_source", "test_dest", probe_result)
 
         assert expected == actual
-        self.mock_Popen.assert_called_once_with(
-            tuple(
-                shlex.split(
-                    "test_encoder -hide_banner -y "
-                    "-i test_source "
-                    "-c:v libx264 -c:a libfdk_aac -pix_fmt yuv420p -movflags faststart test_dest"
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 -map 0:1 "
+            "-c:v libx264 -c:a copy -pix_fmt yuv420p -movflags faststart test_dest"
+        )
+
+    def test_transcode_video_transcode_audio(self):
+        probe_result = ProbeResult(
+            streams=(_video(codec_name="hevc"), _audio(codec_name="dts", channels=6))
+        )
+
+        expected = None
+        actual = _reencodeVideo("test_source", "test_dest", probe_result)
+
+        assert expected == actual
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 -map 0:1 "
+            "-c:v libx264 -c:a libfdk_aac -ac 2 -pix_fmt yuv420p -movflags faststart test_dest"
+        )
+
+    def test_prefers_copyable_alternate_audio(self):
+        probe_result = ProbeResult(
+            streams=(
+                _video(),
+                _audio(
+                    index=1,
+                    codec_name="ac3",
+                    channels=6,
+                    language="eng",
+                    disposition={"default": True},
+                ),
+                _audio(index=2, language="eng"),
+            )
+        )
+
+        expected = None
+        actual = _reencodeVideo("test_source", "test_dest", probe_result)
+
+        assert expected == actual
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 -map 0:2 "
+            "-c copy -pix_fmt yuv420p -movflags faststart test_dest"
+        )
+
+    def test_threads(self):
+        probe_result = ProbeResult(streams=(_video(codec_name="hevc"), _audio()))
+
+        expected = None
+        actual = _reencodeVideo("test_source", "test_dest", probe_result, threads=4)
+
+        assert expected == actual
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 -map 0:1 "
+            "-c:v libx264 -c:a copy -threads 4 -pix_fmt yuv420p -movflags faststart test_dest"
+        )
+
+    def test_subtitle_outputs(self):
+        probe_result = ProbeResult(streams=(_video(), _audio()))
+
+        expected = None
+        actual = _reencodeVideo(
+            "test_source",
+            "test_dest",
+            probe_result,
+            subtitle_outputs=[("0:2", "test_dest-0.srt"), ("0:4", "test_dest-1.srt")],
+        )
+
+        assert expected == actual
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 -map 0:1 "
+            "-c copy -pix_fmt yuv420p -movflags faststart test_dest "
+            "-map 0:2 -c:s srt test_dest-0.srt "
+            "-map 0:4 -c:s srt test_dest-1.srt"
+        )
+
+    def test_failure_removes_outputs(self, temp_directory):
+        self.mock_Popen.return_value.returncode = 1
+        probe_result = ProbeResult(streams=(_video(), _audio()))
+        dest = temp_directory / "test_dest.mp4"
+        srt_path = temp_directory / "test_dest.mp4-0.srt"
+        dest.touch()
+        srt_path.touch()
+
+        with pytest.raises(EncoderException):
+            _reencodeVideo(
+                "test_source",
+                dest,
+                probe_result,
+                subtitle_outputs=[("0:2", srt_path)],
+            )
+
+        assert not dest.exists()
+        assert not srt_path.exists()
+
+    def test_encoding_profile(self, mocker):
+        mocker.patch(
+            "profiles.ENCODING_PROFILES",
+            [
+                {"name": "hd", "match": {"min_height": 720}, "crf": 18},
+                {"name": "default", "match": {}, "preset": "fast", "threads": 3},
+            ],
+        )
+        probe_result = ProbeResult(streams=(_video(codec_name="hevc"), _audio()))
+
+        _reencodeVideo("test_source", "test_dest", probe_result, threads=8)
+
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 -map 0:1 "
+            "-c:v libx264 -preset fast -c:a copy -threads 3 "
+            "-pix_fmt yuv420p -movflags faststart test_dest"
+        )
+
+    def test_progress_callback(self):
+        self.mock_Popen.return_value.stdout = [
+            b"out_time=00:00:05.000000\n",
+            b"speed=2.0x\n",
+            b"progress=end\n",
+        ]
+        progress_callback = mock.MagicMock()
+        probe_result = ProbeResult(streams=(_video(), _audio()))
+
+        _reencodeVideo(
+            "test_source",
+            "test_dest",
+            probe_result,
+            progress_callback=progress_callback,
+        )
+
+        progress_callback.assert_called_once_with(
+            EncodeProgress(out_time=5.0, speed=2.0, done=True)
+        )
+
+    def test_failure_logs_stderr_tail(self, mocker, temp_directory):
+        mocker.patch("convert.ENCODE_STDERR_TAIL_BYTES", 12)
+        mock_log = mocker.patch("convert.log")
+        self.mock_Popen.return_value.returncode = 1
+        self.mock_Popen.return_value.stderr = [b"lots of noise\n", b"Bad input\n"]
+        probe_result = ProbeResult(streams=(_video(), _audio()))
+
+        with pytest.raises(EncoderException):
+            _reencodeVideo("test_source", temp_directory / "dest.mp4", probe_result)
+
+        mock_log.error.assert_called_once_with("e\nBad input\n")
+
+    def test_video_only(self):
+        probe_result = ProbeResult(streams=(_video(),))
+
+        expected = None
+        actual = _reencodeVideo("test_source", "test_dest", probe_result)
+
+        assert expected == actual
+        self._assert_command(
+            "test_encoder -hide_banner -y "
+            "-nostats -progress pipe:1 -stats_period 10 -i test_source -map 0:0 "
+            "-c copy -pix_fmt yuv420p -movflags faststart test_dest"
+        )
+
+
+class TestEncodeChunked:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker, temp_directory):
+        mocker.patch("convert.ENCODER", "test_encoder")
+        mocker.patch("convert.CHUNKED_ENCODE_MIN_DURATION", 600)
+        mocker.patch("convert.CHUNKED_ENCODE_SEGMENT_SECONDS", 60)
+        mocker.patch("convert.CHUNKED_ENCODE_WORKERS", 2)
+        mocker.patch("convert.MAX_PARALLEL_ENCODES", 1)
+        self.mock_log = mocker.patch("convert.log")
+
+        self.dest = temp_directory / "test_dest.mp4"
+        self.work_dir = temp_directory / "test_dest-chunks"
+        self.commands = []
+
+        def _runEncoder(command, progress_callback=None):
+            self.commands.append(command)
+            if "segment" in command:
+                for i in range(3):
+                    (self.work_dir / f"chunk_{i:05d}.mkv").touch()
+            return self.returncode, "stderr"
+
+        self.returncode = 0
+        self.mock_runEncoder = mocker.patch("convert._runEncoder")
+        self.mock_runEncoder.side_effect = _runEncoder
+
+        self.probe_result = ProbeResult(
+            streams=(_video(codec_name="hevc"), _audio(channels=6)),
+            duration=3600.0,
+        )
+
+    @pytest.mark.parametrize(
+        "duration,codec_name,expected",
+        (
+            (3600.0, "hevc", True),
+            (599.0, "hevc", False),
+            (None, "hevc", False),
+            (3600.0, "h264", False),
+        ),
+    )
+    def test_useChunkedEncode(self, duration, codec_name, expected):
+        probe_result = ProbeResult(
+            streams=(_video(codec_name=codec_name),), duration=duration
+        )
+
+        assert expected == _useChunkedEncode(probe_result)
+
+    def test_disabled(self, mocker):
+        mocker.patch("convert.CHUNKED_ENCODE_MIN_DURATION", 0)
+
+        assert not _useChunkedEncode(self.probe_result)
+
+    def test_encode_chunked(self):
+        _reencodeVideo(
+            "test_source",
+            self.dest,
+            self.probe_result,
+            threads=8,
+            subtitle_outputs=[("0:2", "test_dest-0.srt")],
+        )
+
+        split, *jobs, concat = self.commands
+        assert split == tuple(
+            shlex.split(
+                "test_encoder -hide_banner -y -i test_source -map 0:0 -c copy "
+                "-f segment -segment_time 60 -reset_timestamps 1 "
+                f"{self.work_dir}/chunk_%05d.mkv"
+            )
+        )
+        assert sorted(jobs) == sorted(
+            [
+                tuple(
+                    shlex.split(
+                        "test_encoder -hide_banner -y -i test_source -map 0:1 -vn "
+                        f"-c:a libfdk_aac -ac 2 {self.work_dir}/audio.m4a "
+                        "-map 0:2 -c:s srt test_dest-0.srt"
+                    )
                 )
-            ),
-            stdin=PIPE,
-            stdout=PIPE,
-            stderr=PIPE,
+            ]
+            + [
+                tuple(
+                    shlex.split(
+                        f"test_encoder -hide_banner -y -i {self.work_dir}/chunk_{i:05d}.mkv "
+                        "-map 0:v -c:v libx264 -threads 4 -pix_fmt yuv420p "
+                        f"{self.work_dir}/encoded_chunk_{i:05d}.mkv"
+                    )
+                )
+                for i in range(3)
+            ]
+        )
+        assert concat == tuple(
+            shlex.split(
+                "test_encoder -hide_banner -y -f concat -safe 0 "
+                f"-i {self.work_dir}/chunks.txt -i {self.work_dir}/audio.m4a "
+                f"-map 0:v -map 1:a -c copy -movflags faststart {self.dest}"
+            )
+        )
+        assert not self.work_dir.exists()
+
+    def test_chunk_failure(self):
+        def _runEncoder(command, progress_callback=None):
+            if "segment" in command:
+                for i in range(3):
+                    (self.work_dir / f"chunk_{i:05d}.mkv").touch()
+            elif str(self.work_dir / "chunk_00001.mkv") in command:
+                return 1, "stderr"
+            return 0, ""
+
+        self.mock_runEncoder.side_effect = _runEncoder
+        self.dest.touch()
+
+        with pytest.raises(EncoderException):
+            _reencodeVideo("test_source", self.dest, self.probe_result)
+
+        assert not self.dest.exists()
+        assert not self.work_dir.exists()
+
+    def test_dryRun(self):
+        _reencodeVideo("test_source", self.dest, self.probe_result, dryRun=True)
+
+        assert not self.mock_runEncoder.called
+        assert not self.work_dir.exists()
+
+
+class TestEncodeThreadBudget:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("convert.os.cpu_count", return_value=32)
+
+    @pytest.mark.parametrize(
+        "max_parallel,expected",
+        ((1, 32), (4, 8), (5, 6), (64, 1), (0, 32)),
+    )
+    def test_budget(self, max_parallel, expected):
+        assert expected == encodeThreadBudget(max_parallel)
+
+
+@pytest.mark.parametrize("max_parallel", (1, 4))
+class TestRunEncodeJobs:
+    def test_results_in_order(self, max_parallel):
+        def _job(item):
+            if item == 2:
+                raise EncoderException("bad file")
+            return item * 10
+
+        results = list(runEncodeJobs(_job, [1, 2, 3], max_parallel=max_parallel))
+
+        assert [(x[0], x[1]) for x in results] == [(1, 10), (2, None), (3, 30)]
+        assert results[0][2] is None
+        assert isinstance(results[1][2], EncoderException)
+        assert results[2][2] is None
+
+    def test_runs_concurrently(self, max_parallel):
+        barrier = threading.Barrier(max_parallel, timeout=5)
+
+        def _job(item):
+            barrier.wait()
+            return threading.get_ident()
+
+        results = list(
+            runEncodeJobs(_job, range(max_parallel), max_parallel=max_parallel)
+        )
+
+        assert len(set(x[1] for x in results)) == max_parallel
+
+
+class TestReencodeFilesInDirectory:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("convert.MAX_PARALLEL_ENCODES", 3)
+        mocker.patch("convert.os.cpu_count", return_value=6)
+        mocker.patch("convert.stripUnicode", side_effect=lambda x: x)
+        mocker.patch("convert.normalize_paths", side_effect=list)
+        self.mock_log = mocker.patch("convert.log")
+
+        self.mock_getFilesInDirectory = mocker.patch("convert._getFilesInDirectory")
+        self.mock_getFilesInDirectory.return_value = [
+            "/path/to/movie/movie.mkv",
+            "/path/to/movie/movie.srt",
+            "/path/to/movie/extra.mkv",
+            "/path/to/movie/movie.mkv.mv-encoded.mp4",
+        ]
+
+        self.mock_makeFileStreamable = mocker.patch("convert.makeFileStreamable")
+        self.mock_removeStaleScratch = mocker.patch("convert.removeStaleScratch")
+        self.mock_estimate_cost = mocker.patch("convert.estimate_cost")
+        self.mock_estimate_cost.return_value = None
+
+    def test_errors_are_collected(self):
+        def _makeFileStreamable(path, **kwargs):
+            if path.endswith("extra.mkv"):
+                raise EncoderException("Encoding failed")
+            if "mv-encoded" in path:
+                raise AlreadyEncoded("Already encoded")
+            return path
+
+        self.mock_makeFileStreamable.side_effect = _makeFileStreamable
+
+        expected = ["/path/to/movie/extra.mkv"]
+        actual = reencodeFilesInDirectory("/path/to/movie")
+
+        assert expected == actual
+        assert self.mock_makeFileStreamable.call_count == 3
+        self.mock_removeStaleScratch.assert_called_once_with(
+            Path("/path/to/movie"), dryRun=False
+        )
+        self.mock_makeFileStreamable.assert_any_call(
+            "/path/to/movie/movie.mkv",
+            appendSuffix=True,
+            removeOriginal=True,
+            dryRun=False,
+            threads=2,
         )
 
+    def test_cheapest_first(self, mocker):
+        mocker.patch("convert.MAX_PARALLEL_ENCODES", 1)
+        estimates = {
+            "/path/to/movie/movie.mkv": 9000.0,
+            "/path/to/movie/extra.mkv": 300.0,
+        }
+        self.mock_estimate_cost.side_effect = estimates.get
+
+        reencodeFilesInDirectory("/path/to/movie")
+
+        assert [x.args[0] for x in self.mock_makeFileStreamable.call_args_list] == [
+            "/path/to/movie/extra.mkv",
+            "/path/to/movie/movie.mkv",
+            "/path/to/movie/movie.mkv.mv-encoded.mp4",
+        ]
+
+    def test_unexpected_error_is_raised(self):
+        self.mock_makeFileStreamable.side_effect = ValueError("Oh no!")
 
-VALID_SAMPLE_OUTPUT = b"""
-Input #0, matroska,webm, from '/tmp/test.mkv':
-  Metadata:
-    title           : Test
-    encoder         : libebml v1.2.3 + libmatroska v1.3.0
-    creation_time   : 2014-08-07 14:15:22
-  Duration: 01:29:23.00, start: 0.000000, bitrate: 1753 kb/s
-    Chapter #0:0: start 0.000000, end 217.280000
-    Metadata:
-      title           : Test
-    Chapter #0:1: start 217.280000, end 368.840000
-    Metadata:
-      title           : Test
-    Chapter #0:2: start 368.840000, end 527.240000
-    Metadata:
-      title           : Test
-    Chapter #0:3: start 527.240000, end 723.560000
-    Metadata:
-      title           : Test
-    Chapter #0:4: start 723.560000, end 948.680000
-    Metadata:
-      title           : Test
-    Chapter #0:5: start 948.680000, end 1163.360000
-    Metadata:
-      title           : Test
-    Chapter #0:6: start 1163.360000, end 1354.280000
-    Metadata:
-      title           : Test
-    Chapter #0:7: start 1354.280000, end 1438.280000
-    Metadata:
-      title           : Test
-    Chapter #0:8: start 1438.280000, end 1623.160000
-    Metadata:
-      title           : Test
-    Chapter #0:9: start 1623.160000, end 1988.920000
-    Metadata:
-      title           : Test
-    Chapter #0:10: start 1988.920000, end 2116.120000
-    Metadata:
-      title           : Test
-    Chapter #0:11: start 2116.120000, end 2220.760000
-    Metadata:
-      title           : Test
-    Chapter #0:12: start 2220.760000, end 2414.200000
-    Metadata:
-      title           : Test
-    Chapter #0:13: start 2414.200000, end 2709.520000
-    Metadata:
-      title           : Test
-    Chapter #0:14: start 2709.520000, end 2753.000000
-    Metadata:
-      title           : Test
-    Chapter #0:15: start 2753.000000, end 2955.200000
-    Metadata:
-      title           : Test
-    Chapter #0:16: start 2955.200000, end 3149.600000
-    Metadata:
-      title           : Test
-    Chapter #0:17: start 3149.600000, end 3394.000000
-    Metadata:
-      title           : Test
-    Chapter #0:18: start 3394.000000, end 3454.800000
-    Metadata:
-      title           : Test
-    Chapter #0:19: start 3454.800000, end 3708.200000
-    Metadata:
-      title           : Test
-    Chapter #0:20: start 3708.200000, end 3864.760000
-    Metadata:
-      title           : Test
-    Chapter #0:21: start 3864.760000, end 4143.920000
-    Metadata:
-      title           : Test
-    Chapter #0:22: start 4143.920000, end 4184.520000
-    Metadata:
-      title           : Test
-    Chapter #0:23: start 4184.520000, end 4339.160000
-    Metadata:
-      title           : Test
-    Chapter #0:24: start 4339.160000, end 4614.720000
-    Metadata:
-      title           : Test
-    Chapter #0:25: start 4614.720000, end 4865.520000
-    Metadata:
-      title           : Test
-    Chapter #0:26: start 4865.520000, end 5181.960000
-    Metadata:
-      title           : Test
-    Chapter #0:27: start 5181.960000, end 5363.000000
-    Metadata:
-      title           : Test
-    Stream #0:0(eng): Video: h264 (High), yuv420p, 668x404 [SAR 1:1 DAR 167:101], 25 fps, 25 tbr, 1k tbn, 50 tbc (default)
-    Metadata:
-      title           : Test
-    Stream #0:1(eng): Audio: ac3, 48000 Hz, 5.0(side), fltp, 448 kb/s (default)
-    Metadata:
-      title           : English AC3 5.1 448 kbps
-    Stream #0:2(ita): Subtitle: subrip (default)
-    Metadata:
-      title           : Sottotitoli SRT - Italiano
-    Stream #0:3(eng): Subtitle: subrip
-    Metadata:
-      title           : Subtitle SRT - English
-    Stream #0:4(spa): Subtitle: subrip
-    Metadata:
-      title           : Subtitle SRT - Spanish
-At least one output file must be specified
-"""
-
-INVALID_SAMPLE_OUTPUT = b"""
-Input #0, matroska,webm, from '/tmp/test.mkv':
-  Metadata:
-    title           : Test
-    encoder         : libebml v1.2.3 + libmatroska v1.3.0
-    creation_time   : 2014-08-07 14:15:22
-  Duration: 01:29:23.00, start: 0.000000, bitrate: 1753 kb/s
-    Chapter #0:0: start 0.000000, end 217.280000
-    Metadata:
-      title           : Test
-    Chapter #0:1: start 217.280000, end 368.840000
-    Metadata:
-      title           : Test
-    Chapter #0:2: start 368.840000, end 527.240000
-    Metadata:
-      title           : Test
-    Chapter #0:3: start 527.240000, end 723.560000
-    Metadata:
-      title           : Test
-    Chapter #0:4: start 723.560000, end 948.680000
-    Metadata:
-      title           : Test
-    Chapter #0:5: start 948.680000, end 1163.360000
-    Metadata:
-      title           : Test
-    Chapter #0:6: start 1163.360000, end 1354.280000
-    Metadata:
-      title           : Test
-    Chapter #0:7: start 1354.280000, end 1438.280000
-    Metadata:
-      title           : Test
-    Chapter #0:8: start 1438.280000, end 1623.160000
-    Metadata:
-      title           : Test
-    Chapter #0:9: start 1623.160000, end 1988.920000
-    Metadata:
-      title           : Test
-    Chapter #0:10: start 1988.920000, end 2116.120000
-    Metadata:
-      title           : Test
-    Chapter #0:11: start 2116.120000, end 2220.760000
-    Metadata:
-      title           : Test
-    Chapter #0:12: start 2220.760000, end 2414.200000
-    Metadata:
-      title           : Test
-    Chapter #0:13: start 2414.200000, end 2709.520000
-    Metadata:
-      title           : Test
-    Chapter #0:14: start 2709.520000, end 2753.000000
-    Metadata:
-      title           : Test
-    Chapter #0:15: start 2753.000000, end 2955.200000
-    Metadata:
-      title           : Test
-    Chapter #0:16: start 2955.200000, end 3149.600000
-    Metadata:
-      title           : Test
-    Chapter #0:17: start 3149.600000, end 3394.000000
-    Metadata:
-      title           : Test
-    Chapter #0:18: start 3394.000000, end 3454.800000
-    Metadata:
-      title           : Test
-    Chapter #0:19: start 3454.800000, end 3708.200000
-    Metadata:
-      title           : Test
-    Chapter #0:20: start 3708.200000, end 3864.760000
-    Metadata:
-      title           : Test
-    Chapter #0:21: start 3864.760000, end 4143.920000
-    Metadata:
-      title           : Test
-    Chapter #0:22: start 4143.920000, end 4184.520000
-    Metadata:
-      title           : Test
-    Chapter #0:23: start 4184.520000, end 4339.160000
-    Metadata:
-      title           : Test
-    Chapter #0:24: start 4339.160000, end 4614.720000
-    Metadata:
-      title           : Test
-    Chapter #0:25: start 4614.720000, end 4865.520000
-    Metadata:
-      title           : Test
-    Chapter #0:26: start 4865.520000, end 5181.960000
-    Metadata:
-      title           : Test
-    Chapter #0:27: start 5181.960000, end 5363.000000
-    Metadata:
-      title           : Test
-    Stream #0:0(eng): Video: h264 (High), yuv420p, 668x404 [SAR 1:1 DAR 167:101], 25 fps, 25 tbr, 1k tbn, 50 tbc (default)
-    Metadata:
-      title           : Test
-    Stream #0:1(eng): Audio: ac3, 48000 Hz, 5.0(side), fltp, 448 kb/s (default)
-    Metadata:
-      title           : English AC3 5.1 448 kbps
-    Stream #0:2(ita): Subtitle: subrip (default)
-    Metadata:
-      title           : Sottotitoli SRT - Italiano
-    Stream #0:3(eng): Subtitle: subrip
-    Metadata:
-      title           : Subtitle SRT - English
-    Stream #0:4(spa): Subtitle: subrip
-    Metadata:
-      title           : Subtitle SRT - Spanish
-Stream map '0:s:3' matches no streams.
-To ignore this, add a trailing '?' to the map.
-"""
+        with pytest.raises(ValueError):
+            reencodeFilesInDirectory("/path/to/movie")
@@ -0,0 +1,92 @@
+import json
+import time
+import pytest
+import requests
+
+from requests.structures import CaseInsensitiveDict
+
+from http_cache import HttpCache
+
+URL = "https://mediaviewer/mediaviewer/api/tvmediapath/1/"
+BODY = {"pk": 1, "media_files": ["ep1.mp4", "ep2.mp4"]}
+
+
+def make_response(status_code=200, body=None, **headers):
+    response = requests.Response()
+    response.status_code = status_code
+    response.url = URL
+    response.headers = CaseInsensitiveDict(headers)
+    response._content = b"" if body is None else json.dumps(body).encode("utf-8")
+    return response
+
+
+class TestHttpCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self):
+        self.cache = HttpCache(max_entries=2, ttl=1)
+
+    def test_miss(self):
+        assert self.cache.get(URL) is None
+
+    def test_store_and_revalidate(self):
+        self.cache.store(
+            URL,
+            make_response(
+                body=BODY,
+                ETag='"abc"',
+                **{
+                    "Last-Modified": "Wed, 21 Oct 2026 07:28:00 GMT",
+                    "Content-Type": "application/json",
+                    "Set-Cookie": "secret",
+                },
+            ),
+        )
+
+        entry = self.cache.get(URL)
+        assert entry.validators() == {
+            "If-None-Match": '"abc"',
+            "If-Modified-Since": "Wed, 21 Oct 2026 07:28:00 GMT",
+        }
+        assert "Set-Cookie" not in entry.headers
+
+        response = self.cache.not_modified(entry, make_response(304))
+        assert response.status_code == 200
+        assert response.json() == BODY
+        assert response.headers["Content-Type"] == "application/json"
+        assert (self.cache.hits, self.cache.misses) == (1, 1)
+
+    def test_responses_without_validators_are_not_stored(self):
+        self.cache.store(URL, make_response(body=BODY))
+
+        assert self.cache.get(URL) is None
+        assert self.cache.misses == 1
+
+    def test_changed_response_replaces_entry(self):
+        self.cache.store(URL, make_response(body=BODY, ETag='"abc"'))
+        self.cache.store(URL, make_response(body={"pk": 1}, ETag='"def"'))
+
+        entry = self.cache.get(URL)
+        assert entry.etag == '"def"'
+        assert entry.to_response().json() == {"pk": 1}
+
+    def test_expired(self):
+        self.cache.store(URL, make_response(body=BODY, ETag='"abc"'))
+        with self.cache._connect() as conn:
+            conn.execute("UPDATE responses SET stored_at=?", (time.time() - 7200,))
+
+        assert self.cache.get(URL) is None
+        assert len(self.cache) == 0
+
+    def test_invalidate(self):
+        self.cache.store(URL, make_response(body=BODY, ETag='"abc"'))
+        self.cache.invalidate(URL)
+
+        assert self.cache.get(URL) is None
+
+    def test_eviction(self):
+        for i in range(3):
+            self.cache.store(f"{URL}{i}/", make_response(body=BODY, ETag=f'"{i}"'))
+
+        assert len(self.cache) == 2
+        assert self.cache.get(f"{URL}0/") is None
+        assert self.cache.get(f"{URL}2/") is not None
@@ -0,0 +1,199 @@
+import os
+import time
+import pytest
+from pathlib import Path
+
+from utils import EncoderException
+from probe import ProbeResult, Stream
+from jobs import JobQueue, estimate_cost
+
+
+class TestJobQueue:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.temp_directory = temp_directory
+
+    def _enqueue(self, queue, name, size=1, mtime=None, **kwargs):
+        path = self.temp_directory / name
+        path.write_bytes(b"0" * size)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        queue.enqueue(path, **kwargs)
+        return path
+
+    def test_invalid_policy(self):
+        with pytest.raises(ValueError):
+            JobQueue(policy="random")
+
+    def test_enqueue(self):
+        queue = JobQueue()
+        path = self._enqueue(queue, "ep1.mkv", size=10, media_path_id=3, show="Show")
+
+        (job,) = queue.jobs()
+        assert job.path == path
+        assert job.media_path_id == 3
+        assert job.show == "Show"
+        assert job.size == 10
+        assert len(queue) == 1
+
+    def test_enqueue_twice_keeps_one_job(self):
+        queue = JobQueue()
+        self._enqueue(queue, "ep1.mkv", estimate=10.0)
+        self._enqueue(queue, "ep1.mkv", estimate=20.0)
+
+        (job,) = queue.jobs()
+        assert job.estimate == 20.0
+
+    def test_shortest_first(self):
+        queue = JobQueue(policy="shortest_first")
+        self._enqueue(queue, "movie.mkv", estimate=9000.0)
+        self._enqueue(queue, "unknown.mkv", size=5)
+        self._enqueue(queue, "ep1.mkv", estimate=1300.0)
+
+        assert [x.path.name for x in queue.drain()] == [
+            "ep1.mkv",
+            "movie.mkv",
+            "unknown.mkv",
+        ]
+
+    def test_newest_first(self):
+        queue = JobQueue(policy="newest_first")
+        self._enqueue(queue, "old.mkv", mtime=1000)
+        self._enqueue(queue, "new.mkv", mtime=3000)
+        self._enqueue(queue, "middle.mkv", mtime=2000)
+
+        assert [x.path.name for x in queue.drain()] == [
+            "new.mkv",
+            "middle.mkv",
+            "old.mkv",
+        ]
+
+    def test_complete(self):
+        queue = JobQueue()
+        self._enqueue(queue, "ep1.mkv")
+
+        job = queue.claim()
+        queue.complete(job)
+
+        assert queue.claim() is None
+        assert queue.jobs("running") == []
+
+    def test_fail_and_requeue(self):
+        queue = JobQueue()
+        self._enqueue(queue, "ep1.mkv")
+
+        queue.fail(queue.claim(), EncoderException("Encoding failed"))
+
+        (job,) = queue.jobs("failed")
+        assert job.error == "Encoding failed"
+        assert queue.claim() is None
+
+        self._enqueue(queue, "ep1.mkv")
+        assert queue.claim().path == job.path
+
+    def test_enqueue_does_not_reset_running_job(self):
+        queue = JobQueue()
+        self._enqueue(queue, "ep1.mkv")
+
+        job = queue.claim()
+        self._enqueue(queue, "ep1.mkv")
+
+        assert queue.jobs("running") == [job]
+        assert len(queue) == 0
+
+    def test_claim_records_owner(self):
+        queue = JobQueue(owner="worker:1")
+        self._enqueue(queue, "ep1.mkv")
+
+        assert queue.claim().owner == "worker:1"
+
+    def test_jobs_leased_elsewhere_are_left_alone(self):
+        self._enqueue(JobQueue(), "ep1.mkv")
+        JobQueue(owner="worker:1").claim()
+
+        assert list(JobQueue(owner="watcher:2").drain()) == []
+        assert [x.owner for x in JobQueue().jobs("running")] == ["worker:1"]
+
+    def test_expired_leases_are_recovered(self):
+        self._enqueue(JobQueue(), "ep1.mkv")
+        JobQueue(owner="worker:1", lease=60).claim()
+        with JobQueue()._connect() as conn:
+            conn.execute("UPDATE jobs SET heartbeat=?", (time.time() - 61,))
+
+        (job,) = JobQueue(owner="watcher:2", lease=60).drain()
+        assert job.path.name == "ep1.mkv"
+        assert job.owner == "watcher:2"
+
+    def test_renew(self):
+        queue = JobQueue(owner="worker:1", lease=60)
+        self._enqueue(queue, "ep1.mkv")
+        job = queue.claim()
+        with queue._connect() as conn:
+            conn.execute("UPDATE jobs SET heartbeat=?", (time.time() - 61,))
+
+        JobQueue(owner="watcher:2", lease=60).renew([job.id])
+        queue.renew([job.id])
+
+        assert list(JobQueue(owner="watcher:2", lease=60).drain()) == []
+
+    def test_abandon(self):
+        queue = JobQueue(owner="worker:1")
+        self._enqueue(queue, "ep1.mkv")
+        self._enqueue(queue, "ep2.mkv")
+        first, second = queue.claim(), queue.claim()
+        queue.complete(first)
+
+        queue.abandon()
+
+        (job,) = queue.jobs()
+        assert job.path == second.path
+        assert job.owner is None
+
+    def test_leases_renewed_in_background(self):
+        queue = JobQueue(owner="worker:1", lease=0.3)
+        self._enqueue(queue, "ep1.mkv")
+
+        job = queue.claim()
+        time.sleep(0.5)
+        assert list(JobQueue(owner="watcher:2", lease=0.3).drain()) == []
+
+        queue.complete(job)
+        time.sleep(0.2)
+        assert queue._renewer is None
+
+
+class TestEstimateCost:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_probe = mocker.patch("jobs.probe")
+
+    def test_transcode(self):
+        self.mock_probe.return_value = ProbeResult(
+            streams=(
+                Stream(index=0, codec_type="video", codec_name="hevc", height=2160),
+            ),
+            duration=1000.0,
+        )
+
+        assert estimate_cost(Path("test.mkv")) == 2000.0
+
+    def test_remux(self):
+        self.mock_probe.return_value = ProbeResult(
+            streams=(
+                Stream(
+                    index=0,
+                    codec_type="video",
+                    codec_name="h264",
+                    pix_fmt="yuv420p",
+                    height=1080,
+                ),
+            ),
+            duration=1000.0,
+        )
+
+        assert estimate_cost(Path("test.mkv")) == pytest.approx(20.0)
+
+    def test_unknown(self):
+        self.mock_probe.side_effect = EncoderException("Invalid data")
+
+        assert estimate_cost(Path("test.mkv")) is None
@@ -17,13 +17,13 @@ class TestPostMovies:
         movie_dir.mkdir(parents=True)
         mocker.patch("movie_runner.BASE_PATH", self.tmp_dir)
         mocker.patch("utils.requests")
-        self.mock_get_data = mocker.patch("movie_runner.get_data")
-        self.mock_response = mock.MagicMock()
-        self.mock_response.json.return_value = {
-            "results": [],
-            "next": "",
-        }
-        self.mock_get_data.return_value = self.mock_response
+        self.mock_get_all_pages = mocker.patch("movie_runner.get_all_pages")
+        self.mock_get_all_pages.return_value = [
+            {
+                "results": [],
+                "next": "",
+            }
+        ]
 
         mocker.patch("movie_runner.LOCAL_MOVIE_PATHS", [f"{self.tmp_dir}/movies"])
 
@@ -77,6 +77,17 @@ class TestPostMovies:
             ]
         )
 
+    def test_unsettled_movie_is_not_posted(self, mocker):
+        mocker.patch("movie_runner.MovieRunner.isSettled", return_value=False)
+        mock_post_media_path = mocker.patch("movie_runner.Movie.post_media_path")
+        localpath = Path(f"{self.tmp_dir}/movies/movie1")
+
+        self.movieRunner.postMovie(localpath)
+
+        assert not self.mock_reencodeFilesInDirectory.called
+        assert not mock_post_media_path.called
+        assert self.movieRunner.deferred == set([localpath])
+
     def test_reencodeErrors(self):
         self.mock_reencodeFilesInDirectory.side_effect = [
             ["test_error1"],
@@ -147,6 +158,12 @@ class TestRun:
     @pytest.fixture(autouse=True)
     def setUp(self, mocker):
         self.mock_postMovies = mocker.patch("movie_runner.MovieRunner.postMovies")
+        self.mock_removeStaleSharedScratch = mocker.patch(
+            "movie_runner.removeStaleSharedScratch"
+        )
+        self.mock_flush_infer_scrapers = mocker.patch(
+            "movie_runner.flush_infer_scrapers"
+        )
 
         self.mock_info = mocker.patch("movie_runner.log.info")
 
@@ -160,8 +177,18 @@ class TestRun:
 
         assert expected == actual
         self.mock_postMovies.assert_called_once_with(dry_run=False)
+        self.mock_removeStaleSharedScratch.assert_called_once_with(dryRun=False)
+        self.mock_flush_infer_scrapers.assert_called_once_with()
         self.mock_info.assert_called_once_with("Done running movies")
 
+    def test_scrapers_inferred_after_error(self):
+        self.mock_postMovies.side_effect = ValueError()
+
+        with pytest.raises(ValueError):
+            self.movieRunner.run()
+
+        self.mock_flush_infer_scrapers.assert_called_once_with()
+
 
 class TestPromoteSubtitles:
     @pytest.fixture(autouse=True)
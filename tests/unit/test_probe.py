@@ -0,0 +1,351 @@
+import json
+import sqlite3
+import pytest
+import mock
+from subprocess import PIPE
+
+from utils import EncoderException
+from probe import probe, ProbeCache, ProbeResult, Stream
+
+
+SAMPLE_PROBE_OUTPUT = {
+    "streams": [
+        {
+            "index": 0,
+            "codec_name": "h264",
+            "profile": "High",
+            "codec_type": "video",
+            "width": 668,
+            "height": 404,
+            "pix_fmt": "yuv420p",
+            "disposition": {"default": 1, "attached_pic": 0},
+            "tags": {"language": "eng"},
+        },
+        {
+            "index": 1,
+            "codec_name": "ac3",
+            "codec_type": "audio",
+            "channels": 6,
+            "bit_rate": "448000",
+            "disposition": {"default": 1},
+            "tags": {"language": "eng"},
+        },
+        {
+            "index": 2,
+            "codec_name": "subrip",
+            "codec_type": "subtitle",
+            "disposition": {"default": 1},
+            "tags": {"language": "ita"},
+        },
+        {
+            "index": 3,
+            "codec_name": "hdmv_pgs_subtitle",
+            "codec_type": "subtitle",
+            "disposition": {"default": 0},
+            "tags": {"language": "eng"},
+        },
+        {
+            "index": 4,
+            "codec_name": "subrip",
+            "codec_type": "subtitle",
+            "disposition": {"default": 0},
+            "tags": {"language": "eng"},
+        },
+        {
+            "index": 5,
+            "codec_name": "mjpeg",
+            "codec_type": "video",
+            "pix_fmt": "yuvj420p",
+            "disposition": {"default": 0, "attached_pic": 1},
+        },
+    ],
+    "format": {
+        "format_name": "matroska,webm",
+        "duration": "5363.000000",
+        "size": "1175000000",
+        "bit_rate": "1753000",
+    },
+}
+
+
+class TestProbeResult:
+    @pytest.fixture(autouse=True)
+    def setUp(self):
+        self.probe_result = ProbeResult.from_ffprobe(SAMPLE_PROBE_OUTPUT)
+
+    def test_format(self):
+        assert self.probe_result.format_name == "matroska,webm"
+        assert self.probe_result.duration == 5363.0
+        assert self.probe_result.size == 1175000000
+        assert self.probe_result.bit_rate == 1753000
+
+    def test_streams(self):
+        assert len(self.probe_result.streams) == 6
+        assert self.probe_result.audio_streams[0] == Stream(
+            index=1,
+            codec_type="audio",
+            codec_name="ac3",
+            channels=6,
+            language="eng",
+            bit_rate=448000,
+            disposition={"default": True},
+        )
+
+    def test_attached_pic_is_ignored(self):
+        assert [x.index for x in self.probe_result.video_streams] == [0]
+        assert self.probe_result.video_stream.index == 0
+
+    def test_copy_decisions(self):
+        assert self.probe_result.can_copy_video
+        assert not self.probe_result.can_copy_audio
+        assert self.probe_result.audio_stream.is_surround
+
+    def test_english_text_subtitles(self):
+        assert [x.identifier for x in self.probe_result.english_subtitle_streams] == [
+            "0:4"
+        ]
+
+    def test_empty(self):
+        probe_result = ProbeResult.from_ffprobe({})
+
+        assert probe_result.video_stream is None
+        assert probe_result.audio_stream is None
+        assert not probe_result.can_copy_video
+        assert not probe_result.can_copy_audio
+
+
+def audio(index, codec_name="aac", channels=2, language="eng", **kwargs):
+    disposition = {key: True for key, val in kwargs.pop("disposition", {}).items()}
+    return Stream(
+        index=index,
+        codec_type="audio",
+        codec_name=codec_name,
+        channels=channels,
+        language=language,
+        disposition=disposition,
+        **kwargs,
+    )
+
+
+class TestAudioStream:
+    def test_default_can_be_copied(self):
+        probe_result = ProbeResult(
+            streams=(audio(1, disposition={"default": 1}), audio(2))
+        )
+
+        assert probe_result.audio_stream.index == 1
+
+    def test_copyable_main_mix_is_preferred(self):
+        probe_result = ProbeResult(
+            streams=(
+                audio(1, codec_name="dts", channels=6, disposition={"default": 1}),
+                audio(2),
+            )
+        )
+
+        assert probe_result.audio_stream.index == 2
+        assert probe_result.can_copy_audio
+
+    def test_other_language_is_not_swapped_in(self):
+        probe_result = ProbeResult(
+            streams=(
+                audio(1, codec_name="dts", channels=6, disposition={"default": 1}),
+                audio(2, language="spa"),
+            )
+        )
+
+        assert probe_result.audio_stream.index == 1
+        assert not probe_result.can_copy_audio
+
+    @pytest.mark.parametrize(
+        "kwargs",
+        (
+            {"disposition": {"comment": 1}},
+            {"disposition": {"hearing_impaired": 1}},
+            {"disposition": {"visual_impaired": 1}},
+            {"title": "Director's Commentary"},
+            {"title": "English - Audio Description"},
+        ),
+    )
+    def test_secondary_tracks_are_not_swapped_in(self, kwargs):
+        probe_result = ProbeResult(
+            streams=(
+                audio(1, codec_name="dts", channels=6, disposition={"default": 1}),
+                audio(2, **kwargs),
+            )
+        )
+
+        assert probe_result.audio_stream.index == 1
+        assert not probe_result.can_copy_audio
+
+    def test_main_mix_is_picked_over_commentary_without_default(self):
+        probe_result = ProbeResult(
+            streams=(
+                audio(1, disposition={"comment": 1}),
+                audio(2, codec_name="ac3", channels=6),
+                audio(3),
+            )
+        )
+
+        assert probe_result.audio_stream.index == 3
+
+    def test_only_commentary(self):
+        probe_result = ProbeResult(streams=(audio(1, disposition={"comment": 1}),))
+
+        assert probe_result.audio_stream.index == 1
+
+    def test_title_from_ffprobe(self):
+        stream = Stream.from_ffprobe(
+            {
+                "index": 2,
+                "codec_type": "audio",
+                "tags": {"title": "Commentary"},
+                "disposition": {"comment": 0},
+            }
+        )
+
+        assert stream.title == "Commentary"
+        assert stream.is_alternate_audio
+
+
+class TestProbe:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_popen = mocker.patch("probe.Popen")
+        mocker.patch("probe.FFPROBE", "test_ffprobe")
+
+        self.mock_log = mocker.patch("probe.log")
+
+        self.process = mock.MagicMock()
+        self.process.returncode = 0
+        self.process.communicate.return_value = (
+            json.dumps(SAMPLE_PROBE_OUTPUT).encode("utf-8"),
+            b"",
+        )
+        self.mock_popen.return_value = self.process
+
+        self.source = "test.mkv"
+
+    def test_good_call(self):
+        expected = ProbeResult.from_ffprobe(SAMPLE_PROBE_OUTPUT)
+        actual = probe(self.source)
+
+        assert expected == actual
+        self.mock_popen.assert_called_once_with(
+            (
+                "test_ffprobe",
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                "-print_format",
+                "json",
+                "-show_streams",
+                "-show_format",
+                self.source,
+            ),
+            stdout=PIPE,
+            stderr=PIPE,
+        )
+
+    def test_bad_call(self):
+        self.process.returncode = 1
+        self.process.communicate.return_value = (b"", b"test.mkv: Invalid data")
+
+        with pytest.raises(EncoderException):
+            probe(self.source)
+
+        self.mock_log.error.assert_called_once_with(b"test.mkv: Invalid data")
+
+    def test_bad_output(self):
+        self.process.communicate.return_value = (b"not json", b"")
+
+        with pytest.raises(EncoderException):
+            probe(self.source)
+
+
+class TestProbeCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.cache = ProbeCache(max_entries=2)
+
+        self.source = temp_directory / "test.mkv"
+        self.source.write_bytes(b"0" * 100)
+
+    def test_miss(self):
+        assert self.cache.get(self.source) is None
+
+    def test_hit(self):
+        self.cache.set(self.source, SAMPLE_PROBE_OUTPUT)
+
+        assert self.cache.get(self.source) == SAMPLE_PROBE_OUTPUT
+
+    def test_modified_file_is_a_miss(self):
+        self.cache.set(self.source, SAMPLE_PROBE_OUTPUT)
+        self.source.write_bytes(b"0" * 200)
+
+        assert self.cache.get(self.source) is None
+        assert len(self.cache) == 0
+
+    def test_invalidate(self):
+        self.cache.set(self.source, SAMPLE_PROBE_OUTPUT)
+        self.cache.invalidate(self.source)
+
+        assert self.cache.get(self.source) is None
+
+    def test_invalidate_deleted_file(self):
+        self.cache.set(self.source, SAMPLE_PROBE_OUTPUT)
+        self.source.unlink()
+        self.cache.invalidate(self.source)
+
+        assert len(self.cache) == 0
+
+    def test_eviction(self, temp_directory):
+        sources = []
+        for i in range(3):
+            source = temp_directory / f"test{i}.mkv"
+            source.write_bytes(b"0" * i)
+            self.cache.set(source, {"streams": [], "format": {"size": str(i)}})
+            sources.append(source)
+
+        assert len(self.cache) == 2
+        assert self.cache.get(sources[0]) is None
+        assert self.cache.get(sources[2]) is not None
+
+
+class TestProbeWithCache:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_run_ffprobe = mocker.patch("probe._run_ffprobe")
+        self.mock_run_ffprobe.return_value = SAMPLE_PROBE_OUTPUT
+
+        self.cache = mock.MagicMock()
+
+    def test_cache_hit(self):
+        self.cache.get.return_value = SAMPLE_PROBE_OUTPUT
+
+        expected = ProbeResult.from_ffprobe(SAMPLE_PROBE_OUTPUT)
+        actual = probe("test.mkv", cache=self.cache)
+
+        assert expected == actual
+        assert not self.mock_run_ffprobe.called
+        assert not self.cache.set.called
+
+    def test_cache_miss(self):
+        self.cache.get.return_value = None
+
+        expected = ProbeResult.from_ffprobe(SAMPLE_PROBE_OUTPUT)
+        actual = probe("test.mkv", cache=self.cache)
+
+        assert expected == actual
+        self.mock_run_ffprobe.assert_called_once_with("test.mkv")
+        self.cache.set.assert_called_once_with("test.mkv", SAMPLE_PROBE_OUTPUT)
+
+    def test_broken_cache_falls_back_to_ffprobe(self):
+        self.cache.get.side_effect = sqlite3.OperationalError("database is locked")
+        self.cache.set.side_effect = sqlite3.OperationalError("database is locked")
+
+        expected = ProbeResult.from_ffprobe(SAMPLE_PROBE_OUTPUT)
+        actual = probe("test.mkv", cache=self.cache)
+
+        assert expected == actual
+        self.mock_run_ffprobe.assert_called_once_with("test.mkv")
@@ -0,0 +1,136 @@
+import pytest
+
+from probe import ProbeResult, Stream
+from profiles import (
+    EncodingProfile,
+    SourceProperties,
+    is_animation,
+    select_profile,
+)
+
+
+TEST_PROFILES = [
+    {
+        "name": "animation",
+        "match": {"animation": True},
+        "preset": "slow",
+        "crf": 20,
+        "tune": "animation",
+    },
+    {
+        "name": "uhd",
+        "match": {"min_height": 1440},
+        "preset": "fast",
+        "crf": 22,
+        "max_height": 1080,
+        "threads": 16,
+    },
+    {
+        "name": "short_low_bitrate",
+        "match": {"max_duration": 1800, "max_bitrate": 2_000_000},
+        "preset": "veryfast",
+    },
+    {
+        "name": "default",
+        "match": {},
+        "preset": "medium",
+        "crf": 21,
+        "extra_args": ["-profile:v", "high"],
+    },
+]
+
+
+class TestSelectProfile:
+    @pytest.mark.parametrize(
+        "properties,expected",
+        (
+            (SourceProperties(height=2160, animation=True), "animation"),
+            (SourceProperties(height=2160), "uhd"),
+            (SourceProperties(height=1080), "default"),
+            (
+                SourceProperties(height=480, bitrate=1_000_000, duration=1300),
+                "short_low_bitrate",
+            ),
+            (
+                SourceProperties(height=480, bitrate=3_000_000, duration=1300),
+                "default",
+            ),
+            (SourceProperties(height=480, duration=1300), "default"),
+            (SourceProperties(), "default"),
+        ),
+    )
+    def test_select_profile(self, properties, expected):
+        assert expected == select_profile(properties, TEST_PROFILES).name
+
+    def test_no_match(self):
+        profile = select_profile(SourceProperties(), TEST_PROFILES[:1])
+
+        assert profile.name == "default"
+        assert profile.video_args() == []
+
+    def test_invalid_criteria(self):
+        with pytest.raises(ValueError):
+            select_profile(SourceProperties(), [{"name": "bad", "match": {"fps": 1}}])
+
+
+class TestVideoArgs:
+    def test_all_args(self):
+        profile = EncodingProfile.from_dict(TEST_PROFILES[1])
+
+        assert profile.video_args() == [
+            "-preset",
+            "fast",
+            "-crf",
+            "22",
+            "-vf",
+            "scale=-2:'min(1080,ih)'",
+        ]
+
+    def test_extra_args(self):
+        profile = EncodingProfile.from_dict(TEST_PROFILES[3])
+
+        assert profile.video_args() == [
+            "-preset",
+            "medium",
+            "-crf",
+            "21",
+            "-profile:v",
+            "high",
+        ]
+
+
+class TestSourceProperties:
+    def test_from_probe(self):
+        probe_result = ProbeResult(
+            streams=(
+                Stream(index=0, codec_type="video", height=720, bit_rate=1_500_000),
+            ),
+            duration=1200.0,
+            bit_rate=1_800_000,
+        )
+
+        assert SourceProperties.from_probe(
+            probe_result, "/tv/Some.Show/Some.Show.S01E01.mkv"
+        ) == SourceProperties(
+            height=720, bitrate=1_500_000, duration=1200.0, animation=False
+        )
+
+    def test_falls_back_to_container_bitrate(self):
+        probe_result = ProbeResult(
+            streams=(Stream(index=0, codec_type="video", height=720),),
+            bit_rate=1_800_000,
+        )
+
+        assert SourceProperties.from_probe(probe_result).bitrate == 1_800_000
+
+    @pytest.mark.parametrize(
+        "tags,source,expected",
+        (
+            ({"genre": "Animation"}, None, True),
+            ({}, "/media/Anime/Some.Show/Some.Show.S01E01.mkv", True),
+            ({}, "/media/tv/Some.Show/Some.Show.S01E01.mkv", False),
+            ({"genre": "Drama"}, None, False),
+        ),
+    )
+    def test_is_animation(self, tags, source, expected):
+        assert expected == is_animation(ProbeResult(tags=tags), source)
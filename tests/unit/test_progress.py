@@ -0,0 +1,86 @@
+import pytest
+import mock
+
+from progress import EncodeProgress, OutputTail, parse_progress, progress_logger
+
+
+SAMPLE_PROGRESS_OUTPUT = [
+    b"frame=120\n",
+    b"fps=48.00\n",
+    b"stream_0_0_q=28.0\n",
+    b"bitrate= 512.3kbits/s\n",
+    b"total_size=262144\n",
+    b"out_time_us=5000000\n",
+    b"out_time_ms=5000000\n",
+    b"out_time=00:00:05.000000\n",
+    b"dup_frames=0\n",
+    b"drop_frames=0\n",
+    b"speed=1.92x\n",
+    b"progress=continue\n",
+    b"frame=240\n",
+    b"fps=N/A\n",
+    b"bitrate=N/A\n",
+    b"out_time_us=10000000\n",
+    b"speed=N/A\n",
+    b"progress=end\n",
+]
+
+
+class TestParseProgress:
+    def test_parse(self):
+        actual = list(parse_progress(SAMPLE_PROGRESS_OUTPUT))
+
+        assert actual == [
+            EncodeProgress(
+                frame=120,
+                fps=48.0,
+                bitrate_kbps=512.3,
+                total_size=262144,
+                out_time=5.0,
+                speed=1.92,
+                done=False,
+            ),
+            EncodeProgress(
+                frame=240,
+                out_time=10.0,
+                done=True,
+            ),
+        ]
+
+    def test_incomplete_block_is_ignored(self):
+        assert list(parse_progress([b"frame=1\n", b"garbage\n"])) == []
+
+    @pytest.mark.parametrize(
+        "out_time,duration,expected",
+        ((5.0, 20.0, 25.0), (30.0, 20.0, 100.0), (5.0, None, None), (None, 20, None)),
+    )
+    def test_percent(self, out_time, duration, expected):
+        assert expected == EncodeProgress(out_time=out_time).percent(duration)
+
+
+class TestOutputTail:
+    def test_keeps_tail(self):
+        tail = OutputTail(10)
+        tail.drain([b"line one\n", b"line two\n", b"three\n"])
+
+        assert tail.text() == "two\nthree\n"
+
+    def test_small_output(self):
+        tail = OutputTail(1024)
+        tail.drain([b"line one\n", "line two\n"])
+
+        assert tail.text() == "line one\nline two\n"
+
+
+class TestProgressLogger:
+    def test_logs_percent(self, mocker):
+        mock_log = mocker.patch("progress.log")
+
+        progress_logger("movie.mkv", duration=20.0)(
+            EncodeProgress(fps=48.0, out_time=5.0, speed=1.5, bitrate_kbps=100.0)
+        )
+
+        mock_log.info.assert_called_once_with(mock.ANY)
+        message = mock_log.info.call_args[0][0]
+        assert message.startswith("movie.mkv: 25.0% ")
+        assert "speed=1.5x" in message
@@ -0,0 +1,226 @@
+import os
+import time
+import pytest
+
+from scanner import (
+    scan_files,
+    open_for_writing,
+    DirectoryManifest,
+    DirectorySnapshot,
+    StabilityGate,
+)
+
+
+class TestScanFiles:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.root = temp_directory
+
+        for relative, size in (
+            ("Show's Name.S01E01.mkv", 300),
+            ("small.mkv", 10),
+            ("Show's Name.S01E01.srt", 300),
+            ("Season 1/Show.S01E02.MKV", 300),
+            ("Season 1/Extras/deep.mp4", 300),
+        ):
+            path = self.root / relative
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(b"0" * size)
+
+    def _names(self, **kwargs):
+        return sorted(entry.name for entry in scan_files(self.root, **kwargs))
+
+    def test_all_files(self):
+        assert self._names() == [
+            "Show's Name.S01E01.mkv",
+            "Show's Name.S01E01.srt",
+            "Show.S01E02.MKV",
+            "deep.mp4",
+            "small.mkv",
+        ]
+
+    @pytest.mark.parametrize(
+        "max_depth,expected",
+        (
+            (1, 3),
+            (2, 4),
+            (3, 5),
+        ),
+    )
+    def test_max_depth(self, max_depth, expected):
+        assert len(self._names(max_depth=max_depth)) == expected
+
+    def test_min_size(self):
+        assert "small.mkv" not in self._names(min_size=200)
+        assert "small.mkv" not in self._names(min_size=10)
+        assert "small.mkv" in self._names(min_size=9)
+
+    def test_extensions(self):
+        assert self._names(extensions=(".mkv",)) == [
+            "Show's Name.S01E01.mkv",
+            "Show.S01E02.MKV",
+            "small.mkv",
+        ]
+
+    def test_exclude_extensions(self):
+        assert self._names(max_depth=1, exclude_extensions=(".srt",)) == [
+            "Show's Name.S01E01.mkv",
+            "small.mkv",
+        ]
+
+    def test_symlinked_directories_are_not_followed(self):
+        os.symlink(self.root / "Season 1", self.root / "link")
+
+        # Like find, the link itself is listed but never descended into
+        assert self._names(max_depth=1) == [
+            "Show's Name.S01E01.mkv",
+            "Show's Name.S01E01.srt",
+            "link",
+            "small.mkv",
+        ]
+        assert self._names().count("deep.mp4") == 1
+
+    def test_missing_path(self):
+        with pytest.raises(FileNotFoundError):
+            list(scan_files(self.root / "missing"))
+
+    def test_unreadable_subdirectory_is_skipped(self, mocker):
+        real_scandir = os.scandir
+
+        def _scandir(path):
+            if path.endswith("Extras"):
+                raise PermissionError(path)
+            return real_scandir(path)
+
+        mocker.patch("scanner.os.scandir", side_effect=_scandir)
+
+        assert "deep.mp4" not in self._names()
+
+
+class TestDirectoryManifest:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.path = temp_directory / "Some.Show"
+        self.path.mkdir()
+        (self.path / "Some.Show.S01E01.mkv").write_bytes(b"0")
+
+        self.manifest = DirectoryManifest(full_scan_interval=24)
+
+    def _bump_mtime(self):
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    def test_snapshot(self):
+        (self.path / "Season 1").mkdir()
+
+        snapshot = DirectorySnapshot.take(self.path)
+
+        assert snapshot.entry_count == 2
+        assert snapshot.has_subdirs
+        assert DirectorySnapshot.take(self.path / "missing") is None
+
+    def test_never_scanned(self):
+        assert self.manifest.unchanged(self.path) is None
+
+    def test_unchanged(self):
+        self.manifest.update(self.path, {"Some.Show.S01E01.mkv"}, synced=True)
+
+        entry = self.manifest.unchanged(self.path)
+        assert entry.files == frozenset(["Some.Show.S01E01.mkv"])
+        assert entry.synced
+
+    def test_new_file(self):
+        self.manifest.update(self.path, {"Some.Show.S01E01.mkv"})
+        (self.path / "Some.Show.S01E02.mkv").write_bytes(b"0")
+        self._bump_mtime()
+
+        assert self.manifest.unchanged(self.path) is None
+
+    def test_entry_count_changed_within_mtime_granularity(self):
+        self.manifest.update(self.path, {"Some.Show.S01E01.mkv"})
+        stat = os.stat(self.path)
+        (self.path / "Some.Show.S01E02.mkv").write_bytes(b"0")
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        assert self.manifest.unchanged(self.path) is None
+
+    def test_subdirectories_are_always_rescanned(self):
+        (self.path / "Season 1").mkdir()
+        self.manifest.update(self.path, {"Some.Show.S01E01.mkv"})
+
+        assert self.manifest.unchanged(self.path) is None
+
+    def test_full_scan_interval(self):
+        self.manifest.update(self.path, set(), scanned_at=time.time() - 25 * 3600)
+
+        assert self.manifest.unchanged(self.path) is None
+
+    def test_disabled(self):
+        manifest = DirectoryManifest(full_scan_interval=0)
+        manifest.update(self.path, set())
+
+        assert manifest.unchanged(self.path) is None
+
+    def test_invalidate(self):
+        self.manifest.update(self.path, set())
+        self.manifest.invalidate(self.path)
+
+        assert self.manifest.get(self.path) is None
+
+
+class TestStabilityGate:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.path = temp_directory / "Some.Show.S01E01.mkv"
+        self.path.write_bytes(b"0")
+
+    def _age(self, seconds):
+        mtime = time.time() - seconds
+        os.utime(self.path, (mtime, mtime))
+
+    def test_settled(self):
+        self._age(120)
+        gate = StabilityGate(window=60, check_open_files=True)
+
+        assert gate.is_stable(self.path)
+        assert gate.deferred == set()
+
+    def test_recently_modified(self):
+        self._age(10)
+        gate = StabilityGate(window=60, check_open_files=False)
+
+        assert not gate.is_stable(self.path)
+        assert gate.deferred == set([str(self.path)])
+
+    def test_open_for_writing(self):
+        self._age(120)
+        gate = StabilityGate(window=60, check_open_files=True)
+
+        with open(self.path, "ab"):
+            assert (
+                os.stat(self.path).st_dev,
+                os.stat(self.path).st_ino,
+            ) in open_for_writing()
+            assert not gate.is_stable(self.path)
+
+    def test_open_for_reading(self):
+        self._age(120)
+        gate = StabilityGate(window=60, check_open_files=True)
+
+        with open(self.path, "rb"):
+            assert gate.is_stable(self.path)
+
+    def test_missing_file(self):
+        gate = StabilityGate(window=0, check_open_files=False)
+
+        assert not gate.is_stable(self.path.parent / "missing.mkv")
+
+    def test_scan_files(self, temp_directory):
+        self._age(120)
+        (temp_directory / "Some.Show.S01E02.mkv").write_bytes(b"0")
+        gate = StabilityGate(window=60, check_open_files=False)
+
+        assert [x.name for x in scan_files(temp_directory, stability=gate)] == [
+            "Some.Show.S01E01.mkv"
+        ]
+        assert gate.deferred == set([str(temp_directory / "Some.Show.S01E02.mkv")])
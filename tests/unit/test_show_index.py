@@ -0,0 +1,77 @@
+import pytest
+from pathlib import Path
+
+from show_index import ShowIndex, show_key, title_words
+
+
+class TestTitleWords:
+    @pytest.mark.parametrize(
+        "name,expected",
+        (
+            ("Grey's.Anatomy", ("greys", "anatomy")),
+            ("Grey's Anatomy (2005)", ("greys", "anatomy", "2005")),
+            ("Pokémon.S01E01.mkv", ("pokemon", "s01e01", "mkv")),
+            ("...", ()),
+        ),
+    )
+    def test_title_words(self, name, expected):
+        assert title_words(name) == expected
+
+
+class TestShowKey:
+    @pytest.mark.parametrize(
+        "filename,expected",
+        (
+            ("Grey's.Anatomy.S01E01.720p.mkv", ("greys", "anatomy")),
+            ("greys anatomy 1x01.mkv", ("greys", "anatomy")),
+            ("Greys.Anatomy.Finale.mkv", None),
+            ("S01E01.mkv", None),
+        ),
+    )
+    def test_show_key(self, filename, expected):
+        assert show_key(filename) == expected
+
+
+class TestShowIndex:
+    @pytest.fixture(autouse=True)
+    def setUp(self):
+        self.index = ShowIndex(
+            [
+                Path("/tv/Grey's.Anatomy"),
+                Path("/tv/The.Office"),
+                Path("/tv/The.Office.US"),
+                Path("/tv/Doctor.Who"),
+                Path("/tv/Pokémon"),
+            ]
+        )
+
+    @pytest.mark.parametrize(
+        "filename,expected",
+        (
+            ("Greys.Anatomy.S19E01.1080p.WEB.mkv", "/tv/Grey's.Anatomy"),
+            ("grey's anatomy s19e01.mkv", "/tv/Grey's.Anatomy"),
+            ("Greys.Anatomy.19x01.mkv", "/tv/Grey's.Anatomy"),
+            ("The.Office.S01E01.mkv", "/tv/The.Office"),
+            ("The.Office.US.S01E01.mkv", "/tv/The.Office.US"),
+            ("Pokemon.S01E01.mkv", "/tv/Pokémon"),
+            ("Pokemon.S01", "/tv/Pokémon"),
+            ("Doctor.Who.2005.S01E01.mkv", None),
+            ("Greys.Anatomy.mkv", None),
+            ("The.Office.UK.S01E01.mkv", None),
+            ("Unknown.Show.S01E01.mkv", None),
+        ),
+    )
+    def test_match(self, filename, expected):
+        assert self.index.match(filename) == (expected and Path(expected))
+
+    def test_ambiguous(self):
+        self.index.add(Path("/other/Greys.Anatomy"))
+
+        assert self.index.match("Greys.Anatomy.S19E01.mkv") is None
+
+    def test_same_directory_twice(self):
+        self.index.add(Path("/tv/Grey's.Anatomy"))
+
+        assert self.index.match("Greys.Anatomy.S19E01.mkv") == Path(
+            "/tv/Grey's.Anatomy"
+        )
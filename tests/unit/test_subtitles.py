@@ -0,0 +1,98 @@
+import codecs
+import pytest
+
+from utils import EncoderException
+from subtitles import (
+    detect_encoding,
+    srt_to_vtt_lines,
+    convert_srt_to_vtt,
+)
+
+
+SAMPLE_SRT = (
+    "1\r\n"
+    "00:16:18,811 --> 00:16:20,437 X1:100 X2:200\r\n"
+    "It has happened.\r\n"
+    "\r\n"
+    "2\r\n"
+    "01:02:03,5 --> 01:02:04,25\r\n"
+    "{\\an8}Café au lait\r\n"
+    "\r\n"
+)
+
+EXPECTED_VTT = (
+    "WEBVTT\n"
+    "\n"
+    "1\n"
+    "00:16:18.811 --> 00:16:20.437\n"
+    "It has happened.\n"
+    "\n"
+    "2\n"
+    "01:02:03.500 --> 01:02:04.250\n"
+    "Café au lait\n"
+    "\n"
+)
+
+
+class TestDetectEncoding:
+    @pytest.mark.parametrize(
+        "sample,expected",
+        (
+            (codecs.BOM_UTF8 + "Café".encode("utf-8"), "utf-8-sig"),
+            ("Café".encode("utf-16"), "utf-16"),
+            ("1\n00:00:01,000".encode("utf-16-le"), "utf-16-le"),
+            ("1\n00:00:01,000".encode("utf-16-be"), "utf-16-be"),
+            ("Café".encode("utf-8"), "utf-8"),
+            ("Café".encode("cp1252"), "cp1252"),
+            (b"", "utf-8"),
+        ),
+    )
+    def test_detect_encoding(self, sample, expected):
+        assert expected == detect_encoding(sample)
+
+    def test_partial_sample(self):
+        sample = "Café".encode("utf-8")[:-1]
+
+        assert "utf-8" == detect_encoding(sample, complete=False)
+        assert "cp1252" == detect_encoding(sample, complete=True)
+
+
+class TestSrtToVttLines:
+    def test_conversion(self):
+        actual = "".join(srt_to_vtt_lines(SAMPLE_SRT.splitlines(keepends=True)))
+
+        assert EXPECTED_VTT == actual
+
+    def test_is_lazy(self):
+        def _lines():
+            yield "1\n"
+            raise AssertionError("Read too far")
+
+        lines = srt_to_vtt_lines(_lines())
+
+        assert next(lines) == "WEBVTT\n"
+        assert next(lines) == "\n"
+        assert next(lines) == "1\n"
+
+
+@pytest.mark.parametrize("encoding", ("utf-8", "utf-8-sig", "utf-16", "cp1252"))
+class TestConvertSrtToVtt:
+    def test_convert(self, temp_directory, encoding):
+        srt_path = temp_directory / "test.srt"
+        srt_path.write_bytes(SAMPLE_SRT.encode(encoding))
+
+        expected = temp_directory / "test.vtt"
+        actual = convert_srt_to_vtt(srt_path)
+
+        assert expected == actual
+        assert EXPECTED_VTT == actual.read_text(encoding="utf-8")
+
+
+class TestConvertSrtToVttErrors:
+    def test_missing_file(self, temp_directory):
+        srt_path = temp_directory / "test.srt"
+
+        with pytest.raises(EncoderException):
+            convert_srt_to_vtt(srt_path)
+
+        assert not srt_path.with_suffix(".vtt").exists()
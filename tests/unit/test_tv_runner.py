@@ -1,9 +1,11 @@
 import pytest
+import threading
 from pathlib import Path
 
 import mock
 from mock import call
-from tv_runner import TvRunner
+from tv_runner import Tv, TvRunner
+from utils import EncoderException
 
 
 class TestTvRunner:
@@ -13,6 +15,9 @@ class TestTvRunner:
         self.mock_sort_unsorted_files = mocker.patch(
             "tv_runner.TvRunner._sort_unsorted_files"
         )
+        self.mock_removeStaleSharedScratch = mocker.patch(
+            "tv_runner.removeStaleSharedScratch"
+        )
 
         self.tvRunner = TvRunner()
 
@@ -38,7 +43,37 @@ class TestTvRunner:
         self.tvRunner.load_paths()
         assert expected == self.tvRunner.paths
 
-    def test_build_remote_media_file_set(self, mocker):
+    @pytest.mark.parametrize("sync_enabled", (True, False))
+    def test_get_all_tv(self, mocker, sync_enabled):
+        mocker.patch("tv_runner.BASE_PATH", "/base")
+        mocker.patch("tv_runner.CATALOG_SYNC_ENABLED", sync_enabled)
+        pages = [
+            {
+                "results": [
+                    {
+                        "finished": False,
+                        "media_paths": [
+                            {"pk": 1, "path": "tv/Show.One"},
+                            {"pk": 2, "path": "/base/tv/Show.One"},
+                        ],
+                    },
+                    {
+                        "finished": True,
+                        "media_paths": [{"pk": 3, "path": "tv/Show.Two"}],
+                    },
+                ]
+            }
+        ]
+        mocker.patch("tv_runner.get_all_pages", return_value=pages)
+        mocker.patch("catalog.get_all_pages", return_value=pages)
+
+        assert Tv.get_all_tv() == {
+            Path("/base/tv/Show.One"): {"pks": {1, 2}, "finished": False},
+            Path("/base/tv/Show.Two"): {"pks": {3}, "finished": True},
+        }
+
+    @pytest.mark.parametrize("max_parallel", (1, 4))
+    def test_build_remote_media_file_set(self, mocker, max_parallel):
         mock_tv = mocker.patch("tv_runner.Tv")
 
         testData = {
@@ -56,31 +91,42 @@ class TestTvRunner:
         )
         mock_tv.get_media_path = lambda x: testData.get(x)
 
-        actualSet = self.tvRunner.build_remote_media_file_set([-1, 1, 12, 123])
+        actualSet = self.tvRunner.build_remote_media_file_set(
+            [-1, 1, 12, 123], max_parallel=max_parallel
+        )
         assert expectedSet == actualSet
 
+    def test_build_remote_media_file_set_error(self, mocker):
+        mock_tv = mocker.patch("tv_runner.Tv")
+        mock_tv.get_media_path.side_effect = [
+            {"media_files": ["test1"]},
+            ValueError(),
+            {"media_files": ["test123"]},
+        ]
+
+        with pytest.raises(ValueError):
+            self.tvRunner.build_remote_media_file_set([1, 12, 123], max_parallel=2)
+
     def test_updateFileRecords(self, mocker):
-        mock_post_media_file = mocker.patch("tv_runner.MediaFile.post_media_file")
-        mock_makeFileStreamable = mocker.patch("tv_runner.makeFileStreamable")
         mock_get_or_create_media_path = mocker.patch(
             "tv_runner.TvRunner.get_or_create_media_path"
         )
-        mock_os_path_exists = mocker.patch("tv_runner.os.path.exists")
-        mock_os_path_getsize = mocker.patch("tv_runner.os.path.getsize")
-        mock_os_path_basename = mocker.patch("tv_runner.os.path.basename")
-
+        mocker.patch(
+            "tv_runner.normalize_filenames",
+            side_effect=lambda path, names: {path / x: path / x for x in names},
+        )
+        mock_estimate_cost = mocker.patch("tv_runner.estimate_cost", return_value=42.0)
         mock_get_or_create_media_path.return_value = {"pk": 1, "skip": False}
-        mock_os_path_exists.return_value = True
-        mock_os_path_getsize.return_value = 1
-        mock_os_path_basename.return_value = "basename"
 
-        test_path = "/a/local/path"
+        test_path = Path("/a/local/path")
+        self.tvRunner.paths = {test_path: {1}}
         test_localFileSet = set(
             [
                 "file1",
                 "file2",
                 "file3",
-                "newfile",
+                "newfile.mkv",
+                "newfile.nfo",
             ]
         )
         test_remoteFileSet = set(
@@ -94,19 +140,129 @@ class TestTvRunner:
         self.tvRunner.updateFileRecords(
             test_path, test_localFileSet, test_remoteFileSet
         )
-        mock_makeFileStreamable.assert_called_with(
+
+        job, other = self.tvRunner.queue.jobs()
+        assert job.path == Path("/a/local/path/newfile.mkv")
+        assert job.media_path_id == 1
+        assert job.show == "/a/local/path"
+        assert job.estimate == 42.0
+
+        # Only media files are probed for an estimate
+        assert other.path == Path("/a/local/path/newfile.nfo")
+        assert other.estimate is None
+        mock_estimate_cost.assert_called_once_with(Path("/a/local/path/newfile.mkv"))
+
+    def test_updateFileRecords_skip(self, mocker):
+        mock_get_or_create_media_path = mocker.patch(
+            "tv_runner.TvRunner.get_or_create_media_path"
+        )
+        mock_get_or_create_media_path.return_value = {"pk": 1, "skip": True}
+
+        self.tvRunner.updateFileRecords(Path("/a/local/path"), set(["newfile"]), set())
+
+        assert len(self.tvRunner.queue) == 0
+
+    def test_processQueue(self, mocker):
+        mock_post_media_file = mocker.patch("tv_runner.MediaFile.post_media_file")
+        mock_makeFileStreamable = mocker.patch("tv_runner.makeFileStreamable")
+
+        self.tvRunner.queue.enqueue("/a/local/path/newfile", media_path_id=1)
+
+        self.tvRunner.processQueue()
+
+        mock_makeFileStreamable.assert_called_once_with(
             Path("/a/local/path/newfile"),
             appendSuffix=True,
             removeOriginal=True,
             dryRun=False,
+            threads=mock.ANY,
         )
         mock_post_media_file.assert_called_once_with(
             mock_makeFileStreamable().name,
             1,
             mock_makeFileStreamable().stat().st_size,
         )
+        assert len(self.tvRunner.queue) == 0
+
+    def test_processQueue_shortest_first(self, mocker):
+        mocker.patch("tv_runner.MediaFile.post_media_file")
+        mock_makeFileStreamable = mocker.patch("tv_runner.makeFileStreamable")
+
+        for name, estimate in (("movie", 9000.0), ("ep1", 1300.0), ("ep2", 1200.0)):
+            self.tvRunner.queue.enqueue(
+                f"/a/local/path/{name}", media_path_id=1, estimate=estimate
+            )
+
+        self.tvRunner.processQueue()
+
+        assert [x.args[0].name for x in mock_makeFileStreamable.call_args_list] == [
+            "ep2",
+            "ep1",
+            "movie",
+        ]
+
+    def test_processQueue_parallel_errors(self, mocker):
+        mocker.patch("convert.MAX_PARALLEL_ENCODES", 4)
+        mock_post_media_file = mocker.patch("tv_runner.MediaFile.post_media_file")
+        mock_makeFileStreamable = mocker.patch("tv_runner.makeFileStreamable")
+
+        def _makeFileStreamable(fullPath, **kwargs):
+            if fullPath.name.startswith("bad"):
+                raise EncoderException("Encoding failed")
+            return mock.MagicMock()
+
+        mock_makeFileStreamable.side_effect = _makeFileStreamable
+
+        test_path = Path("/a/local/path")
+        for name in ("bad1", "good1", "bad2", "good2"):
+            self.tvRunner.queue.enqueue(test_path / name, media_path_id=1)
+
+        self.tvRunner.processQueue()
+
+        assert 4 == mock_makeFileStreamable.call_count
+        assert 2 == mock_post_media_file.call_count
+        assert sorted(self.tvRunner.errors) == [
+            f"Got a non-fatal encoding error attempting to make {test_path / name} streamable"
+            for name in ("bad1", "bad2")
+        ]
+        assert [x.path.name for x in self.tvRunner.queue.jobs("failed")] == [
+            "bad1",
+            "bad2",
+        ]
+        assert len(self.tvRunner.queue) == 0
+
+    def test_processQueue_fatal_error(self, mocker):
+        mocker.patch("tv_runner.makeFileStreamable", side_effect=OSError("boom"))
+        mock_handleFatalError = mocker.patch("tv_runner.TvRunner._handleFatalError")
+
+        self.tvRunner.queue.enqueue("/a/local/path/newfile", media_path_id=1)
+
+        with pytest.raises(OSError):
+            self.tvRunner.processQueue()
+
+        mock_handleFatalError.assert_called_once_with(
+            Path("/a/local/path/newfile"), mock.ANY
+        )
+        (job,) = self.tvRunner.queue.jobs("failed")
+        assert job.error == "boom"
+
+    def test_processQueue_fatal_error_requeues_the_rest(self, mocker):
+        mocker.patch("tv_runner.makeFileStreamable", side_effect=OSError("boom"))
+        mocker.patch("tv_runner.TvRunner._handleFatalError")
 
-    def test_run(self):
+        for name, estimate in (("ep1", 1.0), ("ep2", 2.0)):
+            self.tvRunner.queue.enqueue(
+                f"/a/local/path/{name}", media_path_id=1, estimate=estimate
+            )
+
+        with pytest.raises(OSError):
+            self.tvRunner.processQueue()
+
+        assert [x.path.name for x in self.tvRunner.queue.jobs("failed")] == ["ep1"]
+        assert [x.path.name for x in self.tvRunner.queue.jobs()] == ["ep2"]
+        assert self.tvRunner.queue.jobs("running") == []
+
+    def test_run(self, mocker):
         test_data = {
             "asdf": [1],
             "sdfg": [12, 23],
@@ -125,12 +281,23 @@ class TestTvRunner:
         self.tvRunner.updateFileRecords = mock.MagicMock()
 
         self.tvRunner.handleDirs = mock.MagicMock()
+        self.tvRunner.processQueue = mock.MagicMock()
+
+        mock_flush_infer_scrapers = mocker.patch("tv_runner.flush_infer_scrapers")
 
         self.tvRunner.run()
 
-        self.mock_sort_unsorted_files.assert_called_once_with(dry_run=False)
+        mock_flush_infer_scrapers.assert_called_once_with()
+        self.mock_removeStaleSharedScratch.assert_called_once_with(dryRun=False)
+        self.mock_sort_unsorted_files.assert_called_once_with(
+            dry_run=False, known_paths=test_data
+        )
         self.tvRunner.buildLocalFileSet.assert_has_calls(
-            [call("sdfg"), call("asdf")], any_order=True
+            [
+                call("sdfg", stability=mock.ANY),
+                call("asdf", stability=mock.ANY),
+            ],
+            any_order=True,
         )
         assert 2 == self.tvRunner.buildLocalFileSet.call_count
         self.tvRunner.build_remote_media_file_set.assert_has_calls(
@@ -160,3 +327,91 @@ class TestTvRunner:
         self.tvRunner.handleDirs.assert_has_calls(
             [call("asdf", dry_run=False), call("sdfg", dry_run=False)]
         )
+        self.tvRunner.processQueue.assert_called_once_with()
+
+    def test_run_skips_unchanged_directories(self, temp_directory):
+        show_dir = temp_directory / "Some.Show"
+        show_dir.mkdir()
+        self.tvRunner.manifest.update(show_dir, {"ep1.mp4"}, synced=True)
+
+        self.tvRunner.paths = {show_dir: [1]}
+        self.tvRunner.load_paths = mock.MagicMock()
+        self.tvRunner.handleDirs = mock.MagicMock()
+        self.tvRunner.buildLocalFileSet = mock.MagicMock()
+        self.tvRunner.build_remote_media_file_set = mock.MagicMock()
+        self.tvRunner.updateFileRecords = mock.MagicMock()
+        self.tvRunner.processQueue = mock.MagicMock()
+
+        self.tvRunner.run()
+
+        assert not self.tvRunner.handleDirs.called
+        assert not self.tvRunner.buildLocalFileSet.called
+        assert not self.tvRunner.build_remote_media_file_set.called
+        assert not self.tvRunner.updateFileRecords.called
+
+        self.tvRunner.buildLocalFileSet.return_value = {"ep1.mp4"}
+        self.tvRunner.build_remote_media_file_set.return_value = {"ep1.mp4"}
+        self.tvRunner.run(full_scan=True)
+
+        self.tvRunner.handleDirs.assert_called_once_with(show_dir, dry_run=False)
+        self.tvRunner.buildLocalFileSet.assert_called_once_with(
+            show_dir, stability=mock.ANY
+        )
+
+    def test_run_reuses_file_set_until_synced(self, temp_directory):
+        show_dir = temp_directory / "Some.Show"
+        show_dir.mkdir()
+        self.tvRunner.manifest.update(show_dir, {"ep1.mp4", "ep2.mkv"}, synced=False)
+
+        self.tvRunner.paths = {show_dir: [1]}
+        self.tvRunner.load_paths = mock.MagicMock()
+        self.tvRunner.handleDirs = mock.MagicMock()
+        self.tvRunner.buildLocalFileSet = mock.MagicMock()
+        self.tvRunner.build_remote_media_file_set = mock.MagicMock()
+        self.tvRunner.build_remote_media_file_set.return_value = {"ep1.mp4"}
+        self.tvRunner.updateFileRecords = mock.MagicMock()
+        self.tvRunner.processQueue = mock.MagicMock()
+
+        self.tvRunner.run()
+
+        assert not self.tvRunner.handleDirs.called
+        assert not self.tvRunner.buildLocalFileSet.called
+        self.tvRunner.updateFileRecords.assert_called_once_with(
+            show_dir, {"ep1.mp4", "ep2.mkv"}, {"ep1.mp4"}, dry_run=False
+        )
+        assert not self.tvRunner.manifest.get(show_dir).synced
+
+        self.tvRunner.build_remote_media_file_set.return_value = {"ep1.mp4", "ep2.mkv"}
+        self.tvRunner.run()
+
+        assert self.tvRunner.manifest.get(show_dir).synced
+
+    def test_handlePaths_parallel(self):
+        self.tvRunner.paths = {f"show{i}": [i] for i in range(10)}
+        self.tvRunner.handlePath = mock.MagicMock()
+
+        self.tvRunner.handlePaths(dry_run=True, max_parallel=4)
+
+        self.tvRunner.handlePath.assert_has_calls(
+            [call(f"show{i}", [i], dry_run=True, full_scan=False) for i in range(10)],
+            any_order=True,
+        )
+        assert 10 == self.tvRunner.handlePath.call_count
+
+    def test_handlePaths_raises_first_error_in_path_order(self):
+        started = threading.Event()
+
+        def _handlePath(path, pathIDs, **kwargs):
+            if path == "show0":
+                # Fail after show1 has already failed
+                started.wait(timeout=5)
+                raise ValueError(path)
+            if path == "show1":
+                started.set()
+                raise KeyError(path)
+
+        self.tvRunner.paths = {"show0": [0], "show1": [1], "show2": [2]}
+        self.tvRunner.handlePath = mock.MagicMock(side_effect=_handlePath)
+
+        with pytest.raises(ValueError):
+            self.tvRunner.handlePaths(max_parallel=2)
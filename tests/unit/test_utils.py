@@ -1,9 +1,22 @@
 import pytest
+import sqlite3
 import mock
 import requests
 from pathlib import Path
 
-from utils import get_localpath_by_filename
+from http_cache import HttpCache
+from utils import (
+    get_localpath_by_filename,
+    get_session,
+    close_sessions,
+    request_timeout,
+    retry_after_seconds,
+    RateLimiter,
+    _make_request,
+    post_data,
+    flush_infer_scrapers,
+    get_all_pages,
+)
 
 
 class TestGetLocalpathByFilename:
@@ -15,11 +28,16 @@ class TestGetLocalpathByFilename:
 
         mocker.patch("utils.mediaviewer_infer_scrapers_url", lambda: "test_url")
 
-        self.mock_get = mocker.patch("utils.requests.get")
+        mocker.patch("utils.request_timeout", return_value=(1, 2))
+        mocker.patch("utils.get_rate_limiter")
+        self.mock_get_session = mocker.patch("utils.get_session")
+        self.mock_get = self.mock_get_session.return_value.request
 
         self.test_filename = "test_filename.S02E10.mpg"
 
         self.mock_response = mock.MagicMock(requests.models.Response)
+        self.mock_response.status_code = 200
+        self.mock_response.headers = {}
         self.mock_response.json.return_value = {
             "path": "/path/to/media/test_filename",
         }
@@ -31,10 +49,13 @@ class TestGetLocalpathByFilename:
         actual = get_localpath_by_filename(self.test_filename)
 
         assert expected == actual
+        self.mock_get_session.assert_called_with("test_url")
         self.mock_get.assert_called_once_with(
+            "GET",
             "test_url",
             params={"title": self.test_filename},
             auth=("waiter_username", "waiter_password"),
+            timeout=(1, 2),
         )
 
     def test_failure(self):
@@ -47,7 +68,420 @@ class TestGetLocalpathByFilename:
 
         assert expected == actual
         self.mock_get.assert_called_once_with(
+            "GET",
             "test_url",
             params={"title": self.test_filename},
             auth=("waiter_username", "waiter_password"),
+            timeout=(1, 2),
         )
+
+
+class TestGetSession:
+    @pytest.fixture(autouse=True)
+    def setUp(self):
+        close_sessions()
+        yield
+        close_sessions()
+
+    def test_one_session_per_host(self):
+        session = get_session("https://mediaviewer:8001/mediaviewer/api/tv/")
+
+        assert session is get_session("https://mediaviewer:8001/mediaviewer/api/movie/")
+        assert session is not get_session("https://other:8001/mediaviewer/api/tv/")
+
+    def test_retries(self, mocker):
+        mocker.patch("utils.HTTP_RETRIES", 5)
+        mocker.patch("utils.HTTP_POOL_SIZE", 7)
+
+        adapter = get_session("https://mediaviewer:8001/").get_adapter(
+            "https://mediaviewer:8001/mediaviewer/api/tv/"
+        )
+
+        assert adapter.max_retries.total == 5
+        assert adapter._pool_maxsize == 7
+        assert adapter.max_retries.is_retry("GET", 503)
+        assert adapter.max_retries.is_retry("PUT", 503)
+        assert not adapter.max_retries.is_retry("POST", 503)
+        assert not adapter.max_retries.is_retry("GET", 404)
+
+
+class TestRequestTimeout:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("utils.HTTP_CONNECT_TIMEOUT", 5)
+        mocker.patch("utils.HTTP_READ_TIMEOUT", 30)
+        mocker.patch(
+            "utils.HTTP_TIMEOUTS",
+            {"/api/": 10, "/api/inferscrapers/": 60},
+        )
+
+    @pytest.mark.parametrize(
+        "url,expected",
+        (
+            ("https://mediaviewer/other/", (5, 30)),
+            ("https://mediaviewer/api/tv/", (5, 10)),
+            ("https://mediaviewer/api/inferscrapers/", (5, 60)),
+        ),
+    )
+    def test_timeout(self, url, expected):
+        assert request_timeout(url) == expected
+
+
+class TestMakeRequest:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("utils.WAITER_USERNAME", "waiter_username")
+        mocker.patch("utils.WAITER_PASSWORD", "waiter_password")
+        mocker.patch("utils.VERIFY_REQUESTS", True)
+        mocker.patch("utils.request_timeout", return_value=(1, 2))
+        self.mock_get_rate_limiter = mocker.patch("utils.get_rate_limiter")
+        self.mock_limiter = self.mock_get_rate_limiter.return_value
+
+        self.mock_get_session = mocker.patch("utils.get_session")
+        self.mock_request = self.mock_get_session.return_value.request
+        self.mock_request.return_value.headers = {}
+
+    def test_request(self):
+        actual = _make_request("put", "test_url", values={"skip": True})
+
+        assert actual == self.mock_request.return_value
+        self.mock_get_session.assert_called_once_with("test_url")
+        self.mock_request.assert_called_once_with(
+            "PUT",
+            "test_url",
+            data={"skip": True},
+            auth=("waiter_username", "waiter_password"),
+            verify=True,
+            timeout=(1, 2),
+        )
+        self.mock_request.return_value.raise_for_status.assert_called_once_with()
+        self.mock_limiter.acquire.assert_called_once_with()
+        self.mock_limiter.record.assert_called_once_with(
+            status=self.mock_request.return_value.status_code,
+            latency=mock.ANY,
+            retry_after=None,
+        )
+
+    def test_retry_after(self):
+        self.mock_request.return_value.headers = {"Retry-After": "7"}
+
+        _make_request("GET", "test_url")
+
+        self.mock_limiter.record.assert_called_once_with(
+            status=mock.ANY, latency=mock.ANY, retry_after=7
+        )
+
+    def test_connection_error(self):
+        self.mock_request.side_effect = requests.exceptions.ConnectionError()
+
+        with pytest.raises(requests.exceptions.ConnectionError):
+            _make_request("GET", "test_url")
+
+        self.mock_limiter.record.assert_called_once_with()
+
+    def test_conditional_get(self, mocker):
+        cache = mocker.patch("utils.get_http_cache").return_value
+        cache.get.return_value.validators.return_value = {"If-None-Match": '"abc"'}
+        self.mock_request.return_value.status_code = 304
+
+        actual = _make_request("GET", "test_url")
+
+        assert actual == cache.not_modified.return_value
+        cache.not_modified.assert_called_once_with(
+            cache.get.return_value, self.mock_request.return_value
+        )
+        self.mock_request.assert_called_once_with(
+            "GET",
+            "test_url",
+            data=None,
+            auth=("waiter_username", "waiter_password"),
+            verify=True,
+            headers={"If-None-Match": '"abc"'},
+            timeout=(1, 2),
+        )
+        assert not cache.store.called
+
+    def test_uncached_get(self, mocker):
+        cache = mocker.patch("utils.get_http_cache").return_value
+        cache.get.return_value = None
+        self.mock_request.return_value.status_code = 200
+
+        actual = _make_request("GET", "test_url")
+
+        assert actual == self.mock_request.return_value
+        cache.store.assert_called_once_with("test_url", actual)
+
+    def test_broken_cache_falls_back_to_plain_request(self, mocker):
+        cache = mocker.patch("utils.get_http_cache").return_value
+        cache.get.side_effect = sqlite3.OperationalError("database is locked")
+        cache.store.side_effect = sqlite3.OperationalError("database is locked")
+        self.mock_request.return_value.status_code = 200
+
+        actual = _make_request("GET", "test_url")
+
+        assert actual == self.mock_request.return_value
+        assert "headers" not in self.mock_request.call_args.kwargs
+
+    def test_unwritable_state_dir(self, mocker, tmp_path):
+        (tmp_path / "file").write_text("")
+        mocker.patch("state.STATE_DIR", str(tmp_path / "file" / "state"))
+        mocker.patch("utils.get_http_cache", return_value=HttpCache())
+        self.mock_request.return_value.status_code = 200
+
+        assert _make_request("GET", "test_url") == self.mock_request.return_value
+        _make_request("PUT", "test_url", values={"skip": True})
+
+    def test_cached_body_used_when_cache_update_fails(self, mocker):
+        cache = mocker.patch("utils.get_http_cache").return_value
+        cache.not_modified.side_effect = OSError("disk I/O error")
+        self.mock_request.return_value.status_code = 304
+
+        actual = _make_request("GET", "test_url")
+
+        cached = cache.get.return_value
+        assert actual == cached.to_response.return_value
+        cached.to_response.assert_called_once_with(
+            not_modified=self.mock_request.return_value
+        )
+
+    def test_write_invalidates_cache(self, mocker):
+        cache = mocker.patch("utils.get_http_cache").return_value
+
+        _make_request("PUT", "test_url", values={"skip": True})
+
+        assert not cache.get.called
+        cache.invalidate.assert_called_once_with("test_url")
+
+    def test_invalid_verb(self):
+        with pytest.raises(ValueError):
+            _make_request("DELETE", "test_url")
+
+        assert not self.mock_request.called
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestRateLimiter:
+    @pytest.fixture(autouse=True)
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def _limiter(self, **kwargs):
+        kwargs.setdefault("max_rate", 10)
+        kwargs.setdefault("burst", 5)
+        kwargs.setdefault("min_rate", 1)
+        kwargs.setdefault("target_latency", 1)
+        return RateLimiter(clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+    def test_burst_then_rate(self):
+        limiter = self._limiter()
+
+        for _ in range(5):
+            assert limiter.acquire() == 0
+        assert limiter.acquire() == pytest.approx(0.1)
+        assert limiter.acquire() == pytest.approx(0.1)
+
+    def test_refills_while_idle(self):
+        limiter = self._limiter()
+        for _ in range(5):
+            limiter.acquire()
+
+        self.clock.now += 10
+
+        for _ in range(5):
+            assert limiter.acquire() == 0
+
+    def test_disabled(self):
+        limiter = self._limiter(max_rate=0)
+
+        for _ in range(100):
+            assert limiter.acquire() == 0
+        limiter.record(status=429, retry_after=10)
+        assert self.clock.sleeps == []
+
+    @pytest.mark.parametrize("status", (429, 503, None))
+    def test_throttled(self, status):
+        limiter = self._limiter()
+
+        limiter.record(status=status)
+        assert limiter.rate == 5
+        limiter.record(status=status)
+        limiter.record(status=status)
+        limiter.record(status=status)
+        assert limiter.rate == 1
+
+    def test_retry_after(self):
+        limiter = self._limiter()
+
+        limiter.record(status=429, retry_after=30)
+
+        assert limiter.acquire() == 30
+        assert limiter.acquire() == 0
+
+    def test_slow_responses(self):
+        limiter = self._limiter()
+
+        limiter.record(status=200, latency=5)
+        assert limiter.rate < 10
+
+        for _ in range(50):
+            limiter.record(status=200, latency=0.1)
+        assert limiter.rate == 10
+
+
+class TestRetryAfterSeconds:
+    @pytest.mark.parametrize(
+        "value,expected",
+        (
+            (None, None),
+            ("", None),
+            ("garbage", None),
+            ("12", 12),
+            ("-5", 0),
+            ("100000", 300),
+            ("Thu, 01 Jan 1970 00:01:40 GMT", 40),
+        ),
+    )
+    def test_retry_after_seconds(self, value, expected):
+        assert retry_after_seconds(value, now=60) == expected
+
+
+class TestInferScrapers:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        mocker.patch("utils.mediaviewer_infer_scrapers_url", lambda: "scrapers_url")
+        self.mock_make_request = mocker.patch("utils._make_request")
+        self.mock_send = mocker.patch("utils._send")
+
+    def test_coalesced(self, mocker):
+        mocker.patch("utils.COALESCE_INFER_SCRAPERS", True)
+
+        for _ in range(24):
+            post_data({"filename": "ep.mp4"}, "test_url")
+        assert not self.mock_send.called
+
+        flush_infer_scrapers()
+        flush_infer_scrapers()
+
+        self.mock_send.assert_called_once_with(
+            "POST", "scrapers_url", data={}, auth=mock.ANY, verify=mock.ANY
+        )
+
+    def test_nothing_posted(self, mocker):
+        mocker.patch("utils.COALESCE_INFER_SCRAPERS", True)
+
+        flush_infer_scrapers()
+
+        assert not self.mock_send.called
+
+    def test_every_post(self, mocker):
+        mocker.patch("utils.COALESCE_INFER_SCRAPERS", False)
+
+        post_data({"filename": "ep1.mp4"}, "test_url")
+        post_data({"filename": "ep2.mp4"}, "test_url")
+        flush_infer_scrapers()
+
+        assert self.mock_send.call_count == 2
+
+    def test_scraping_errors_are_ignored(self, mocker):
+        mocker.patch("utils.COALESCE_INFER_SCRAPERS", False)
+        self.mock_send.side_effect = requests.exceptions.ConnectionError()
+
+        actual = post_data({"filename": "ep1.mp4"}, "test_url")
+
+        assert actual == self.mock_make_request.return_value
+
+
+class TestGetAllPages:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.pages = dict()
+        self.mock_get_data = mocker.patch("utils.get_data", side_effect=self._get_data)
+
+    def _get_data(self, url):
+        if url not in self.pages:
+            raise requests.exceptions.HTTPError(f"404 for {url}")
+        response = mock.MagicMock()
+        response.json.return_value = self.pages[url]
+        return response
+
+    def _paginate(self, items, page_size, style="page", count=True):
+        base = "https://mediaviewer/api/tv/"
+        pages = [items[i : i + page_size] for i in range(0, len(items), page_size)]
+        urls = [base]
+        for number in range(1, len(pages)):
+            if style == "page":
+                urls.append(f"{base}?page={number + 1}")
+            elif style == "offset":
+                urls.append(f"{base}?limit={page_size}&offset={number * page_size}")
+            else:
+                urls.append(f"{base}?cursor=abc{number}")
+
+        for number, (url, results) in enumerate(zip(urls, pages)):
+            data = {
+                "next": urls[number + 1] if number + 1 < len(urls) else None,
+                "results": results,
+            }
+            if count:
+                data["count"] = len(items)
+            self.pages[url] = data
+        return base
+
+    def _results(self, url, **kwargs):
+        return [x for data in get_all_pages(url, **kwargs) for x in data["results"]]
+
+    @pytest.mark.parametrize("style", ("page", "offset"))
+    def test_count_based(self, style):
+        url = self._paginate(list(range(23)), 5, style=style)
+
+        assert self._results(url, max_parallel=3) == list(range(23))
+        assert self.mock_get_data.call_count == 5
+
+    @pytest.mark.parametrize("style", ("page", "cursor"))
+    def test_follows_next_links_without_count(self, style):
+        url = self._paginate(list(range(23)), 5, style=style, count=False)
+
+        assert self._results(url, max_parallel=3) == list(range(23))
+        assert [x.args[0] for x in self.mock_get_data.call_args_list] == [
+            url,
+            f"{url}?page=2" if style == "page" else f"{url}?cursor=abc1",
+            f"{url}?page=3" if style == "page" else f"{url}?cursor=abc2",
+            f"{url}?page=4" if style == "page" else f"{url}?cursor=abc3",
+            f"{url}?page=5" if style == "page" else f"{url}?cursor=abc4",
+        ]
+
+    def test_single_page(self):
+        url = self._paginate(list(range(3)), 5)
+
+        assert self._results(url) == list(range(3))
+        assert self.mock_get_data.call_count == 1
+
+    def test_sequential(self):
+        url = self._paginate(list(range(23)), 5)
+
+        assert self._results(url, max_parallel=1) == list(range(23))
+
+    def test_grew_since_first_page(self):
+        url = self._paginate(list(range(23)), 5)
+        self._paginate(list(range(26)), 5)
+        self.pages[url]["count"] = 23
+
+        assert self._results(url, max_parallel=3) == list(range(26))
+
+    def test_shrank_since_first_page(self):
+        url = self._paginate(list(range(23)), 5)
+        del self.pages[f"{url}?page=5"]
+        self.pages[f"{url}?page=4"]["next"] = None
+
+        assert self._results(url, max_parallel=3) == list(range(20))
@@ -0,0 +1,258 @@
+import pytest
+import mock
+from pathlib import Path
+
+from watcher import (
+    EVENT_HEADER,
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_IGNORED,
+    IN_ISDIR,
+    IN_MOVED_TO,
+    IN_Q_OVERFLOW,
+    MOVIE,
+    TV,
+    UNSORTED,
+    InotifyEvent,
+    Watcher,
+    WatchRunner,
+    parse_events,
+)
+
+
+def _raw_event(wd, mask, name=b"", cookie=0):
+    padded = name + b"\0" * (16 - len(name) % 16) if name else b""
+    return EVENT_HEADER.pack(wd, mask, cookie, len(padded)) + padded
+
+
+class TestParseEvents:
+    def test_parse(self):
+        data = _raw_event(1, IN_CLOSE_WRITE, b"Show.S01E01.mkv") + _raw_event(
+            2, IN_CREATE | IN_ISDIR, b"Season 1"
+        )
+
+        assert list(parse_events(data)) == [
+            InotifyEvent(wd=1, mask=IN_CLOSE_WRITE, cookie=0, name="Show.S01E01.mkv"),
+            InotifyEvent(wd=2, mask=IN_CREATE | IN_ISDIR, cookie=0, name="Season 1"),
+        ]
+
+    def test_no_name(self):
+        assert list(parse_events(_raw_event(1, IN_Q_OVERFLOW))) == [
+            InotifyEvent(wd=1, mask=IN_Q_OVERFLOW, cookie=0, name="")
+        ]
+
+
+class TestWatcher:
+    @pytest.fixture(autouse=True)
+    def setUp(self, temp_directory):
+        self.tv_root = temp_directory / "tv"
+        self.show = self.tv_root / "Some.Show"
+        (self.show / "Some.Show.S01E01").mkdir(parents=True)
+        self.unsorted_root = temp_directory / "unsorted"
+        (self.unsorted_root / "Some.Dir").mkdir(parents=True)
+
+        self.inotify = mock.MagicMock()
+        self.wds = dict()
+
+        def _add_watch(path):
+            self.wds[Path(path)] = len(self.wds) + 1
+            return self.wds[Path(path)]
+
+        self.inotify.add_watch.side_effect = _add_watch
+
+        self.watcher = Watcher(
+            self.inotify,
+            [
+                (TV, self.tv_root),
+                (UNSORTED, self.unsorted_root),
+                (MOVIE, temp_directory / "missing"),
+            ],
+            debounce=30,
+        )
+        self.watcher.start()
+
+    def _event(self, directory, mask, name):
+        return InotifyEvent(wd=self.wds[directory], mask=mask, cookie=0, name=name)
+
+    def test_watches(self):
+        assert set(self.wds) == set(
+            [
+                self.tv_root,
+                self.show,
+                self.show / "Some.Show.S01E01",
+                self.unsorted_root,
+                self.unsorted_root / "Some.Dir",
+            ]
+        )
+
+    def test_debounce(self):
+        episode_dir = self.show / "Some.Show.S01E01"
+        self.watcher.handle(self._event(episode_dir, IN_CLOSE_WRITE, "a.mkv"), now=0)
+        self.watcher.handle(self._event(self.show, IN_MOVED_TO, "b.mkv"), now=20)
+
+        assert self.watcher.due(now=40) == []
+        assert self.watcher.due(now=50) == [(TV, self.show)]
+        assert self.watcher.due(now=100) == []
+
+    def test_new_directory_is_watched_but_not_processed(self):
+        self.watcher.handle(
+            self._event(self.tv_root, IN_CREATE | IN_ISDIR, "New.Show"), now=0
+        )
+
+        assert self.wds[self.tv_root / "New.Show"]
+        assert self.watcher.due(now=100) == []
+
+    def test_moved_directory_is_processed(self):
+        self.watcher.handle(
+            self._event(self.show, IN_MOVED_TO | IN_ISDIR, "Some.Show.S01E02"), now=0
+        )
+
+        assert self.wds[self.show / "Some.Show.S01E02"]
+        assert self.watcher.due(now=100) == [(TV, self.show)]
+
+    def test_unsorted(self):
+        self.watcher.handle(
+            self._event(self.unsorted_root, IN_CLOSE_WRITE, "Show.S01E01.mkv"), now=0
+        )
+
+        assert self.watcher.due(now=100) == [(UNSORTED, self.unsorted_root)]
+
+    def test_unsorted_directory_filled_in_place(self):
+        self.watcher.handle(
+            self._event(self.unsorted_root, IN_CREATE | IN_ISDIR, "Show.S01E01"),
+            now=0,
+        )
+        release_dir = self.unsorted_root / "Show.S01E01"
+        assert self.watcher.due(now=100) == []
+
+        self.watcher.handle(
+            self._event(release_dir, IN_CLOSE_WRITE, "Show.S01E01.mkv"), now=100
+        )
+        assert self.watcher.due(now=200) == [(UNSORTED, self.unsorted_root)]
+
+    def test_created_directory_with_files_is_processed(self):
+        (self.show / "Some.Show.S01E02").mkdir()
+        (self.show / "Some.Show.S01E02" / "a.mkv").touch()
+
+        self.watcher.handle(
+            self._event(self.show, IN_CREATE | IN_ISDIR, "Some.Show.S01E02"), now=0
+        )
+
+        assert self.watcher.due(now=100) == [(TV, self.show)]
+
+    def test_created_files_are_not_processed(self):
+        self.watcher.handle(
+            self._event(self.unsorted_root, IN_CREATE, "Show.S01E01.mkv.part"), now=0
+        )
+        self.watcher.handle(self._event(self.show, IN_CREATE, "b.mkv"), now=0)
+
+        assert self.watcher.due(now=100) == []
+
+    def test_scratch_files_are_ignored(self):
+        self.watcher.handle(
+            self._event(self.show, IN_CREATE | IN_ISDIR, ".mc-scratch-abc"), now=0
+        )
+        self.watcher.handle(
+            self._event(self.show, IN_MOVED_TO, ".mc-scratch-abc"), now=0
+        )
+
+        assert self.show / ".mc-scratch-abc" not in self.wds
+        assert self.watcher.due(now=100) == []
+
+    def test_overflow(self):
+        self.watcher.handle(InotifyEvent(wd=-1, mask=IN_Q_OVERFLOW, cookie=0, name=""))
+
+        assert self.watcher.overflowed
+
+    def test_removed_watch(self):
+        wd = self.wds[self.show]
+        self.watcher.handle(InotifyEvent(wd=wd, mask=IN_IGNORED, cookie=0, name=""))
+        self.watcher.handle(
+            InotifyEvent(wd=wd, mask=IN_CLOSE_WRITE, cookie=0, name="a.mkv"), now=0
+        )
+
+        assert self.watcher.due(now=100) == []
+
+
+class TestWatchRunner:
+    @pytest.fixture(autouse=True)
+    def setUp(self, mocker):
+        self.mock_tv_runner = mocker.patch("watcher.TvRunner").return_value
+        self.mock_movie_runner = mocker.patch("watcher.MovieRunner").return_value
+        self.mock_movie_runner.errors = []
+        self.mock_movie = mocker.patch("watcher.Movie")
+
+        self.runner = WatchRunner()
+
+    def test_process_tv(self):
+        self.mock_tv_runner.paths = {Path("/tv/Some.Show"): {1}}
+
+        self.runner.process(TV, Path("/tv/Some.Show"))
+
+        assert not self.mock_tv_runner.load_paths.called
+        self.mock_tv_runner.handlePath.assert_called_once_with(
+            Path("/tv/Some.Show"), {1}, dry_run=False, full_scan=True
+        )
+        self.mock_tv_runner.processQueue.assert_called_once_with()
+
+    def test_process_unknown_tv(self):
+        self.mock_tv_runner.paths = {}
+
+        self.runner.process(TV, Path("/tv/Finished.Show"))
+
+        self.mock_tv_runner.load_paths.assert_called_once_with()
+        assert not self.mock_tv_runner.handlePath.called
+
+    def test_process_movie(self, temp_directory):
+        self.mock_movie.get_all_movies.return_value = {temp_directory / "Old": {}}
+
+        self.runner.process(MOVIE, temp_directory)
+        self.runner.process(MOVIE, temp_directory)
+
+        self.mock_movie_runner.postMovie.assert_called_once_with(
+            temp_directory, dry_run=False
+        )
+        assert 1 == self.mock_movie.get_all_movies.call_count
+
+    def test_process_movie_already_posted(self, temp_directory):
+        self.mock_movie.get_all_movies.return_value = {temp_directory: {}}
+
+        self.runner.process(MOVIE, temp_directory)
+
+        assert not self.mock_movie_runner.postMovie.called
+
+    def test_process_unsorted(self):
+        self.runner.process(UNSORTED, Path("/unsorted"))
+
+        self.mock_tv_runner._sort_unsorted_files.assert_called_once_with(
+            dry_run=False, known_paths=self.mock_tv_runner.paths
+        )
+        assert (
+            self.mock_tv_runner.deferred_unsorted
+            == self.mock_tv_runner._sort_unsorted_files.return_value
+        )
+
+    def test_is_deferred(self):
+        self.mock_tv_runner.deferred = set([Path("/tv/Some.Show")])
+        self.mock_movie_runner.deferred = set()
+
+        assert self.runner.is_deferred(TV, Path("/tv/Some.Show"))
+        assert not self.runner.is_deferred(MOVIE, Path("/movies/Some.Movie"))
+        assert not self.runner.is_deferred(UNSORTED, Path("/unsorted"))
+
+        self.mock_tv_runner.deferred_unsorted = set([Path("/unsorted")])
+        assert self.runner.is_deferred(UNSORTED, Path("/unsorted"))
+
+    def test_report_errors(self, mocker):
+        mocker.patch("watcher.SEND_EMAIL", True)
+        mock_send_email = mocker.patch("watcher.send_email")
+        self.mock_tv_runner.errors = ["tv error"]
+        self.mock_movie_runner.errors = ["movie error"]
+
+        self.runner.report_errors()
+
+        mock_send_email.assert_called_once_with(
+            "MC: Got some errors", "tv error\nmovie error"
+        )
+        assert self.mock_tv_runner.errors == []
+        assert self.mock_movie_runner.errors == []
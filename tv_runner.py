@@ -1,9 +1,10 @@
 import os
+import fnmatch
 import traceback
-import subprocess  # nosec
-import shlex
 import shutil
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from pathlib import Path
 from settings import (
     BASE_PATH,
@@ -13,25 +14,49 @@ from settings import (
     MINIMUM_FILE_SIZE,
     DOMAIN,
     LOCAL_TV_SHOWS_PATHS,
+    MAX_PARALLEL_SHOWS,
+    MAX_PARALLEL_REQUESTS,
+    CATALOG_SYNC_ENABLED,
+)
+from convert import (
+    SCRATCH_PREFIX,
+    makeFileStreamable,
+    removeStaleScratch,
+    removeStaleSharedScratch,
+    runEncodeJobs,
+    encodeThreadBudget,
+    SkipProcessing,
+    AlreadyEncoded,
+)
+from catalog import RemoteCatalog
+from jobs import JobQueue, estimate_cost
+from show_index import ShowIndex, show_key
+from scanner import (
+    scan_files,
+    DirectoryManifest,
+    DirectorySnapshot,
+    StabilityGate,
 )
-from convert import makeFileStreamable, SkipProcessing, AlreadyEncoded
 from utils import (
-    stripUnicode,
+    normalize_filenames,
     EncoderException,
     MissingPathException,
     send_email,
     get_localpath_by_filename,
+    is_valid_media_file,
     post_data,
     get_data,
+    get_all_pages,
     put_data,
+    flush_infer_scrapers,
 )
 
 import logging
 
 log = logging.getLogger(__name__)
 
-FIND_FAIL_STRING = b"No such file or directory"
 IGNORED_FILE_EXTENSIONS = (".vtt", ".srt")
+ENGLISH_SUBTITLE_PATTERN = "*Eng*.srt"
 
 
 class MediaPathMixin:
@@ -90,31 +115,32 @@ class Tv(MediaPathMixin):
     def MEDIAVIEWER_MEDIAPATH_URL(cls):
         return DOMAIN + "/mediaviewer/api/tvmediapath/"
 
+    @staticmethod
+    def _media_paths(result):
+        for media_path in result["media_paths"]:
+            mp = media_path["path"]
+            if BASE_PATH not in mp:
+                local_path = Path(BASE_PATH) / mp
+            else:
+                local_path = Path(mp)
+            yield local_path, media_path["pk"], result["finished"]
+
     @classmethod
-    def get_all_tv(cls):
-        paths = dict()
+    def get_all_tv(cls, full_sync=False):
+        if CATALOG_SYNC_ENABLED:
+            catalog = RemoteCatalog("tv", cls.MEDIAVIEWER_TV_URL, cls._media_paths)
+            return catalog.sync(full=full_sync)
 
-        data = {"next": cls.MEDIAVIEWER_TV_URL}
-        while data["next"]:
-            request = get_data(data["next"])
-            data = request.json()
+        paths = dict()
 
+        for data in get_all_pages(cls.MEDIAVIEWER_TV_URL):
             if data["results"]:
                 for result in data["results"]:
-                    media_paths = result["media_paths"]
-
-                    for media_path in media_paths:
-                        mp = media_path["path"]
-                        if BASE_PATH not in mp:
-                            local_path = Path(BASE_PATH) / mp
-                        else:
-                            local_path = Path(mp)
-
+                    for local_path, pk, finished in cls._media_paths(result):
                         val = paths.setdefault(
-                            local_path, {"pks": set(), "finished": result["finished"]}
+                            local_path, {"pks": set(), "finished": finished}
                         )
-                        val["pks"].add(media_path["pk"])
-                        paths[local_path] = val
+                        val["pks"].add(pk)
         return paths
 
 
@@ -141,9 +167,15 @@ class TvRunner:
     def __init__(self):
         self.paths = dict()
         self.errors = []
-
-    def load_paths(self):
-        tv_entries = Tv.get_all_tv()
+        self.queue = JobQueue()
+        self.manifest = DirectoryManifest()
+        # Show directories holding files that are still being written
+        self.deferred = set()
+        # Unsorted directories holding downloads that are still being written
+        self.deferred_unsorted = set()
+
+    def load_paths(self, full_sync=False):
+        tv_entries = Tv.get_all_tv(full_sync=full_sync)
         self.paths = {
             key: val["pks"] for key, val in tv_entries.items() if not val["finished"]
         }
@@ -167,170 +199,342 @@ class TvRunner:
         }
 
     @staticmethod
-    def build_remote_media_file_set(pathIDs):
+    def build_remote_media_file_set(pathIDs, max_parallel=None):
+        if max_parallel is None:
+            max_parallel = MAX_PARALLEL_REQUESTS
+
+        # Skip local paths
+        remoteIDs = [pathid for pathid in pathIDs if pathid != -1]
+
+        if max_parallel <= 1 or len(remoteIDs) <= 1:
+            results = [Tv.get_media_path(pathid) for pathid in remoteIDs]
+        else:
+            with ThreadPoolExecutor(
+                max_workers=min(max_parallel, len(remoteIDs)),
+                thread_name_prefix="remote",
+            ) as executor:
+                results = list(executor.map(Tv.get_media_path, remoteIDs))
+
         fileSet = set()
-        for pathid in pathIDs:
-            # Skip local paths
-            if pathid == -1:
-                continue
-            res = Tv.get_media_path(pathid)
+        for res in results:
             fileSet.update(res["media_files"])
         log.info("Built remote fileSet")
 
         return fileSet
 
     def updateFileRecords(self, path, localFileSet, remoteFileSet, dry_run=False):
-        media_path_id = None
-        for localFile in localFileSet.difference(remoteFileSet):
-            if not localFile:
-                continue
+        newFiles = sorted(x for x in localFileSet.difference(remoteFileSet) if x)
+        if not newFiles:
+            return
 
-            if dry_run:
+        if dry_run:
+            for localFile in newFiles:
                 log.debug(f"Would process {localFile}")
-                continue
+            return
 
-            if not media_path_id:
-                media_path_data = self.get_or_create_media_path(path)
-                if media_path_data["skip"]:
-                    break
+        media_path_data = self.get_or_create_media_path(path)
+        if media_path_data["skip"]:
+            return
+        media_path_id = media_path_data["pk"]
 
-                media_path_id = media_path_data["pk"]
+        try:
+            cleanPaths = normalize_filenames(path, newFiles)
+        except Exception as e:
+            self._handleFatalError(path, e)
+            raise
 
+        for localFile in newFiles:
+            fullPath = cleanPaths[Path(path) / localFile]
             try:
                 log.info(f"Attempting to add {localFile}")
-                fullPath = stripUnicode(localFile, path=path)
-                try:
-                    fullPath = makeFileStreamable(
-                        fullPath, appendSuffix=True, removeOriginal=True, dryRun=False
-                    )
-                except EncoderException:
-                    errorMsg = f"Got a non-fatal encoding error attempting to make {fullPath} streamable"
-                    log.error(errorMsg)
-                    log.error("Attempting to recover and continue")
-                    self.errors.append(errorMsg)
-                    continue
-                except (AlreadyEncoded, SkipProcessing) as e:
-                    log.warning(e)
-                    continue
-
-                if fullPath.exists():
-                    MediaFile.post_media_file(
-                        fullPath.name, media_path_id, fullPath.stat().st_size
-                    )
-            except Exception as e:
-                errorMsg = (
-                    f"Something bad happened attempting to make {fullPath} streamable"
+                self.queue.enqueue(
+                    fullPath,
+                    media_path_id=media_path_id,
+                    show=path,
+                    # makeFileStreamable skips anything else, don't probe it
+                    estimate=(
+                        estimate_cost(fullPath)
+                        if is_valid_media_file(fullPath)
+                        else None
+                    ),
                 )
-                log.error(errorMsg)
-                log.error(e)
-
-                if SEND_EMAIL:
-                    subject = "MC: Got some errors"
-                    message = f"""
-                    {errorMsg}
-                    Got the following:
-                    {traceback.format_exc()}
-                    """
-                    send_email(subject, message)
+            except Exception as e:
+                self._handleFatalError(fullPath, e)
                 raise
 
-    @staticmethod
-    def buildLocalFileSet(path):
-        command = f"find '{path}' -maxdepth 1 -size +{MINIMUM_FILE_SIZE}c -not -type d"
-        p = subprocess.Popen(
-            shlex.split(command),  # nosec
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+    def processQueue(self):
+        threads = encodeThreadBudget()
+        jobs = runEncodeJobs(
+            lambda job: makeFileStreamable(
+                job.path,
+                appendSuffix=True,
+                removeOriginal=True,
+                dryRun=False,
+                threads=threads,
+            ),
+            self.queue.drain(),
         )
-        local_files = p.communicate()[0]
+        try:
+            with closing(jobs):
+                for job, encodedPath, exc in jobs:
+                    try:
+                        if isinstance(exc, EncoderException):
+                            errorMsg = f"Got a non-fatal encoding error attempting to make {job.path} streamable"
+                            log.error(errorMsg)
+                            log.error("Attempting to recover and continue")
+                            self.errors.append(errorMsg)
+                            self.queue.fail(job, exc)
+                            continue
+                        elif isinstance(exc, (AlreadyEncoded, SkipProcessing)):
+                            log.warning(exc)
+                            self.queue.complete(job)
+                            continue
+                        elif exc is not None:
+                            raise exc
+
+                        if encodedPath.exists():
+                            MediaFile.post_media_file(
+                                encodedPath.name,
+                                job.media_path_id,
+                                encodedPath.stat().st_size,
+                            )
+                        self.queue.complete(job)
+                    except Exception as e:
+                        self.queue.fail(job, e)
+                        self._handleFatalError(job.path, e)
+                        raise
+        finally:
+            # Jobs cancelled by an error go back for the next run
+            self.queue.abandon()
 
-        if FIND_FAIL_STRING in local_files:
+    @staticmethod
+    def _handleFatalError(fullPath, e):
+        errorMsg = f"Something bad happened attempting to make {fullPath} streamable"
+        log.error(errorMsg)
+        log.error(e)
+
+        if SEND_EMAIL:
+            subject = "MC: Got some errors"
+            message = f"""
+            {errorMsg}
+            Got the following:
+            {traceback.format_exc()}
+            """
+            send_email(subject, message)
+
+    @staticmethod
+    def buildLocalFileSet(path, stability=None):
+        if stability is None:
+            stability = StabilityGate()
+
+        try:
+            localFileSet = set(
+                entry.name
+                for entry in scan_files(
+                    path,
+                    max_depth=1,
+                    min_size=MINIMUM_FILE_SIZE,
+                    exclude_extensions=IGNORED_FILE_EXTENSIONS,
+                    stability=stability,
+                )
+            )
+        except (FileNotFoundError, NotADirectoryError):
             raise MissingPathException(f"Path not found: {path}")
 
-        localFileSet = local_files.split(b"\n")
-        localFileSet = set(
-            [
-                os.path.basename(x).decode("utf-8")
-                for x in localFileSet
-                if x and os.path.splitext(x)[1] not in IGNORED_FILE_EXTENSIONS
-            ]
-        )
         log.info(localFileSet)
         return localFileSet
 
-    def handleDirs(self, path, dry_run=False):
-        if path.exists():
-            paths = []
-            dir_set = set()
-            for root, dirs, files in path.walk():
-                for file in files:
-                    paths.append(root / file)
-
-            for fullpath in paths:
-                dirs = str(fullpath).split(str(path))[1].split(os.path.sep)
-                top, episode, file = path, dirs[1], dirs[-1]
-                file_ext = os.path.splitext(file)[-1].lower()
-
-                dir_path = Path(top) / episode
-                if dir_path.is_dir():
-                    dir_set.add(dir_path)
-
-                    english_subtitle_paths = dir_path.rglob("*Eng*.srt")
-                    count = 0
-                    for srt_path in english_subtitle_paths:
-                        # Move subtitle to show directory and rename
-                        log.info(f"Found subtitle file in {episode}")
-                        new = Path(top) / f"{episode}-{count}.srt"
-                        if dry_run:
-                            log.debug(f"Would rename {srt_path} to {new}")
-                        else:
-                            os.rename(srt_path, new)
-                        count += 1
-
-                    if (
-                        file_ext in MEDIA_FILE_EXTENSIONS
-                        and os.path.getsize(fullpath) > MINIMUM_FILE_SIZE
-                    ):
-                        # Move media file to show directory
-                        log.info(f"Found media file in {episode}")
-                        new = os.path.join(top, file)
-
-                        if dry_run:
-                            log.debug(f"Would rename {fullpath} to {new}")
-                        else:
-                            os.rename(fullpath, new)
-
-            for directory in dir_set:
-                log.info(f"Deleting {directory}")
-                if dry_run:
-                    log.debug(f"Would remove {directory}")
-                else:
-                    shutil.rmtree(directory)
+    def _planDirs(self, path):
+        """Work out how to flatten the episode directories under path.
+
+        Everything under path is walked once. Returns a list of (src, dst)
+        renames and the episode directories to delete afterwards.
+        """
+        stability = StabilityGate()
+        episodes = dict()
+        unsettled = set()
+        for entry in scan_files(path):
+            parts = Path(entry.path).relative_to(path).parts
+            if len(parts) < 2:
+                # Files directly in the show directory stay where they are
+                continue
 
-    def run(self, dry_run=False):
-        log.info("Attempting to sort unsorted files")
-        self._sort_unsorted_files(dry_run=dry_run)
+            episode = parts[0]
+            if episode.startswith(SCRATCH_PREFIX):
+                # Leave in-progress encodes alone
+                continue
 
-        log.info("Attempting to get paths")
-        self.load_paths()
-        log.info("Got paths")
-        for path, pathIDs in self.paths.items():
             try:
+                # Like scan_files, a dangling symlink is a settled file
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                stat = None
+
+            # Leave episode directories alone until everything in them has
+            # finished downloading
+            if stat is None or not stability.is_stable(entry.path, stat=stat):
+                unsettled.add(episode)
+                continue
+
+            media, subtitles = episodes.setdefault(episode, ([], []))
+            if fnmatch.fnmatchcase(entry.name, ENGLISH_SUBTITLE_PATTERN):
+                subtitles.append(Path(entry.path))
+            elif (
+                os.path.splitext(entry.name)[1].lower() in MEDIA_FILE_EXTENSIONS
+                and stat.st_size > MINIMUM_FILE_SIZE
+            ):
+                media.append(Path(entry.path))
+
+        if unsettled:
+            self.deferred.add(path)
+
+        renames = []
+        removals = []
+        for episode in sorted(set(episodes) - unsettled):
+            media, subtitles = episodes[episode]
+            for count, srt_path in enumerate(sorted(subtitles)):
+                # Move subtitle to show directory and rename
+                log.info(f"Found subtitle file in {episode}")
+                renames.append((srt_path, path / f"{episode}-{count}.srt"))
+
+            for media_path in sorted(media):
+                # Move media file to show directory
+                log.info(f"Found media file in {episode}")
+                renames.append((media_path, path / media_path.name))
+
+            removals.append(path / episode)
+        return renames, removals
+
+    def handleDirs(self, path, dry_run=False):
+        if not path.exists():
+            return
+
+        # Encodes of files in the show directory write their scratch here
+        removeStaleScratch(path, dryRun=dry_run)
+        renames, removals = self._planDirs(path)
+
+        for src, dst in renames:
+            if dry_run:
+                log.debug(f"Would rename {src} to {dst}")
+            else:
+                os.rename(src, dst)
+
+        for directory in removals:
+            log.info(f"Deleting {directory}")
+            if dry_run:
+                log.debug(f"Would remove {directory}")
+            else:
+                shutil.rmtree(directory)
+
+    def handlePath(self, path, pathIDs, dry_run=False, full_scan=False):
+        self.deferred.discard(path)
+        stability = StabilityGate()
+
+        entry = None if full_scan else self.manifest.unchanged(path)
+        if entry is not None and entry.synced:
+            log.info(f"Skipping unchanged directory {path}")
+            return
+
+        try:
+            if entry is not None:
+                log.info(f"Using cached local file set for {path}")
+                snapshot = entry.snapshot
+                localFileSet = set(entry.files)
+            else:
                 log.info(f"Handling directories in {path}")
                 self.handleDirs(path, dry_run=dry_run)
+                snapshot = DirectorySnapshot.take(path)
                 log.info(f"Building local file set for {path}")
-                localFileSet = self.buildLocalFileSet(path)
+                localFileSet = self.buildLocalFileSet(path, stability=stability)
                 log.info(f"Done building local file set for {path}")
-            except MissingPathException as e:
-                log.warning(e)
-                log.warning("Continuing...")
-                continue
-
-            log.info(f"Attempting to get remote files for {path}")
-            remoteFileSet = self.build_remote_media_file_set(pathIDs)
-            log.info(f"Done building remote file set for {path}")
-
-            self.updateFileRecords(path, localFileSet, remoteFileSet, dry_run=dry_run)
+        except MissingPathException as e:
+            log.warning(e)
+            log.warning("Continuing...")
+            return
+
+        log.info(f"Attempting to get remote files for {path}")
+        remoteFileSet = self.build_remote_media_file_set(pathIDs)
+        log.info(f"Done building remote file set for {path}")
+
+        if stability.deferred:
+            self.deferred.add(path)
+
+        if dry_run:
+            pass
+        elif path in self.deferred:
+            # Files still being written don't change the directory once they
+            # finish, so don't let the manifest skip it next time
+            self.manifest.invalidate(path)
+        else:
+            self.manifest.update(
+                path,
+                localFileSet,
+                snapshot=snapshot,
+                synced=not any(
+                    is_valid_media_file(x)
+                    for x in localFileSet.difference(remoteFileSet)
+                ),
+                scanned_at=entry and entry.scanned_at,
+            )
+
+        self.updateFileRecords(path, localFileSet, remoteFileSet, dry_run=dry_run)
+
+    def handlePaths(self, dry_run=False, full_scan=False, max_parallel=None):
+        """Run handlePath for every show using at most max_parallel threads.
+
+        Results are waited on in the same order as self.paths, so when
+        shows fail the exception raised is the one a serial run would have
+        hit first. Shows that have not started yet are cancelled.
+        """
+        if max_parallel is None:
+            max_parallel = MAX_PARALLEL_SHOWS
+
+        items = list(self.paths.items())
+
+        if max_parallel <= 1 or len(items) <= 1:
+            for path, pathIDs in items:
+                self.handlePath(path, pathIDs, dry_run=dry_run, full_scan=full_scan)
+            return
+
+        executor = ThreadPoolExecutor(
+            max_workers=max_parallel, thread_name_prefix="show"
+        )
+        try:
+            futures = [
+                executor.submit(
+                    self.handlePath, path, pathIDs, dry_run=dry_run, full_scan=full_scan
+                )
+                for path, pathIDs in items
+            ]
+            for future in futures:
+                future.result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def run(self, dry_run=False, full_scan=False):
+        try:
+            log.info("Attempting to get paths")
+            self.load_paths(full_sync=full_scan)
+            log.info("Got paths")
+
+            removeStaleSharedScratch(dryRun=dry_run)
+
+            # Sorting only moves files into show directories that already
+            # exist, so it doesn't change the paths just loaded
+            log.info("Attempting to sort unsorted files")
+            self.deferred_unsorted = self._sort_unsorted_files(
+                dry_run=dry_run, known_paths=self.paths
+            )
+
+            self.handlePaths(dry_run=dry_run, full_scan=full_scan)
+
+            if not dry_run:
+                # Encodes run on their own, smaller pool once every show has
+                # been scanned
+                log.info("Processing queued encodes")
+                self.processQueue()
+        finally:
+            flush_infer_scrapers()
 
         if self.errors:
             log.error("Errors occured in the following files:")
@@ -340,7 +544,19 @@ class TvRunner:
         return self.errors
 
     @staticmethod
-    def _sort_unsorted_files(dry_run=False):
+    def _sort_unsorted_files(dry_run=False, known_paths=()):
+        """Move downloads in UNSORTED_PATHS into their show directories.
+
+        Files and directories still being written are left where they are.
+        Returns the unsorted directories holding any of them.
+        """
+        stability = StabilityGate()
+        deferred = set()
+        # Built on first use so nothing is listed when there's nothing to sort
+        index = None
+        # Shows MediaViewer has already been asked about during this run
+        remote_paths = dict()
+
         for unsorted_path_str in UNSORTED_PATHS:
             unsorted_path = Path(unsorted_path_str)
 
@@ -351,7 +567,21 @@ class TvRunner:
             for src in unsorted_path.iterdir():
                 filename = src.name
 
-                localpath = get_localpath_by_filename(filename)
+                if not TvRunner._isSettled(src, stability):
+                    log.info(f"Waiting for {src} to finish downloading")
+                    deferred.add(unsorted_path)
+                    continue
+
+                if index is None:
+                    index = TvRunner._show_index(known_paths)
+
+                localpath = index.match(filename)
+                if localpath is None:
+                    key = show_key(filename) or filename
+                    if key not in remote_paths:
+                        remote_paths[key] = get_localpath_by_filename(filename)
+                    localpath = remote_paths[key]
+
                 if not localpath or not localpath.exists():
                     continue
 
@@ -362,3 +592,30 @@ class TvRunner:
                 else:
                     log.info(f"Moving {src} to {dst}")
                     shutil.move(src, dst)
+        return deferred
+
+    @staticmethod
+    def _isSettled(path, stability):
+        deferred = len(stability.deferred)
+        if path.is_dir():
+            try:
+                for _ in scan_files(path, stability=stability):
+                    pass
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        else:
+            stability.is_stable(path)
+        return len(stability.deferred) == deferred
+
+    @staticmethod
+    def _show_index(known_paths=()):
+        paths = set(Path(x) for x in known_paths)
+        for path_str in LOCAL_TV_SHOWS_PATHS:
+            path = Path(path_str)
+            if not path.is_dir():
+                continue
+
+            for dir in path.iterdir():
+                if dir.is_dir() and "unsorted" not in str(dir).lower():
+                    paths.add(dir)
+        return ShowIndex(sorted(paths))
@@ -1,6 +1,16 @@
 import requests
 import os
+import math
 import time
+import sqlite3
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit, urlunsplit, parse_qs, urlencode
+from urllib3.util.retry import Retry
 
 from pathlib import Path
 from unidecode import unidecode
@@ -17,11 +27,31 @@ from settings import (
     VERIFY_REQUESTS,
     MEDIA_FILE_EXTENSIONS,
     DOMAIN,
+    HTTP_POOL_SIZE,
+    HTTP_RETRIES,
+    HTTP_BACKOFF_FACTOR,
+    HTTP_BACKOFF_JITTER,
+    HTTP_RETRY_STATUSES,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_TIMEOUTS,
+    HTTP_RATE_LIMIT,
+    HTTP_RATE_BURST,
+    HTTP_MIN_RATE,
+    HTTP_TARGET_LATENCY,
+    COALESCE_INFER_SCRAPERS,
+    MAX_PARALLEL_REQUESTS,
 )
 
+from http_cache import get_http_cache
+
 log = logging.getLogger(__name__)
 
-EXTERNAL_REQUEST_COOLDOWN = 0.25
+# Longest Retry-After pause that is honoured
+MAX_RETRY_AFTER = 300
+THROTTLE_STATUSES = (429, 503)
+# Weight given to the newest response when averaging latency
+LATENCY_SMOOTHING = 0.2
 
 
 class EncoderException(Exception):
@@ -32,30 +62,261 @@ class MissingPathException(Exception):
     pass
 
 
+_sessions = dict()
+_rate_limiters = dict()
+_sessions_lock = threading.Lock()
+
+
+def _retry():
+    kwargs = dict(
+        total=HTTP_RETRIES,
+        backoff_factor=HTTP_BACKOFF_FACTOR,
+        status_forcelist=HTTP_RETRY_STATUSES,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+    try:
+        return Retry(backoff_jitter=HTTP_BACKOFF_JITTER, **kwargs)
+    except TypeError:
+        # urllib3 < 2 has no jitter
+        return Retry(**kwargs)
+
+
+def get_session(url):
+    """Return the shared requests.Session for url's host.
+
+    Each host gets its own keep-alive connection pool of HTTP_POOL_SIZE
+    connections, so threads talking to MediaViewer reuse connections instead
+    of opening a new one for every call.
+    """
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=HTTP_POOL_SIZE,
+                max_retries=_retry(),
+            )
+            session = requests.Session()
+            session.mount(f"{parts.scheme}://{parts.netloc}", adapter)
+            _sessions[key] = session
+        return session
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _rate_limiters.clear()
+
+
+def retry_after_seconds(value, now=None):
+    """Parse a Retry-After header, given in seconds or as an HTTP date."""
+    if not value:
+        return None
+
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        seconds = when.timestamp() - (time.time() if now is None else now)
+    return min(max(seconds, 0), MAX_RETRY_AFTER)
+
+
+class RateLimiter:
+    """Token bucket that adapts to how the server is coping.
+
+    Every request takes a token. Tokens refill at rate per second up to
+    burst, so short bursts go out immediately and sustained load is spread
+    out. The rate starts at max_rate and is halved whenever the server says
+    it is overloaded (429 or 503) or a request fails outright, reduced while
+    the average response time is above target_latency and raised again a
+    little with every fast response. A Retry-After header stops all requests
+    until it has passed.
+    """
+
+    def __init__(
+        self,
+        max_rate=None,
+        burst=None,
+        min_rate=None,
+        target_latency=None,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.max_rate = HTTP_RATE_LIMIT if max_rate is None else max_rate
+        self.burst = max(1, HTTP_RATE_BURST if burst is None else burst)
+        self.min_rate = min(
+            self.max_rate, HTTP_MIN_RATE if min_rate is None else min_rate
+        )
+        self.target_latency = (
+            HTTP_TARGET_LATENCY if target_latency is None else target_latency
+        )
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+
+        self.rate = self.max_rate
+        self.tokens = float(self.burst)
+        self.latency = None
+        self.paused_until = None
+        self._updated = clock()
+
+    @property
+    def enabled(self):
+        return self.max_rate > 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Block until a request may be sent. Returns the time spent waiting."""
+        if not self.enabled:
+            return 0
+
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+
+            # Take the token now so concurrent callers queue up behind each
+            # other instead of all waking at once
+            self.tokens -= 1
+            wait = max(0, -self.tokens / self.rate)
+            if self.paused_until is not None:
+                wait = max(wait, self.paused_until - now)
+
+        if wait > 0:
+            log.debug(f"Rate limited, waiting {wait:.2f}s")
+            self._sleep(wait)
+        return wait
+
+    def record(self, status=None, latency=None, retry_after=None):
+        """Adjust the rate using the outcome of a request.
+
+        status is None when the request failed without a response.
+        """
+        if not self.enabled:
+            return
+
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+
+            if retry_after is not None:
+                paused_until = now + retry_after
+                if self.paused_until is None or paused_until > self.paused_until:
+                    self.paused_until = paused_until
+                    log.warning(f"Server asked to retry after {retry_after:.0f}s")
+
+            if status is None or status in THROTTLE_STATUSES:
+                self.rate = max(self.min_rate, self.rate / 2)
+                log.warning(f"Slowing requests to {self.rate:.2f}/s")
+                return
+
+            if latency is not None:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+
+            if self.latency is not None and self.latency > self.target_latency:
+                self.rate = max(self.min_rate, self.rate * 0.9)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def get_rate_limiter(url):
+    """Return the shared RateLimiter for url's host."""
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+
+    with _sessions_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = _rate_limiters[key] = RateLimiter()
+        return limiter
+
+
+def _send(verb, url, **kwargs):
+    limiter = get_rate_limiter(url)
+    limiter.acquire()
+
+    started = time.monotonic()
+    try:
+        response = get_session(url).request(
+            verb, url, timeout=request_timeout(url), **kwargs
+        )
+    except requests.exceptions.RequestException:
+        limiter.record()
+        raise
+
+    limiter.record(
+        status=response.status_code,
+        latency=time.monotonic() - started,
+        retry_after=retry_after_seconds(response.headers.get("Retry-After")),
+    )
+    return response
+
+
+def request_timeout(url):
+    """Return the (connect, read) timeout to use for url."""
+    read_timeout = HTTP_READ_TIMEOUT
+    matches = [x for x in HTTP_TIMEOUTS if x in url]
+    if matches:
+        read_timeout = HTTP_TIMEOUTS[max(matches, key=len)]
+    return (HTTP_CONNECT_TIMEOUT, read_timeout)
+
+
 def mediaviewer_infer_scrapers_url():
     return f"{DOMAIN}/mediaviewer/api/inferscrapers/"
 
 
-def _external_request_cooldown():
-    return EXTERNAL_REQUEST_COOLDOWN
+_infer_scrapers_pending = threading.Event()
 
 
-def post_data(values, url):
+def infer_scrapers():
+    """Ask MediaViewer to scrape metadata for newly posted media."""
+    _infer_scrapers_pending.clear()
     try:
-        request = _make_request("POST", url, values=values)
+        _send(
+            "POST",
+            mediaviewer_infer_scrapers_url(),
+            data={},
+            auth=(WAITER_USERNAME, WAITER_PASSWORD),
+            verify=VERIFY_REQUESTS,
+        )
+    except Exception as e:
+        log.error(e)
+        log.warning("Ignoring error generated during scraping")
 
-        try:
-            requests.post(
-                mediaviewer_infer_scrapers_url(),
-                data={},
-                auth=(WAITER_USERNAME, WAITER_PASSWORD),
-                verify=VERIFY_REQUESTS,
-            )
-            time.sleep(_external_request_cooldown())
-        except Exception as e:
-            log.error(e)
-            log.warning("Ignoring error generated during scraping")
 
+def request_infer_scrapers():
+    """Note that scraping is needed, or scrape now if not coalescing."""
+    if COALESCE_INFER_SCRAPERS:
+        _infer_scrapers_pending.set()
+    else:
+        infer_scrapers()
+
+
+def flush_infer_scrapers():
+    """Scrape once if anything has been posted since the last scrape."""
+    if _infer_scrapers_pending.is_set():
+        log.info("Inferring scrapers for new media")
+        infer_scrapers()
+
+
+def post_data(values, url):
+    try:
+        request = _make_request("POST", url, values=values)
+        request_infer_scrapers()
         return request
     except Exception as e:
         log.error(e)
@@ -70,6 +331,74 @@ def get_data(url):
         raise
 
 
+def _page_urls(data):
+    """Return the URLs of every page after the first.
+
+    data is the first page of a count based listing, paginated either by
+    page number or by limit and offset. Returns None if the remaining pages
+    can't be worked out from it.
+    """
+    count = data.get("count")
+    results = data.get("results")
+    next_url = data.get("next")
+    if not isinstance(count, int) or not results or not next_url:
+        return None
+
+    parts = urlsplit(next_url)
+    query = parse_qs(parts.query, keep_blank_values=True)
+    page_size = len(results)
+    page_count = math.ceil(count / page_size)
+
+    if query.get("page") == ["2"]:
+        key = "page"
+        values = range(2, page_count + 1)
+    elif query.get("offset") == [str(page_size)]:
+        key = "offset"
+        values = range(page_size, count, page_size)
+    else:
+        return None
+
+    return [
+        urlunsplit(parts._replace(query=urlencode({**query, key: [value]}, doseq=True)))
+        for value in values
+    ]
+
+
+def get_all_pages(url, max_parallel=None):
+    """Yield the decoded JSON of every page of a paginated listing in order.
+
+    The first page is fetched alone. If it has a count, the rest are fetched
+    with up to max_parallel requests at once. Otherwise, or if any of
+    those fail, the next links are followed one page at a time.
+    """
+    if max_parallel is None:
+        max_parallel = MAX_PARALLEL_REQUESTS
+
+    first = get_data(url).json()
+    urls = _page_urls(first) if max_parallel > 1 else None
+
+    pages = [first]
+    if urls:
+        try:
+            with ThreadPoolExecutor(
+                max_workers=min(max_parallel, len(urls)), thread_name_prefix="page"
+            ) as executor:
+                pages.extend(executor.map(lambda x: get_data(x).json(), urls))
+        except Exception as e:
+            log.warning(f"Unable to fetch pages of {url} concurrently: {e}")
+            log.warning("Following next links instead")
+            pages = [first]
+
+    yield from pages
+
+    # Anything added since the count was taken, or the whole listing when
+    # it isn't count based
+    data = pages[-1]
+    while data.get("next"):
+        data = get_data(data["next"]).json()
+        yield data
+
+
 def put_data(values, url):
     try:
         request = _make_request("PUT", url, values=values)
@@ -89,24 +418,47 @@ def _make_request(verb, url, values=None):
         else:
             log.info(f"{verb}-ing to {url}")
 
-        request_method = None
-        if verb == "GET":
-            request_method = requests.get
-        elif verb == "POST":
-            request_method = requests.post
-        elif verb == "PUT":
-            request_method = requests.put
-        else:
+        if verb not in ("GET", "POST", "PUT"):
             raise ValueError(f"Got invalid verb {verb}")
 
-        request = request_method(
+        cache = get_http_cache()
+        cached = None
+        kwargs = dict()
+        if cache is not None and verb == "GET":
+            try:
+                cached = cache.get(url)
+            except (OSError, sqlite3.Error) as e:
+                log.warning(f"Unable to read http cache for {url}: {e}")
+            if cached is not None:
+                kwargs["headers"] = cached.validators()
+
+        request = _send(
+            verb,
             url,
             data=values,
             auth=(WAITER_USERNAME, WAITER_PASSWORD),
             verify=VERIFY_REQUESTS,
+            **kwargs,
         )
+
+        if cached is not None and request.status_code == 304:
+            try:
+                return cache.not_modified(cached, request)
+            except (OSError, sqlite3.Error) as e:
+                log.warning(f"Unable to update http cache for {url}: {e}")
+                return cached.to_response(not_modified=request)
+
         request.raise_for_status()
-        time.sleep(_external_request_cooldown())
+
+        if cache is not None:
+            try:
+                if verb == "GET":
+                    cache.store(url, request)
+                else:
+                    # Whatever was cached for a resource we just changed is stale
+                    cache.invalidate(url)
+            except (OSError, sqlite3.Error) as e:
+                log.warning(f"Unable to update http cache for {url}: {e}")
 
         return request
     except Exception as e:
@@ -114,29 +466,80 @@ def _make_request(verb, url, values=None):
         raise
 
 
-def stripUnicode(filename, path=None):
-    if isinstance(filename, bytes):
-        filename = filename.decode("utf-8")
+def normalize_filename(name):
+    return unidecode(name).replace("'", "")
 
-    file_path = Path(filename)
 
-    stripped_filename = unidecode(file_path.name).replace("'", "")
-    stripped_path = file_path.parent / stripped_filename
+def normalize_filenames(directory, names=None):
+    """Rename entries of directory to their ASCII-only form in one batch.
+
+    Renames are made relative to a descriptor for directory rather than the
+    working directory, so this is safe to call from any thread. A name whose
+    normalized form is already taken, by an existing entry or by another
+    name in the batch, is left alone. Returns a mapping of the old path of
+    every name in names (or every entry, if names is None) to its new path.
+    """
+    directory = Path(os.fsdecode(directory))
+    fd = os.open(directory, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+    try:
+        existing = set(os.listdir(fd))
+        if names is None:
+            names = sorted(existing)
+
+        mapping = dict()
+        claimed = set()
+        for name in names:
+            name = os.fsdecode(name)
+            new_name = normalize_filename(name)
+
+            if new_name != name:
+                if new_name in existing or new_name in claimed:
+                    log.warning(
+                        f"Not renaming {directory / name}, "
+                        f"{directory / new_name} already exists"
+                    )
+                    new_name = name
+                else:
+                    os.rename(name, new_name, src_dir_fd=fd, dst_dir_fd=fd)
+                    existing.discard(name)
+                    existing.add(new_name)
+
+            claimed.add(new_name)
+            mapping[directory / name] = directory / new_name
+    finally:
+        os.close(fd)
+    return mapping
+
+
+def normalize_paths(paths):
+    """Normalize the filenames of paths, batching the renames per directory.
+
+    Returns the new paths in the order they were given.
+    """
+    paths = [Path(os.fsdecode(x)) for x in paths]
+
+    by_directory = dict()
+    for path in paths:
+        by_directory.setdefault(path.parent, []).append(path.name)
+
+    mapping = dict()
+    for directory, names in by_directory.items():
+        mapping.update(normalize_filenames(directory, names))
+    return [mapping[path] for path in paths]
 
-    if stripped_path != file_path:
-        if path:
-            current_dir = Path(os.getcwd())
-            os.chdir(path)
 
-        os.rename(filename, stripped_filename)
+def stripUnicode(filename, path=None):
+    file_path = Path(os.fsdecode(filename))
+    if path:
+        file_path = Path(path) / file_path
 
-        if path:
-            os.chdir(current_dir)
+    if normalize_filename(file_path.name) != file_path.name:
+        file_path = normalize_filenames(file_path.parent, [file_path.name])[file_path]
 
     if path:
-        return Path(path) / stripped_filename
+        return Path(path) / file_path.name
     else:
-        return stripped_path
+        return file_path
 
 
 def send_email(subject, body):
@@ -166,7 +569,8 @@ def is_valid_media_file(path):
 
 
 def get_localpath_by_filename(filename):
-    resp = requests.get(
+    resp = _send(
+        "GET",
         mediaviewer_infer_scrapers_url(),
         params={"title": filename},
         auth=(WAITER_USERNAME, WAITER_PASSWORD),
@@ -0,0 +1,385 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+from dataclasses import dataclass
+from pathlib import Path
+
+from settings import (
+    BASE_PATH,
+    SEND_EMAIL,
+    LOCAL_TV_SHOWS_PATHS,
+    LOCAL_MOVIE_PATHS,
+    UNSORTED_PATHS,
+    WATCH_DEBOUNCE_SECONDS,
+)
+from convert import SCRATCH_PREFIX
+from tv_runner import TvRunner
+from movie_runner import Movie, MovieRunner
+from utils import send_email, flush_infer_scrapers
+
+log = logging.getLogger(__name__)
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+TV = "tv"
+MOVIE = "movie"
+UNSORTED = "unsorted"
+
+
+@dataclass(frozen=True)
+class InotifyEvent:
+    wd: int
+    mask: int
+    cookie: int
+    name: str
+
+    @property
+    def is_dir(self):
+        return bool(self.mask & IN_ISDIR)
+
+
+def parse_events(data):
+    """Yield an InotifyEvent for every inotify_event struct in data."""
+    offset = 0
+    while offset + EVENT_HEADER.size <= len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        name = data[offset : offset + length].rstrip(b"\0")
+        offset += length
+        yield InotifyEvent(
+            wd=wd, mask=mask, cookie=cookie, name=os.fsdecode(name) if name else ""
+        )
+
+
+class Inotify:
+    """Minimal wrapper around the Linux inotify API using libc directly."""
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+        return wd
+
+    def read(self, timeout=None):
+        """Return the events available within timeout seconds."""
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        if not poller.poll(None if timeout is None else int(timeout * 1000)):
+            return []
+
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        return list(parse_events(data))
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Watcher:
+    """Turn inotify events under the library roots into debounced targets.
+
+    A target is the show or movie directory an event happened in, or the
+    unsorted directory itself. Everything under the roots is watched, so
+    a release directory filled in place in an unsorted root is noticed. Targets are only handed out once no event
+    has touched them for debounce seconds, so a download that writes many
+    files is processed once after it settles.
+
+    Files are picked up when they are closed after writing or moved into
+    place, never when they are created. New directories are watched as
+    soon as they appear. They only count as activity when they are moved in
+    whole or already hold something once watched, since a freshly created
+    directory is usually still being filled.
+    """
+
+    def __init__(self, inotify, roots, debounce=None):
+        self.inotify = inotify
+        self.roots = [(kind, Path(root)) for kind, root in roots]
+        self.debounce = WATCH_DEBOUNCE_SECONDS if debounce is None else debounce
+
+        self.overflowed = False
+        self._watches = dict()
+        self._pending = dict()
+
+    def start(self):
+        for kind, root in self.roots:
+            if not root.exists():
+                log.warning(f"Not watching {root}, it does not exist")
+                continue
+            self._watch(kind, root, root)
+
+    def _watch(self, kind, root, path):
+        try:
+            wd = self.inotify.add_watch(path)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                log.error("Out of inotify watches, raise fs.inotify.max_user_watches")
+            log.warning(f"Unable to watch {path}: {e}")
+            return False
+        self._watches[wd] = (kind, root, path)
+
+        try:
+            with os.scandir(path) as entries:
+                subdirs = [
+                    Path(entry.path)
+                    for entry in entries
+                    if entry.is_dir(follow_symlinks=False)
+                    and not entry.name.startswith(SCRATCH_PREFIX)
+                ]
+        except OSError as e:
+            log.warning(f"Unable to scan {path}: {e}")
+            return True
+
+        for subdir in subdirs:
+            self._watch(kind, root, subdir)
+        return True
+
+    @staticmethod
+    def _is_empty(path):
+        try:
+            with os.scandir(path) as entries:
+                return next(entries, None) is None
+        except OSError:
+            return True
+
+    @staticmethod
+    def target_for(kind, root, path):
+        if kind == UNSORTED:
+            return kind, root
+
+        parts = path.relative_to(root).parts
+        if not parts:
+            return None
+        return kind, root / parts[0]
+
+    def handle(self, event, now=None):
+        if event.mask & IN_Q_OVERFLOW:
+            log.warning("Missed inotify events, a full sweep is needed")
+            self.overflowed = True
+            return
+
+        if event.mask & IN_IGNORED:
+            self._watches.pop(event.wd, None)
+            return
+
+        if event.wd not in self._watches or not event.name:
+            return
+
+        if event.name.startswith(SCRATCH_PREFIX):
+            # Our own in-progress encodes
+            return
+
+        kind, root, directory = self._watches[event.wd]
+        path = directory / event.name
+
+        if event.is_dir:
+            if self._watch(kind, root, path) and event.mask & IN_CREATE:
+                # Anything written before the watch was added sent no event
+                if not self._is_empty(path):
+                    self.touch(self.target_for(kind, root, path), now=now)
+            if not event.mask & IN_MOVED_TO:
+                return
+        elif event.mask & IN_CREATE:
+            # The file has only just been opened, wait for it to be closed
+            return
+
+        target = self.target_for(kind, root, path)
+        if target is not None:
+            self.touch(target, now=now)
+
+    def touch(self, target, now=None):
+        """Treat target as just changed so it is handed out again later."""
+        self._pending[target] = time.monotonic() if now is None else now
+
+    def poll(self, timeout=None):
+        for event in self.inotify.read(timeout):
+            self.handle(event)
+
+    def due(self, now=None):
+        """Pop and return the targets that have been quiet long enough."""
+        now = time.monotonic() if now is None else now
+        ready = sorted(
+            target
+            for target, last_event in self._pending.items()
+            if now - last_event >= self.debounce
+        )
+        for target in ready:
+            del self._pending[target]
+        return ready
+
+
+class WatchRunner:
+    """Process library changes as they happen instead of in periodic sweeps."""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.tvRunner = TvRunner()
+        self.movieRunner = MovieRunner()
+        self.remote_movie_paths = None
+
+    @staticmethod
+    def roots():
+        return (
+            [(TV, Path(x)) for x in LOCAL_TV_SHOWS_PATHS]
+            + [(MOVIE, Path(BASE_PATH) / x) for x in LOCAL_MOVIE_PATHS]
+            + [(UNSORTED, Path(x)) for x in UNSORTED_PATHS]
+        )
+
+    def process(self, kind, path):
+        log.info(f"Processing {kind} change in {path}")
+        if kind == TV:
+            self.process_tv(path)
+        elif kind == MOVIE:
+            self.process_movie(path)
+        elif kind == UNSORTED:
+            self.tvRunner.deferred_unsorted = self.tvRunner._sort_unsorted_files(
+                dry_run=self.dry_run, known_paths=self.tvRunner.paths
+            )
+
+    def process_tv(self, path):
+        if path not in self.tvRunner.paths:
+            self.tvRunner.load_paths()
+
+        if path not in self.tvRunner.paths:
+            log.info(f"Ignoring {path}, it is not an unfinished show")
+            return
+
+        self.tvRunner.handlePath(
+            path, self.tvRunner.paths[path], dry_run=self.dry_run, full_scan=True
+        )
+        if not self.dry_run:
+            self.tvRunner.processQueue()
+
+    def process_movie(self, path):
+        if self.remote_movie_paths is None or path not in self.remote_movie_paths:
+            self.remote_movie_paths = set(Movie.get_all_movies().keys())
+
+        if path in self.remote_movie_paths or not path.is_dir():
+            return
+
+        error_count = len(self.movieRunner.errors)
+        self.movieRunner.postMovie(path, dry_run=self.dry_run)
+        if len(self.movieRunner.errors) == error_count and not self.dry_run:
+            self.remote_movie_paths.add(path)
+
+    def is_deferred(self, kind, path):
+        if kind == TV:
+            return path in self.tvRunner.deferred
+        elif kind == MOVIE:
+            return path in self.movieRunner.deferred
+        elif kind == UNSORTED:
+            return path in self.tvRunner.deferred_unsorted
+        return False
+
+    def sweep(self):
+        log.info("Running a full sweep")
+        self.tvRunner.run(dry_run=self.dry_run, full_scan=True)
+        self.movieRunner.run(dry_run=self.dry_run)
+        self.remote_movie_paths = None
+
+    def report_errors(self):
+        errors = self.tvRunner.errors + self.movieRunner.errors
+        self.tvRunner.errors.clear()
+        self.movieRunner.errors.clear()
+
+        if not errors:
+            return
+
+        log.error("Errors occured in the following files:")
+        for error in errors:
+            log.error(error)
+
+        if SEND_EMAIL:
+            subject = "MC: Got some errors"
+            message = "\n".join(errors)
+            send_email(subject, message)
+
+    def run(self, poll_interval=1):
+        with Inotify() as inotify:
+            watcher = Watcher(inotify, self.roots())
+            watcher.start()
+            log.info("Watching for changes")
+
+            # Pick up anything that arrived while nothing was watching
+            needs_sweep = True
+            while True:
+                if needs_sweep:
+                    watcher.due(now=float("inf"))
+                    self._safely(self.sweep)
+                    needs_sweep = False
+
+                    for path in self.tvRunner.deferred:
+                        watcher.touch((TV, path))
+                    for path in self.movieRunner.deferred:
+                        watcher.touch((MOVIE, path))
+                    for path in self.tvRunner.deferred_unsorted:
+                        watcher.touch((UNSORTED, path))
+
+                watcher.poll(timeout=poll_interval)
+                if watcher.overflowed:
+                    watcher.overflowed = False
+                    needs_sweep = True
+                    continue
+
+                for kind, path in watcher.due():
+                    self._safely(self.process, kind, path)
+                    if self.is_deferred(kind, path):
+                        # Nothing else will fire once a download finishes
+                        # settling, so look again after another debounce
+                        watcher.touch((kind, path))
+                # Scrape once for everything processed in this batch
+                self._safely(flush_infer_scrapers)
+
+                self.report_errors()
+
+    def _safely(self, func, *args):
+        # One bad show or movie shouldn't stop the watch
+        try:
+            func(*args)
+        except Exception as e:
+            log.error(f"Error running {func.__name__}{args}")
+            log.exception(e)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s"
+    )
+    WatchRunner().run()